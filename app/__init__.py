@@ -2,15 +2,59 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
+from config import get_config
+from app.cache import Cache
+from app.advice import AdviceClient
+from app.metrics import Metrics
+from app.profiler import Profiler
+from app.slowlog import SlowQueryLog
+from app.charts import ChartRenderer
+from app.http_cache import init_http_caching
+from app.templating import init_templating
+from app.sessions import init_sessions
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'a-secret-key-that-you-should-change'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+db = SQLAlchemy()
+migrate = Migrate()
+login = LoginManager()
+login.login_view = 'main.login' # a 'login' endpoint will handle the logins
+cache = Cache() # shared across worker processes, see app/cache.py
+advice_client = AdviceClient() # reads DEEPSEEK_API_KEY from the environment
+metrics = Metrics() # Prometheus endpoint at /metrics, see app/metrics.py
+profiler = Profiler() # on-demand request profiles at /admin/profiles, see app/profiler.py
+slow_query_log = SlowQueryLog() # SQL slower than SLOW_QUERY_THRESHOLD, see app/slowlog.py
+charts = ChartRenderer() # report charts drawn in separate processes, see app/charts.py
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-login = LoginManager(app)
-login.login_view = 'login' # a 'login' endpoint will handle the logins
 
-from app import routes, models
+def create_app(config=None):
+    """Build the application.
+
+    ``config`` is a config class, or the name of one in ``config.CONFIGS``;
+    by default the ``APP_CONFIG`` environment variable picks it.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config if isinstance(config, type) else get_config(config))
+
+    db.init_app(app)
+    migrate.init_app(app, db)
+    login.init_app(app)
+    cache.init_app(app)
+    advice_client.init_app(app)
+    charts.init_app(app)
+    metrics.init_app(app) # first, so its timing also covers the other hooks
+    profiler.init_app(app)
+    slow_query_log.init_app(app)
+    init_http_caching(app)
+    init_templating(app)
+    init_sessions(app) # cookie holds only the session id, see app/sessions.py
+
+    from app.routes import bp as main_bp
+    app.register_blueprint(main_bp)
+    from app.commands import bp as cli_bp
+    app.register_blueprint(cli_bp)
+    from app.jobs import scheduler
+    scheduler.init_app(app) # periodic jobs, see app/scheduler.py
+
+    return app
+
+
+from app import models
@@ -0,0 +1,493 @@
+"""
+DeepSeek advice client.
+
+``AdviceClient.get_advice(metrics)`` turns a user's weekly averages into a
+health assessment from the DeepSeek chat API.  Calls go through one pooled
+``requests.Session`` per process with connect/read timeouts, a few retries
+with exponential backoff for transient failures, and a circuit breaker that
+fails fast for a while after repeated errors instead of tying up workers on
+a struggling upstream.
+
+Metrics are rounded before they are put in the prompt, and the answer is
+stored in the shared cache under a hash of the rounded values, so users
+with similar weeks share one upstream call.  Identical calls that arrive
+while one is already in flight wait for it instead of calling again.
+
+``stream_advice`` yields the answer piece by piece as the API produces it,
+for relaying to the browser over server-sent events.
+
+``AsyncAdviceClient`` does the same on an asyncio event loop with httpx,
+for the ASGI serving mode in app/asgi.py.
+
+Point ``DEEPSEEK_API_URL`` at ``llm_stub.py`` to work offline.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # only the ASGI mode needs httpx
+    httpx = None
+
+PROMPT = ('请根据以下健康数据给出健康评估和建议，数据包含周平均睡眠时长（小时/天）、身体质量指数（BMI）、'
+          '周日均摄入热量（大卡）和周日均运动消耗（大卡）。并且给出食谱建议。')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+NOT_CONFIGURED = '未配置 DeepSeek API 密钥，无法获取额外的健康评估建议。'
+CIRCUIT_OPEN = 'DeepSeek 服务暂时不可用，请稍后重试。'
+FAILED = '无法获取 DeepSeek 的健康评估建议，请稍后重试。'
+
+STREAM_END = object()
+
+
+class AdviceUnavailable(Exception):
+    """The advice could not be fetched; the message is safe to show to users."""
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failures and lets one trial call
+    through once ``reset_timeout`` seconds have passed."""
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def release_trial(self):
+        """End a trial call that proved nothing either way, e.g. one the client abandoned."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._failures >= self.threshold or self._opened_at is not None:
+                self._opened_at = time.monotonic()
+
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers share its result."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def round_metrics(metrics):
+    """Round the inputs so nearly identical weeks share a prompt and a cache entry."""
+    bmi = metrics.get('bmi')
+    return {
+        'avg_sleep': round(metrics.get('avg_sleep') or 0, 1),
+        'bmi': round(bmi, 1) if bmi else None,
+        'avg_calories_eaten': int(round((metrics.get('avg_calories_eaten') or 0) / 10.0)) * 10,
+        'avg_calories_burned': int(round((metrics.get('avg_calories_burned') or 0) / 10.0)) * 10,
+    }
+
+
+def build_messages(metrics):
+    bmi = metrics['bmi'] if metrics['bmi'] else '无数据'
+    return [{
+        'role': 'user',
+        'content': f"{PROMPT} 周平均睡眠时长：{metrics['avg_sleep']} 小时/天，BMI：{bmi}，"
+                   f"周日均摄入热量：{metrics['avg_calories_eaten']} 大卡，"
+                   f"周日均运动消耗：{metrics['avg_calories_burned']} 大卡",
+    }]
+
+
+def cache_key(metrics):
+    digest = hashlib.blake2b(json.dumps(metrics, sort_keys=True).encode(), digest_size=16).hexdigest()
+    return f'advice:{digest}'
+
+
+def build_payload(config, messages, **extra):
+    return dict(model=config['DEEPSEEK_MODEL'], messages=messages, max_tokens=1000, temperature=0.3, **extra)
+
+
+def parse_stream_line(line):
+    """The text carried by one line of the API's event stream.
+
+    Returns None for lines without text and ``STREAM_END`` for the final
+    ``[DONE]`` marker.
+    """
+    if not line.startswith('data:'):
+        return None
+    data = line[5:].strip()
+    if data == '[DONE]':
+        return STREAM_END
+    return json.loads(data)['choices'][0]['delta'].get('content')
+
+
+class AdviceClient:
+
+    def __init__(self, app=None):
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self.breaker = CircuitBreaker()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DEEPSEEK_API_KEY', os.environ.get('DEEPSEEK_API_KEY'))
+        app.config.setdefault('DEEPSEEK_API_URL', os.environ.get(
+            'DEEPSEEK_API_URL', 'https://api.deepseek.com/v1/chat/completions'))
+        app.config.setdefault('DEEPSEEK_MODEL', 'deepseek-chat')
+        app.config.setdefault('DEEPSEEK_CONNECT_TIMEOUT', 3.05) # seconds
+        app.config.setdefault('DEEPSEEK_READ_TIMEOUT', 30) # seconds
+        app.config.setdefault('DEEPSEEK_MAX_RETRIES', 2)
+        app.config.setdefault('DEEPSEEK_RETRY_BACKOFF', 0.5) # seconds, doubled on each retry
+        app.config.setdefault('DEEPSEEK_POOL_SIZE', 10)
+        app.config.setdefault('DEEPSEEK_ASYNC_MAX_CONNECTIONS', 1000) # per process, ASGI mode only
+        app.config.setdefault('DEEPSEEK_BREAKER_THRESHOLD', 5)
+        app.config.setdefault('DEEPSEEK_BREAKER_RESET', 30) # seconds
+        app.config.setdefault('ADVICE_CACHE_TTL', 86400) # seconds
+        app.config.setdefault('ADVICE_MAX_STREAMS', 4) # per process
+        self.breaker = CircuitBreaker(app.config['DEEPSEEK_BREAKER_THRESHOLD'], app.config['DEEPSEEK_BREAKER_RESET'])
+        # Every open stream holds a worker thread, so only a few may run at once
+        self.stream_slots = threading.BoundedSemaphore(app.config['ADVICE_MAX_STREAMS'])
+        app.extensions['advice'] = self
+
+    @property
+    def session(self):
+        # One pool per process; connections must not be shared across a fork
+        if self._session is None or self._session_pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=current_app.config['DEEPSEEK_POOL_SIZE'])
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session, self._session_pid = session, os.getpid()
+        return self._session
+
+    @property
+    def configured(self):
+        return bool(current_app.config['DEEPSEEK_API_KEY'])
+
+    def get_advice(self, metrics):
+        """Advice text for the given weekly metrics (see ``round_metrics``).
+
+        Raises ``AdviceUnavailable`` when the API is not configured, the
+        circuit is open or the call failed after retries.
+        """
+        if not self.configured:
+            raise AdviceUnavailable(NOT_CONFIGURED)
+        metrics = round_metrics(metrics)
+        key = cache_key(metrics)
+        cache = current_app.extensions['cache']
+        advice = cache.get(key)
+        if advice is not None:
+            return advice
+        return self._flights.do(key, lambda: self._fetch(key, metrics))
+
+    def _fetch(self, key, metrics):
+        cache = current_app.extensions['cache']
+        # Another worker process may have finished the same call meanwhile
+        advice = cache.get(key)
+        if advice is not None:
+            return advice
+        if not self.breaker.allow():
+            raise AdviceUnavailable(CIRCUIT_OPEN)
+        try:
+            advice = self._post(build_messages(metrics))
+        except Exception as e:  # also JSON of the wrong shape, so a half-open trial always ends
+            self.breaker.record_failure()
+            current_app.logger.error(f"调用 DeepSeek API 出错: {e}")
+            raise AdviceUnavailable(FAILED) from e
+        self.breaker.record_success()
+        cache.set(key, advice, ttl=current_app.config['ADVICE_CACHE_TTL'])
+        return advice
+
+    def payload(self, messages, **extra):
+        return build_payload(current_app.config, messages, **extra)
+
+    def request(self, payload, stream=False):
+        """POST to the chat API, retrying connection errors and transient statuses."""
+        config = current_app.config
+        headers = {'Authorization': f"Bearer {config['DEEPSEEK_API_KEY']}"}
+        timeout = (config['DEEPSEEK_CONNECT_TIMEOUT'], config['DEEPSEEK_READ_TIMEOUT'])
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(config['DEEPSEEK_API_URL'], json=payload, headers=headers,
+                                             timeout=timeout, stream=stream)
+                if response.status_code not in RETRY_STATUSES or attempt >= config['DEEPSEEK_MAX_RETRIES']:
+                    response.raise_for_status()
+                    return response
+                response.close()
+            except (requests.ConnectionError, requests.ConnectTimeout):
+                # Read timeouts are not retried: the upstream is up but slow
+                if attempt >= config['DEEPSEEK_MAX_RETRIES']:
+                    raise
+            delay = config['DEEPSEEK_RETRY_BACKOFF'] * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay / 2))
+            attempt += 1
+
+    def stream_advice(self, metrics):
+        """Yield the advice text in pieces as the API produces them.
+
+        A cached answer is yielded in one piece.  The complete text is cached
+        like ``get_advice`` once the stream finishes.  Raises
+        ``AdviceUnavailable`` like ``get_advice``, possibly after some pieces
+        have already been yielded.
+        """
+        if not self.configured:
+            raise AdviceUnavailable(NOT_CONFIGURED)
+        metrics = round_metrics(metrics)
+        key = cache_key(metrics)
+        cache = current_app.extensions['cache']
+        advice = cache.get(key)
+        if advice is not None:
+            yield advice
+            return
+        if not self.breaker.allow():
+            raise AdviceUnavailable(CIRCUIT_OPEN)
+
+        pieces = []
+        try:
+            with self.request(self.payload(build_messages(metrics), stream=True), stream=True) as response:
+                # Split bytes, not text: event streams carry no charset and requests would guess Latin-1
+                for line in response.iter_lines():
+                    piece = parse_stream_line(line.decode('utf-8'))
+                    if piece is STREAM_END:
+                        break
+                    if piece:
+                        pieces.append(piece)
+                        yield piece
+        except GeneratorExit:
+            # The browser went away mid-stream: no complete answer, but no upstream failure either
+            self.breaker.release_trial()
+            raise
+        except Exception as e:  # also JSON of the wrong shape, so a half-open trial always ends
+            self.breaker.record_failure()
+            current_app.logger.error(f"调用 DeepSeek API 出错: {e}")
+            raise AdviceUnavailable(FAILED) from e
+        self.breaker.record_success()
+        cache.set(key, ''.join(pieces), ttl=current_app.config['ADVICE_CACHE_TTL'])
+
+    def _post(self, messages):
+        data = self.request(self.payload(messages)).json()
+        return data['choices'][0]['message']['content']
+
+
+class AsyncSingleFlight:
+    """``SingleFlight`` for coroutines on one event loop.
+
+    The call runs as its own task, so a caller that is cancelled (its client
+    went away) does not cancel the call for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+
+class AsyncAdviceClient:
+    """``AdviceClient`` for an asyncio event loop.
+
+    Same prompt, cache entries, retries and circuit breaking, but the API is
+    called through an ``httpx.AsyncClient``, so a request waiting on DeepSeek
+    holds no thread.  The short, blocking cache calls run in ``executor``.
+    """
+
+    def __init__(self, app, executor=None):
+        if httpx is None:
+            raise RuntimeError('AsyncAdviceClient needs httpx (pip install httpx)')
+        self.config = app.config
+        self.cache = app.extensions['cache']
+        self.logger = app.logger
+        self.executor = executor
+        self.breaker = CircuitBreaker(app.config['DEEPSEEK_BREAKER_THRESHOLD'], app.config['DEEPSEEK_BREAKER_RESET'])
+        self._flights = AsyncSingleFlight()
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use so it belongs to the server's event loop
+        if self._client is None:
+            config = self.config
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(config['DEEPSEEK_READ_TIMEOUT'], connect=config['DEEPSEEK_CONNECT_TIMEOUT']),
+                limits=httpx.Limits(max_connections=config['DEEPSEEK_ASYNC_MAX_CONNECTIONS'],
+                                    max_keepalive_connections=config['DEEPSEEK_POOL_SIZE']))
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def configured(self):
+        return bool(self.config['DEEPSEEK_API_KEY'])
+
+    async def _cache_get(self, key):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.cache.get, key)
+
+    async def _cache_set(self, key, value):
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: self.cache.set(key, value, ttl=self.config['ADVICE_CACHE_TTL']))
+
+    async def get_advice(self, metrics):
+        """See ``AdviceClient.get_advice``."""
+        if not self.configured:
+            raise AdviceUnavailable(NOT_CONFIGURED)
+        metrics = round_metrics(metrics)
+        key = cache_key(metrics)
+        advice = await self._cache_get(key)
+        if advice is not None:
+            return advice
+        return await self._flights.do(key, lambda: self._fetch(key, metrics))
+
+    async def _fetch(self, key, metrics):
+        # Another worker process may have finished the same call meanwhile
+        advice = await self._cache_get(key)
+        if advice is not None:
+            return advice
+        if not self.breaker.allow():
+            raise AdviceUnavailable(CIRCUIT_OPEN)
+        try:
+            response = await self.request(build_payload(self.config, build_messages(metrics)))
+            advice = response.json()['choices'][0]['message']['content']
+        except Exception as e:  # also JSON of the wrong shape, so a half-open trial always ends
+            self.breaker.record_failure()
+            self.logger.error(f"调用 DeepSeek API 出错: {e}")
+            raise AdviceUnavailable(FAILED) from e
+        self.breaker.record_success()
+        await self._cache_set(key, advice)
+        return advice
+
+    async def request(self, payload, stream=False):
+        """See ``AdviceClient.request``; close a streamed response with ``aclose()``."""
+        config = self.config
+        headers = {'Authorization': f"Bearer {config['DEEPSEEK_API_KEY']}"}
+        attempt = 0
+        while True:
+            try:
+                request = self.client.build_request('POST', config['DEEPSEEK_API_URL'], json=payload, headers=headers)
+                response = await self.client.send(request, stream=stream)
+                if response.status_code not in RETRY_STATUSES or attempt >= config['DEEPSEEK_MAX_RETRIES']:
+                    if response.is_error:
+                        await response.aclose()
+                        response.raise_for_status()
+                    return response
+                await response.aclose()
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if attempt >= config['DEEPSEEK_MAX_RETRIES']:
+                    raise
+            delay = config['DEEPSEEK_RETRY_BACKOFF'] * (2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            attempt += 1
+
+    async def stream_advice(self, metrics):
+        """See ``AdviceClient.stream_advice``; close the generator with ``aclose()``."""
+        if not self.configured:
+            raise AdviceUnavailable(NOT_CONFIGURED)
+        metrics = round_metrics(metrics)
+        key = cache_key(metrics)
+        advice = await self._cache_get(key)
+        if advice is not None:
+            yield advice
+            return
+        if not self.breaker.allow():
+            raise AdviceUnavailable(CIRCUIT_OPEN)
+
+        pieces = []
+        try:
+            response = await self.request(build_payload(self.config, build_messages(metrics), stream=True),
+                                          stream=True)
+            try:
+                # httpx decodes event streams without a charset as UTF-8
+                async for line in response.aiter_lines():
+                    piece = parse_stream_line(line)
+                    if piece is STREAM_END:
+                        break
+                    if piece:
+                        pieces.append(piece)
+                        yield piece
+            finally:
+                await response.aclose()
+        except (GeneratorExit, asyncio.CancelledError):
+            # The browser went away mid-stream: no complete answer, but no upstream failure either
+            self.breaker.release_trial()
+            raise
+        except Exception as e:  # also JSON of the wrong shape, so a half-open trial always ends
+            self.breaker.record_failure()
+            self.logger.error(f"调用 DeepSeek API 出错: {e}")
+            raise AdviceUnavailable(FAILED) from e
+        self.breaker.record_success()
+        await self._cache_set(key, ''.join(pieces))
@@ -1,53 +1,57 @@
 import numpy as np
-import pandas as pd
 from sklearn.linear_model import LinearRegression
 from sklearn.metrics import mean_squared_error, r2_score
-import matplotlib.pyplot as plt
-import io
 import base64
+import logging
 from datetime import datetime, timedelta
-import matplotlib
 from .models import SleepRecord
+from .history import day_date
+from .charts import ChartUnavailable
 
-plt.rcParams['font.sans-serif'] = ['SimHei']
-plt.rcParams['axes.unicode_minus'] = False
+logger = logging.getLogger(__name__)
 
-matplotlib.use('Agg')  # Use non-interactive backend
+def render_plot(name, data):
+    """The chart as a base64 PNG for an ``<img>`` data URL, or None if it could not be drawn."""
+    from app import charts
+    try:
+        return base64.b64encode(charts.render(name, data)).decode('ascii')
+    except ChartUnavailable:
+        logger.exception('could not render the %s chart', name)
+        return None
 
-def generate_sleep_prediction(sleep_records, days_to_predict=7):
+def generate_sleep_prediction(sleep, days_to_predict=7):
     """
     Generate sleep quality prediction using linear regression.
     
     Args:
-        sleep_records: List of SleepRecord objects
+        sleep: Sleep history array (``history.SLEEP_DTYPE``)
         days_to_predict: Number of days to predict into the future
         
     Returns:
-        dict: Dictionary containing prediction results and visualization
+        dict: Dictionary containing prediction results and chart data
     """
-    if len(sleep_records) < 5:
+    if len(sleep) < 5:
         return {
             'success': False,
             'message': '需要至少5条睡眠记录来生成预测',
-            'plot': None,
+            'chart': None,
             'prediction': None,
             'r2_score': None
         }
     
-    # Extract data and sort by date
-    data = [(record.sleep_time.date(), record.duration) for record in sleep_records]
-    data.sort(key=lambda x: x[0])
-    
-    # Convert to DataFrame
-    df = pd.DataFrame(data, columns=['date', 'duration'])
+    # Sort by date
+    order = np.argsort(sleep['day'], kind='stable')
+    days = sleep['day'][order]
+    durations = sleep['hours'][order]
     
     # Create feature (days since first record)
-    first_date = df['date'].min()
-    df['days_since_start'] = df['date'].apply(lambda x: (x - first_date).days)
+    first_day = days[0]
+    first_date = day_date(first_day)
+    days_since_start = days - first_day
     
     # Prepare data for linear regression
-    X = df[['days_since_start']].values
-    y = df['duration'].values
+    X = days_since_start.reshape(-1, 1)
+    y = durations
     
     # Create and train the model
     model = LinearRegression()
@@ -61,123 +65,93 @@ def generate_sleep_prediction(sleep_records, days_to_predict=7):
     r2 = r2_score(y, y_pred)
     
     # Predict future values
-    last_day = df['days_since_start'].max()
-    future_days = np.array([[last_day + i + 1] for i in range(days_to_predict)])
+    last_day = int(days_since_start[-1])
+    future_days = np.arange(last_day + 1, last_day + days_to_predict + 1).reshape(-1, 1)
     future_predictions = model.predict(future_days)
     
     # Generate dates for future predictions
-    last_date = df['date'].max()
+    last_date = first_date + timedelta(days=last_day)
     future_dates = [last_date + timedelta(days=i+1) for i in range(days_to_predict)]
     
-    # Create visualization
-    plt.figure(figsize=(10, 6))
-    plt.scatter(df['date'], df['duration'], color='blue', label='实际睡眠时长')
-    
-    # Plot regression line for historical data
-    all_days = np.array([[i] for i in range(df['days_since_start'].min(), last_day + days_to_predict + 1)])
+    # Regression line for historical data and the predicted days
+    all_days = np.arange(0, last_day + days_to_predict + 1).reshape(-1, 1)
     all_predictions = model.predict(all_days)
-    all_dates = [first_date + timedelta(days=i) for i in range(len(all_days))]
-    plt.plot(all_dates, all_predictions, color='red', label='趋势线')
-    
-    # Plot future predictions
-    plt.scatter(future_dates, future_predictions, color='green', label='预测睡眠时长')
-    
-    plt.xlabel('日期')
-    plt.ylabel('睡眠时长 (小时)')
-    plt.title('睡眠时长趋势与预测')
-    plt.legend()
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    
-    # Convert plot to base64 string
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plot_url = base64.b64encode(img.getvalue()).decode('utf-8')
-    plt.close()
+    
+    # Chart data; the report draws it with render_plot after its cache lookup
+    first = np.datetime64(first_date, 'D')
+    chart = ('sleep_prediction', {
+        'dates': days.astype('datetime64[D]'),
+        'durations': durations,
+        'trend_dates': first + np.arange(len(all_days)),
+        'trend': all_predictions,
+        'future_dates': first + future_days.ravel(),
+        'future': future_predictions,
+    })
     
     return {
         'success': True,
         'message': '预测成功',
-        'plot': plot_url,
+        'chart': chart,
         'prediction': future_predictions.tolist(),
         'prediction_dates': [date.strftime('%Y-%m-%d') for date in future_dates],
         'r2_score': r2,
         'slope': model.coef_[0]
     }
 
-def analyze_exercise_sleep_correlation(exercise_records, sleep_records):
+def analyze_exercise_sleep_correlation(exercise, sleep):
     """
     Analyze correlation between exercise duration and sleep quality.
     
     Args:
-        exercise_records: List of ExerciseRecord objects
-        sleep_records: List of SleepRecord objects
+        exercise: Exercise history array (``history.EXERCISE_DTYPE``)
+        sleep: Sleep history array (``history.SLEEP_DTYPE``)
         
     Returns:
-        dict: Dictionary containing correlation results and visualization
+        dict: Dictionary containing correlation results and chart data
     """
-    if len(exercise_records) < 5 or len(sleep_records) < 5:
+    if len(exercise) < 5 or len(sleep) < 5:
         return {
             'success': False,
             'message': '需要至少5条运动记录和5条睡眠记录来分析相关性',
-            'plot': None,
+            'chart': None,
             'correlation': None
         }
     
-    # Create DataFrames
-    exercise_df = pd.DataFrame([
-        {'date': record.timestamp.date(), 'duration': record.duration}
-        for record in exercise_records
-    ])
-    
-    sleep_df = pd.DataFrame([
-        {'date': record.sleep_time.date(), 'duration': record.duration}
-        for record in sleep_records
-    ])
-    
     # Group by date and sum exercise duration
-    exercise_df = exercise_df.groupby('date')['duration'].sum().reset_index()
+    exercise_days, day_positions = np.unique(exercise['day'], return_inverse=True)
+    daily_minutes = np.bincount(day_positions, weights=exercise['minutes'])
     
-    # Merge data on date
-    merged_df = pd.merge(exercise_df, sleep_df, on='date', how='inner', suffixes=('_exercise', '_sleep'))
+    # Pair each sleep record with the exercise of the day it started on
+    positions = np.searchsorted(exercise_days, sleep['day']).clip(max=len(exercise_days) - 1)
+    matched = exercise_days[positions] == sleep['day']
+    duration_exercise = daily_minutes[positions[matched]]
+    duration_sleep = sleep['hours'][matched]
     
-    if len(merged_df) < 5:
+    if len(duration_sleep) < 5:
         return {
             'success': False,
             'message': '没有足够的匹配数据来分析相关性（需要至少5天同时有运动和睡眠记录）',
-            'plot': None,
+            'chart': None,
             'correlation': None
         }
     
-    # Calculate correlation
-    correlation = merged_df['duration_exercise'].corr(merged_df['duration_sleep'])
-    
-    # Create visualization
-    plt.figure(figsize=(10, 6))
-    plt.scatter(merged_df['duration_exercise'], merged_df['duration_sleep'])
+    # Calculate correlation (NaN when either side never varies)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = float(np.corrcoef(duration_exercise, duration_sleep)[0, 1])
     
-    # Add regression line
-    X = merged_df[['duration_exercise']].values
-    y = merged_df['duration_sleep'].values
+    # Regression line
+    X = duration_exercise.reshape(-1, 1)
+    y = duration_sleep
     model = LinearRegression()
     model.fit(X, y)
     y_pred = model.predict(X)
-    plt.plot(merged_df['duration_exercise'], y_pred, color='red')
-    
-    plt.xlabel('运动时长 (分钟)')
-    plt.ylabel('睡眠时长 (小时)')
-    plt.title('运动时长与睡眠质量相关性分析')
-    plt.grid(True)
-    plt.tight_layout()
     
-    # Convert plot to base64 string
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plot_url = base64.b64encode(img.getvalue()).decode('utf-8')
-    plt.close()
+    # Chart data; the report draws it with render_plot after its cache lookup
+    chart = ('exercise_sleep_correlation', {
+        'exercise': duration_exercise,
+        'sleep': duration_sleep,
+        'fit': y_pred,
+    })
     
     # Prepare interpretation
     if correlation > 0.7:
@@ -196,11 +170,11 @@ def analyze_exercise_sleep_correlation(exercise_records, sleep_records):
     return {
         'success': True,
         'message': '分析成功',
-        'plot': plot_url,
+        'chart': chart,
         'correlation': correlation,
         'interpretation': interpretation,
         'slope': model.coef_[0],
-        'data_points': len(merged_df)
+        'data_points': len(duration_sleep)
     }
 
 def get_weekly_avg_sleep(user):
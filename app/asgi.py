@@ -0,0 +1,349 @@
+"""
+ASGI serving mode.
+
+    uvicorn asgi:app --workers 4
+
+``AsyncRoutes`` wraps the Flask app and answers the routes that spend
+their time waiting on I/O directly on the event loop, where a waiting
+request costs a coroutine instead of a worker thread:
+
+* ``POST /get_deepseek_advice`` and ``GET /advice/stream`` - the same
+  responses as the views in routes.py, with DeepSeek called through
+  ``AsyncAdviceClient``;
+* ``GET /report/status?since=<generation>`` - long poll used by the report
+  page.  Answers as soon as the user's data generation differs from
+  ``since``, or with ``"changed": false`` after ``REPORT_POLL_TIMEOUT``
+  seconds.  One ``GenerationWatcher`` per process polls the shared cache
+  for all waiting requests at once.
+
+Every other request runs the unchanged Flask app in a thread pool of
+``ASGI_THREADS`` threads.  The async routes authenticate by opening a Flask
+request context in that pool, so sessions, remember cookies and the login
+redirect behave exactly as in the Flask views.
+
+Needs httpx for the DeepSeek calls and an ASGI server such as uvicorn; the
+WSGI deployment needs neither.
+"""
+import asyncio
+import io
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from flask import request
+from flask_login import current_user
+from flask_login.utils import login_url
+
+from app.advice import AdviceUnavailable, AsyncAdviceClient
+from app.routes import save_last_advice, weekly_metrics
+
+
+def wsgi_environ(scope, body=b''):
+    """A WSGI environ for an ASGI http ``scope``."""
+    script_name = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    path_info = scope['path'].encode('utf-8').decode('latin-1')
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def until_disconnect(receive, coro):
+    """Run ``coro`` but cancel it if the client disconnects first.
+
+    Returns ``(True, result)``, or ``(False, None)`` after a disconnect.
+    """
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    work = asyncio.ensure_future(coro)
+    watch = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({work, watch}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watch.cancel()
+        if not work.done():
+            work.cancel()
+            await asyncio.wait({work})  # let it unwind, e.g. close the upstream response
+    if work.cancelled():
+        return False, None
+    return True, work.result()
+
+
+async def send_json(send, data, status=200):
+    body = json.dumps(data, ensure_ascii=False).encode()
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode()),
+        (b'cache-control', b'no-store'),
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_redirect(send, location):
+    await send({'type': 'http.response.start', 'status': 302, 'headers': [
+        (b'location', location.encode('latin-1')),
+        (b'content-length', b'0'),
+    ]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def sse(data, event=None):
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n'.encode()
+
+
+class WSGIAdapter:
+    """Runs a WSGI app for ASGI http requests in a thread pool.
+
+    The response body is passed on chunk by chunk as the app produces it,
+    and the thread waits for each chunk to be sent.
+    """
+
+    def __init__(self, wsgi_app, executor):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        environ = wsgi_environ(scope, await read_body(receive))
+        loop = asyncio.get_running_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            }
+
+        async def send_body(body, more_body):
+            if 'start' in response:
+                await send(response.pop('start'))
+            await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+        def run():
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    if chunk:
+                        asyncio.run_coroutine_threadsafe(send_body(chunk, True), loop).result()
+                asyncio.run_coroutine_threadsafe(send_body(b'', False), loop).result()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        await loop.run_in_executor(self.executor, run)
+
+
+class GenerationWatcher:
+    """Wakes long-poll waiters when the cache generation they wait on moves.
+
+    One task per process reads all watched generations with a single
+    ``get_counters`` call every ``interval`` seconds, however many requests
+    are waiting, and stops while nobody is.
+    """
+
+    def __init__(self, cache, executor, interval=1.0):
+        self.cache = cache
+        self.executor = executor
+        self.interval = interval
+        self._waiters = defaultdict(dict)  # key -> {future: since}
+        self._task = None
+
+    async def current(self, key):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.cache.generation, key)
+
+    async def wait(self, key, since, timeout):
+        """The generation of ``key`` once it differs from ``since``, or ``since`` after ``timeout`` seconds."""
+        generation = await self.current(key)
+        if since is None or generation != since:
+            return generation
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[key][future] = since
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return since
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.pop(future, None)
+                if not waiters:
+                    del self._waiters[key]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            await asyncio.sleep(self.interval)
+            keys = list(self._waiters)
+            if not keys:
+                break
+            try:
+                generations = await loop.run_in_executor(self.executor, self.cache.generations, keys)
+            except Exception:
+                continue  # a locked cache database; try again next round
+            for key in keys:
+                for future, since in list(self._waiters.get(key, {}).items()):
+                    if generations[key] != since and not future.done():
+                        future.set_result(generations[key])
+
+
+class AsyncRoutes:
+    """ASGI application serving the I/O-bound routes natively and the rest through Flask."""
+
+    def __init__(self, flask_app):
+        flask_app.config.setdefault('ASGI_THREADS', 16) # see config.py
+        flask_app.config.setdefault('REPORT_POLL_TIMEOUT', 25) # seconds, below common proxy read timeouts
+        flask_app.config.setdefault('REPORT_POLL_INTERVAL', 1.0) # seconds
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(flask_app.config['ASGI_THREADS'], thread_name_prefix='asgi')
+        self.wsgi = WSGIAdapter(flask_app, self.executor)
+        self.advice = AsyncAdviceClient(flask_app, self.executor)
+        self.watcher = GenerationWatcher(flask_app.extensions['cache'], self.executor,
+                                         flask_app.config['REPORT_POLL_INTERVAL'])
+        self.routes = {
+            ('POST', '/get_deepseek_advice'): self.get_deepseek_advice,
+            ('GET', '/advice/stream'): self.stream_deepseek_advice,
+            ('GET', '/report/status'): self.report_status,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return  # no websockets; the server closes the connection
+        path = scope['path'][len(scope.get('root_path', '')):] if scope.get('root_path') else scope['path']
+        handler = self.routes.get((scope['method'], path))
+        if handler is None:
+            await self.wsgi(scope, receive, send)
+        else:
+            await handler(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.advice.aclose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run_sync(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _as_user(self, environ, fn):
+        """``(True, fn(user))`` inside a Flask request context, or ``(False, login_url)`` for anonymous requests."""
+        with self.flask_app.request_context(environ):
+            if not current_user.is_authenticated:
+                return False, login_url(self.flask_app.login_manager.login_view, next_url=request.url)
+            return True, fn(current_user)
+
+    def _save_last_advice(self, user_id, text):
+        with self.flask_app.app_context():
+            save_last_advice(user_id, text)
+
+    def _metrics(self, user):
+        return user.id, weekly_metrics(user)
+
+    # --- routes ---
+
+    async def get_deepseek_advice(self, scope, receive, send):
+        environ = wsgi_environ(scope, await read_body(receive))
+        authenticated, result = await self.run_sync(self._as_user, environ, self._metrics)
+        if not authenticated:
+            await send_redirect(send, result)
+            return
+        user_id, metrics = result
+        try:
+            advice = await self.advice.get_advice(metrics)
+            await self.run_sync(self._save_last_advice, user_id, advice)
+        except AdviceUnavailable as e:
+            advice = str(e)
+        await send_json(send, {'advice': advice})
+
+    async def stream_deepseek_advice(self, scope, receive, send):
+        """Relay the advice as server-sent events, without the per-process stream limit of the WSGI view."""
+        authenticated, result = await self.run_sync(self._as_user, wsgi_environ(scope), self._metrics)
+        if not authenticated:
+            await send_redirect(send, result)
+            return
+        user_id, metrics = result
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'), # tell nginx not to buffer the stream
+        ]})
+
+        async def relay():
+            pieces = self.advice.stream_advice(metrics)
+            text = []
+            try:
+                async for piece in pieces:
+                    text.append(piece)
+                    await send({'type': 'http.response.body', 'body': sse({'text': piece}), 'more_body': True})
+            except AdviceUnavailable as e:
+                return sse({'message': str(e)}, event='failed')
+            finally:
+                await pieces.aclose()
+            await self.run_sync(self._save_last_advice, user_id, ''.join(text))
+            return sse({}, event='done')
+
+        connected, last_event = await until_disconnect(receive, relay())
+        if connected:
+            await send({'type': 'http.response.body', 'body': last_event})
+
+    async def report_status(self, scope, receive, send):
+        authenticated, result = await self.run_sync(self._as_user, wsgi_environ(scope), lambda user: user.id)
+        if not authenticated:
+            await send_json(send, {'error': 'login required'}, status=401)
+            return
+        try:
+            since = int(parse_qs(scope['query_string'].decode('latin-1')).get('since', [''])[0])
+        except ValueError:
+            since = None
+        connected, generation = await until_disconnect(receive, self.watcher.wait(
+            f'user:{result}', since, self.flask_app.config['REPORT_POLL_TIMEOUT']))
+        if connected:
+            await send_json(send, {'generation': generation, 'changed': generation != since})
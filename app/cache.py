@@ -0,0 +1,355 @@
+"""
+Shared result cache.
+
+Values are pickled and stored in a backend that every worker process on the
+host can see.  The default backend is a SQLite file in the instance folder;
+``RedisBackend`` accepts any client with a redis-py style interface so the
+same cache can be moved to a memcached/Redis-like server without touching
+the callers.
+
+Besides plain entries, the cache keeps monotonically increasing counters
+("generations").  Every route that changes a user's data bumps that user's
+generation, and cached results are keyed by it, so a write makes all older
+entries unreachable without having to enumerate and delete them.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Small in-process LRU mapping with an optional per-entry time to live.
+
+    Use it for data that is cheap to rebuild and only needs to be shared
+    between requests of one worker process.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteBackend:
+    """File-backed store shared by all processes, with LRU eviction.
+
+    A hit refreshes the entry's ``accessed_at`` only when it is more than
+    ``touch_interval`` seconds old, so most reads do not take the write lock.
+    """
+
+    tracks_generations = True
+
+    def __init__(self, path, max_entries=2048, touch_interval=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+
+    def _conn(self):
+        # sqlite3 connections must not cross threads or a fork, so keep one
+        # per thread and reopen it when we find ourselves in a new process.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS cache_entry (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_cache_entry_accessed_at
+                    ON cache_entry (accessed_at);
+                CREATE TABLE IF NOT EXISTS cache_counter (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            ''')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute('SELECT value, expires_at, accessed_at FROM cache_entry WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at, accessed_at = row
+        now = time.time()
+        if expires_at is not None and expires_at < now:
+            conn.execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+            return None
+        if accessed_at < now - self.touch_interval:
+            conn.execute('UPDATE cache_entry SET accessed_at = ? WHERE key = ?', (now, key))
+        return value
+
+    def set(self, key, value, ttl=None):
+        conn = self._conn()
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        conn.execute('INSERT OR REPLACE INTO cache_entry (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                     (key, value, expires_at, now))
+        if self.max_entries:
+            # Keep the most recently used entries and drop everything past the bound
+            conn.execute('''DELETE FROM cache_entry WHERE key IN (
+                                SELECT key FROM cache_entry ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)''',
+                         (self.max_entries,))
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+
+    def incr(self, key):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('''INSERT INTO cache_counter (key, value, updated_at) VALUES (?, 1, ?)
+                            ON CONFLICT(key) DO UPDATE SET value = value + 1, updated_at = excluded.updated_at''',
+                         (key, now))
+            value = conn.execute('SELECT value FROM cache_counter WHERE key = ?', (key,)).fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return value
+
+    def get_counters(self, keys):
+        """Return ``{key: (value, updated_at)}`` for the counters that exist."""
+        if not keys:
+            return {}
+        placeholders = ','.join('?' * len(keys))
+        rows = self._conn().execute(
+            f'SELECT key, value, updated_at FROM cache_counter WHERE key IN ({placeholders})', list(keys))
+        return {key: (value, updated_at) for key, value, updated_at in rows}
+
+    def clear(self):
+        self._conn().execute('DELETE FROM cache_entry')
+
+    def __len__(self):
+        return self._conn().execute('SELECT count(*) FROM cache_entry').fetchone()[0]
+
+
+class RedisBackend:
+    """Adapter for a redis-py compatible client.
+
+    Size bounds and LRU eviction are left to the server
+    (``maxmemory`` with ``maxmemory-policy allkeys-lru``).
+    """
+
+    tracks_generations = True
+
+    def __init__(self, client, prefix='hms:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key):
+        pipe = self.client.pipeline()
+        pipe.incr(self.prefix + 'counter:' + key)
+        pipe.set(self.prefix + 'counter_at:' + key, repr(time.time()))
+        return pipe.execute()[0]
+
+    def get_counters(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        names = [self.prefix + 'counter:' + k for k in keys] + [self.prefix + 'counter_at:' + k for k in keys]
+        values = self.client.mget(names)
+        counters = {}
+        for i, key in enumerate(keys):
+            if values[i] is not None:
+                updated_at = values[len(keys) + i]
+                counters[key] = (int(values[i]), float(updated_at) if updated_at is not None else None)
+        return counters
+
+    def clear(self):
+        for name in self.client.scan_iter(self.prefix + '*'):
+            if not name.decode().startswith(self.prefix + 'counter'):
+                self.client.delete(name)
+
+
+class NullBackend:
+    """Caches nothing, but keeps real generation counters for this process.
+
+    The per-process caches (identities, the food catalog, the social graph)
+    reload when a generation moves, so the counters must still count even
+    though no entry is ever stored.  They are not shared with other
+    processes, so use this backend with a single worker only.
+    """
+
+    tracks_generations = False
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters.get(key, (0, None))[0] + 1
+            self._counters[key] = (value, time.time())
+        return value
+
+    def get_counters(self, keys):
+        with self._lock:
+            return {key: self._counters[key] for key in keys if key in self._counters}
+
+    def clear(self):
+        pass
+
+
+class Cache:
+    """Pickling front end over a backend, with per-process hit/miss counters."""
+
+    def __init__(self, app=None):
+        self._backend = None
+        self._factory = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'sqlite')
+        app.config.setdefault('CACHE_PATH', os.path.join(app.instance_path, 'cache.db'))
+        app.config.setdefault('CACHE_MAX_ENTRIES', 2048)
+        app.config.setdefault('CACHE_REDIS_URL', None)
+        config = app.config
+
+        def factory():
+            kind = config['CACHE_BACKEND']
+            if kind == 'sqlite':
+                return SQLiteBackend(config['CACHE_PATH'], config['CACHE_MAX_ENTRIES'])
+            if kind == 'redis':
+                import redis  # optional dependency, only needed for this backend
+                return RedisBackend(redis.Redis.from_url(config['CACHE_REDIS_URL']))
+            if kind == 'null':
+                return NullBackend()
+            raise ValueError(f'Unknown CACHE_BACKEND: {kind}')
+
+        self._factory = factory
+        self._backend = None
+        app.extensions['cache'] = self
+
+    @property
+    def backend(self):
+        # Created lazily so a preforking server never shares one across workers
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = self._factory()
+        return self._backend
+
+    def get(self, key):
+        data = self.backend.get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), ttl)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def get_or_set(self, key, factory, ttl=None):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value, ttl)
+        return value
+
+    def clear(self):
+        self.backend.clear()
+
+    # --- generation counters ---
+
+    @property
+    def tracks_generations(self):
+        """Whether a bump in one process is seen by every other process."""
+        return self.backend.tracks_generations
+
+    def generation(self, key):
+        counter = self.backend.get_counters([key]).get(key)
+        return counter[0] if counter else 0
+
+    def generations(self, keys):
+        counters = self.backend.get_counters(list(keys))
+        return {key: counters[key][0] if key in counters else 0 for key in keys}
+
+    def last_modified(self, key):
+        """Unix time of the last bump of ``key``, or None if it was never bumped."""
+        counter = self.backend.get_counters([key]).get(key)
+        return counter[1] if counter else None
+
+    def bump(self, key):
+        return self.backend.incr(key)
+
+    def user_generation(self, user_id):
+        return self.generation(f'user:{user_id}')
+
+    def bump_user(self, user_id):
+        """Call after committing any change to a user's records, goals or profile."""
+        return self.bump(f'user:{user_id}')
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,248 @@
+"""
+Chart rendering in a small pool of separate processes.
+
+pyplot keeps one global current figure per process, so two threads
+drawing at once corrupt each other's charts, and every web worker that
+draws carries matplotlib's memory.  Web workers therefore only compute the
+numbers; ``charts.render(name, data)`` sends them to a renderer process and
+returns the image as PNG (or SVG) bytes.
+
+The renderers draw with matplotlib's object-oriented ``Figure`` API, never
+pyplot, and keep one ``Figure`` per chart that is cleared and reused for
+the next render of that chart.  They run in a ``ProcessPoolExecutor`` of
+``CHART_WORKERS`` processes per web worker, started with ``spawn`` so they
+do not inherit the web worker's threads, and created on first use, after
+gunicorn has forked.  ``CHART_WORKERS = 0`` draws in the calling process
+instead, one chart at a time.
+
+A render that fails raises ``ChartUnavailable``.  So does one that has
+been drawing for longer than ``CHART_TIMEOUT`` seconds; the renderers note
+in shared memory which chart they are drawing since when, and only such a
+stuck pool is replaced.  A chart still queued after
+``CHART_QUEUE_TIMEOUT`` seconds is cancelled on its own, leaving the pool
+and every other chart alone.
+
+``/metrics`` shows render time per chart, time from submission to result,
+failures, and the number of charts queued or rendering
+(``hms_chart_queue_depth``, summed over web workers).
+
+Charts are registered with ``@chart(name)`` on a function that draws
+``data`` (plain lists or NumPy arrays) on an empty ``Figure``.
+"""
+import io
+import logging
+import os
+import threading
+import time
+from itertools import count
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+FORMATS = ('png', 'svg')
+FIGURE_SIZE = (10, 6) # inches
+RENDER_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+POLL_INTERVAL = 1 # seconds between checks on a chart that is not done yet
+
+logger = logging.getLogger(__name__)
+
+CHARTS = {}
+
+
+class ChartUnavailable(Exception):
+    """The chart could not be rendered in time."""
+
+
+def chart(name):
+    def register(draw):
+        CHARTS[name] = draw
+        return draw
+    return register
+
+
+@chart('sleep_prediction')
+def _draw_sleep_prediction(figure, data):
+    ax = figure.add_subplot()
+    ax.scatter(data['dates'], data['durations'], color='blue', label='实际睡眠时长')
+    ax.plot(data['trend_dates'], data['trend'], color='red', label='趋势线')
+    ax.scatter(data['future_dates'], data['future'], color='green', label='预测睡眠时长')
+    ax.set_xlabel('日期')
+    ax.set_ylabel('睡眠时长 (小时)')
+    ax.set_title('睡眠时长趋势与预测')
+    ax.legend()
+    ax.grid(True)
+    ax.tick_params(axis='x', labelrotation=45)
+
+
+@chart('exercise_sleep_correlation')
+def _draw_exercise_sleep_correlation(figure, data):
+    ax = figure.add_subplot()
+    ax.scatter(data['exercise'], data['sleep'])
+    ax.plot(data['exercise'], data['fit'], color='red')
+    ax.set_xlabel('运动时长 (分钟)')
+    ax.set_ylabel('睡眠时长 (小时)')
+    ax.set_title('运动时长与睡眠质量相关性分析')
+    ax.grid(True)
+
+
+# --- in the renderer process ---
+
+_figures = {} # chart name -> Figure, cleared and reused
+_drawing = None # shared with the web worker: (task id, start time) per renderer
+_slot = None # this renderer's pair in _drawing
+
+
+def _init_renderer(drawing=None, slots=None):
+    global _drawing, _slot
+    import matplotlib
+    matplotlib.rcParams['font.sans-serif'] = ['SimHei']
+    matplotlib.rcParams['axes.unicode_minus'] = False
+    if drawing is not None:
+        with slots.get_lock():
+            _slot = slots.value
+            slots.value += 1
+        _drawing = drawing
+
+
+def _render(name, data, format, task=None):
+    """Draw one chart in a renderer; returns ``(image bytes, seconds spent)``."""
+    if task is not None and _drawing is not None:
+        # Start time first: a reader that sees the task id also sees when it started
+        _drawing[2 * _slot + 1] = time.time()
+        _drawing[2 * _slot] = task
+    try:
+        return _draw(name, data, format)
+    finally:
+        if task is not None and _drawing is not None:
+            _drawing[2 * _slot] = 0
+
+
+def _draw(name, data, format):
+    """Draw one chart; returns ``(image bytes, seconds spent)``."""
+    from matplotlib.figure import Figure
+    started = time.perf_counter()
+    figure = _figures.get(name)
+    if figure is None:
+        figure = _figures[name] = Figure(figsize=FIGURE_SIZE)
+    else:
+        figure.clear()
+    CHARTS[name](figure, data)
+    figure.tight_layout()
+    image = io.BytesIO()
+    figure.savefig(image, format=format)
+    return image.getvalue(), time.perf_counter() - started
+
+
+# --- in the web worker ---
+
+class ChartRenderer:
+
+    def __init__(self):
+        self._pool = None
+        self._pool_pid = None
+        self._drawing = None
+        self._tasks = count(1)
+        self._lock = threading.Lock()
+        self._inline_lock = threading.Lock()
+        self._inline_ready = False
+        self.pending = 0 # submitted and not finished, in this process
+
+    def init_app(self, app):
+        app.config.setdefault('CHART_WORKERS', 2)
+        app.config.setdefault('CHART_TIMEOUT', 30) # seconds of drawing
+        app.config.setdefault('CHART_QUEUE_TIMEOUT', 30) # seconds of waiting for a free renderer
+        self.workers = app.config['CHART_WORKERS']
+        self.timeout = app.config['CHART_TIMEOUT']
+        self.queue_timeout = app.config['CHART_QUEUE_TIMEOUT']
+        app.extensions['charts'] = self
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                # A forked worker cannot use its parent's pool; it starts its own
+                context = multiprocessing.get_context('spawn')
+                self._drawing = context.Array('d', 2 * self.workers, lock=False)
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_renderer,
+                                                 initargs=(self._drawing, context.Value('i', 0)))
+                self._pool_pid = os.getpid()
+            return self._pool, self._drawing
+
+    def _drawing_since(self, drawing, task):
+        """When a renderer started drawing ``task``, or None if none is drawing it."""
+        for slot in range(self.workers):
+            if drawing[2 * slot] == task:
+                started = drawing[2 * slot + 1]
+                return started if drawing[2 * slot] == task else None
+        return None
+
+    def _wait(self, pool, drawing, task, future, name):
+        queued = time.time()
+        while True:
+            try:
+                return future.result(timeout=POLL_INTERVAL)
+            except FutureTimeout:
+                pass
+            started = self._drawing_since(drawing, task)
+            if started is not None and time.time() - started > self.timeout:
+                # Stuck: it would hold up every later chart
+                self._reset_pool(pool)
+                raise ChartUnavailable(f'{name} took longer than {self.timeout}s')
+            if started is None and time.time() - queued > self.queue_timeout and future.cancel():
+                # Only a busy queue; the pool and the charts ahead of this one are fine
+                raise ChartUnavailable(f'{name} waited longer than {self.queue_timeout}s for a renderer')
+
+    def _reset_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        if hasattr(pool, 'terminate_workers'): # Python 3.14+
+            pool.terminate_workers()
+            return
+        processes = list((pool._processes or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def _render_inline(self, name, data, format):
+        with self._inline_lock:
+            if not self._inline_ready:
+                _init_renderer()
+                self._inline_ready = True
+            return _draw(name, data, format)
+
+    def render(self, name, data, format='png'):
+        """The chart ``name`` drawn from ``data``, as PNG or SVG bytes."""
+        from app import metrics
+        if name not in CHARTS:
+            raise KeyError(f'Unknown chart: {name}')
+        if format not in FORMATS:
+            raise ValueError(f'Unknown chart format: {format}')
+        labels = (('chart', name),)
+        started = time.perf_counter()
+        with self._lock:
+            self.pending += 1
+        try:
+            if not self.workers:
+                image, seconds = self._render_inline(name, data, format)
+            else:
+                pool, drawing = self._get_pool()
+                task = next(self._tasks)
+                future = pool.submit(_render, name, data, format, task)
+                try:
+                    image, seconds = self._wait(pool, drawing, task, future, name)
+                except BrokenProcessPool:
+                    self._reset_pool(pool)
+                    raise ChartUnavailable(f'the renderer drawing {name} exited')
+        except ChartUnavailable:
+            metrics.registry.inc('hms_chart_errors_total', labels)
+            raise
+        except Exception as exc:
+            metrics.registry.inc('hms_chart_errors_total', labels)
+            raise ChartUnavailable(f'{name} failed: {exc}') from exc
+        finally:
+            with self._lock:
+                self.pending -= 1
+        metrics.registry.observe('hms_chart_render_duration_seconds', seconds, RENDER_BUCKETS, labels)
+        metrics.registry.observe('hms_chart_wait_duration_seconds', time.perf_counter() - started,
+                                 RENDER_BUCKETS, labels)
+        return image
@@ -0,0 +1,189 @@
+import csv
+
+import click
+
+from flask import Blueprint, current_app
+
+bp = Blueprint('cli', __name__, cli_group=None)
+
+
+@bp.cli.group()
+def foods():
+    """Manage the food catalog."""
+
+
+@foods.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--name-column', default='name', show_default=True)
+@click.option('--calories-column', default='calories_per_100g', show_default=True)
+@click.option('--batch-size', default=5000, show_default=True)
+def import_foods_command(path, name_column, calories_column, batch_size):
+    """Bulk import a nutrition database CSV into FoodItem."""
+    from app.foods import import_foods
+
+    def rows():
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                try:
+                    yield row[name_column], float(row[calories_column])
+                except (KeyError, TypeError, ValueError):
+                    continue
+
+    written = import_foods(rows(), batch_size=batch_size)
+    click.echo(f'Imported {written} foods.')
+
+
+@foods.command('seed')
+def seed_foods_command():
+    """Load the built-in reference foods into FoodItem."""
+    from app.foods import import_foods, DEFAULT_FOODS
+    written = import_foods(DEFAULT_FOODS.items())
+    click.echo(f'Imported {written} foods.')
+
+
+@bp.cli.group()
+def feed():
+    """Manage friend activity timelines."""
+
+
+@feed.command('trim')
+@click.option('--max-entries', type=int, default=None, help='Defaults to FEED_MAX_ENTRIES.')
+def trim_feed_command(max_entries):
+    """Drop the oldest entries beyond the per-timeline bound."""
+    from app.feed import trim_timelines
+    deleted = trim_timelines(max_entries)
+    click.echo(f'Deleted {deleted} feed entries.')
+
+
+@bp.cli.group('history')
+def history_group():
+    """Manage the per-user history arrays used by the report (see app/history.py)."""
+
+
+@history_group.command('rebuild')
+@click.option('--user-id', type=int, multiple=True, help='Only these users; by default all of them.')
+def rebuild_history_command(user_id):
+    """Rebuild users' history arrays from their records."""
+    from app.history import rebuild
+    rebuilt = rebuild(list(user_id) or None)
+    click.echo(f'Rebuilt the history of {rebuilt} users.')
+
+
+@bp.cli.group('scheduler')
+def scheduler_group():
+    """Run periodic jobs (see app/scheduler.py)."""
+
+
+@scheduler_group.command('run')
+def scheduler_run_command():
+    """Run due jobs until interrupted."""
+    from app.jobs import scheduler
+    click.echo(f"Scheduler running {', '.join(sorted(scheduler.jobs))}; Ctrl+C to stop.")
+    try:
+        scheduler.run_forever(current_app._get_current_object())
+    except KeyboardInterrupt:
+        pass
+
+
+@scheduler_group.command('tick')
+def scheduler_tick_command():
+    """Run the jobs that are due now, once (e.g. from system cron)."""
+    from app.jobs import scheduler
+    for name, status in scheduler.run_pending().items():
+        click.echo(f'{name}: {status}')
+
+
+@scheduler_group.command('run-job')
+@click.argument('name')
+def scheduler_run_job_command(name):
+    """Run one job now, whether it is due or not."""
+    from app.jobs import scheduler
+    if name not in scheduler.jobs:
+        raise click.BadParameter(f"choose from {', '.join(sorted(scheduler.jobs))}", param_hint='NAME')
+    scheduler.sync()
+    status = scheduler.run(name, force=True)
+    click.echo(f'{name}: {status or "locked by another runner"}')
+
+
+@scheduler_group.command('status')
+def scheduler_status_command():
+    """Show the schedule and last run of every job."""
+    from app.jobs import scheduler
+    from app.models import ScheduledJob
+    scheduler.sync()
+    for job in ScheduledJob.query.order_by(ScheduledJob.name):
+        last = '-'
+        if job.last_started_at:
+            duration = f'{job.last_duration:.2f}s' if job.last_duration is not None else 'running'
+            last = f"{job.last_started_at:%Y-%m-%d %H:%M:%S} {job.last_status or 'running'} {duration}"
+        click.echo(f'{job.name:<20} {job.schedule:<14} next {job.next_run_at:%Y-%m-%d %H:%M}  last {last}'
+                   f'{"  locked by " + job.locked_by if job.locked_by else ""}'
+                   f'{f"  ({job.failure_count} failures in a row)" if job.failure_count else ""}'
+                   f'{"  resumable" if job.state else ""}')
+        if job.last_status == 'failed' and job.last_error:
+            click.echo(f'    {job.last_error.strip().splitlines()[-1]}')
+
+
+@bp.cli.command('check-query-budgets')
+def check_query_budgets_command():
+    """Count the SQL statements of every page for users of several data sizes."""
+    from app.querybudget import check_routes, ROUTE_BUDGETS, RECORD_COUNTS, FRIEND_COUNTS
+    counts, failures = check_routes(echo=click.echo)
+    shapes = [(records, friends) for friends in FRIEND_COUNTS for records in RECORD_COUNTS]
+    click.echo(f"{'route':<22}" + ''.join(f'{f"{r}r/{f}f":>11}' for r, f in shapes) + f"{'budget':>8}")
+    for endpoint, budget in ROUTE_BUDGETS.items():
+        click.echo(f'{endpoint:<22}' + ''.join(f'{counts[endpoint][shape]:>11}' for shape in shapes)
+                   + f'{budget:>8}')
+    for failure in failures:
+        click.echo(f'\nFAIL {failure}', err=True)
+    if failures:
+        raise SystemExit(1)
+    click.echo('All routes within budget.')
+
+
+@bp.cli.command('generate-data')
+@click.option('--users', default=100, show_default=True)
+@click.option('--years', default=1.0, show_default=True, help='Length of each user\'s history.')
+@click.option('--friends', default=10, show_default=True, help='Average friends per user.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--password', default='password', show_default=True)
+@click.option('--batch-size', default=5000, show_default=True)
+def generate_data_command(users, years, friends, seed, password, batch_size):
+    """Fill the database with synthetic users and their history."""
+    import time
+    from app.datagen import generate
+    started = time.monotonic()
+    written = generate(users=users, years=years, friends=friends, seed=seed, password=password,
+                       batch_size=batch_size, echo=click.echo)
+    click.echo(', '.join(f'{count} {table}' for table, count in written.items())
+               + f' in {time.monotonic() - started:.1f}s.')
+
+
+@bp.cli.command('slow-queries')
+@click.option('--hours', default=24, show_default=True, help='Only statements logged in this many hours.')
+@click.option('--limit', default=20, show_default=True)
+@click.option('--plans/--no-plans', default=True, show_default=True, help='Show each statement\'s query plan.')
+@click.option('--endpoint', help='Only statements run by this endpoint.')
+def slow_queries_command(hours, limit, plans, endpoint):
+    """Summarize the slow-query log by statement, the most total time first."""
+    from datetime import datetime, timedelta
+    from app.slowlog import read_entries, aggregate
+    entries = read_entries(current_app.config['SLOW_QUERY_LOG'], since=datetime.utcnow() - timedelta(hours=hours))
+    if endpoint:
+        entries = [entry for entry in entries if entry['endpoint'] == endpoint]
+    groups = aggregate(entries)
+    if not groups:
+        click.echo(f'No statements slower than {current_app.config["SLOW_QUERY_THRESHOLD"]}s '
+                   f'in the last {hours} hours.')
+        return
+    for group in groups[:limit]:
+        click.echo(f"{group['count']:>6}x  p50 {group['p50'] * 1000:.1f}ms  p95 {group['p95'] * 1000:.1f}ms  "
+                   f"max {group['max'] * 1000:.1f}ms  last {group['last_seen']}"
+                   f"{'  FULL SCAN' if group['full_scan'] else ''}")
+        click.echo(f"    {group['statement']}")
+        click.echo('    from ' + ', '.join(f'{name} ({count})' for name, count in group['endpoints']))
+        if plans and group['plan']:
+            for line in group['plan']:
+                click.echo(f'      {line}')
+    if len(groups) > limit:
+        click.echo(f'... and {len(groups) - limit} more statements.')
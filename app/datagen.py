@@ -0,0 +1,224 @@
+"""
+Synthetic data at production scale, for local profiling and benchmarks.
+
+``generate`` writes users with years of sleep, exercise and diet history,
+goals and friendships straight into the tables with bulk inserts.  It also
+fills everything the routes would have maintained along the way:
+``DailyActivity`` rollups, ``UserHistory`` arrays, username trigrams and
+the last week of feed entries.
+
+Each user gets a few habits of their own: a usual bedtime and sleep
+length, how often they exercise and what they like to do, and how many
+meals they log.  The day-to-day values scatter around those habits, and
+some nights and meals go unrecorded.  The same ``seed`` always produces the
+same data.  Every user's password is ``password`` unless another is given.
+
+Rows get explicit ids above the current maximum, so run this while nothing
+else writes to the database.
+"""
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta, time as clock
+
+from flask import current_app
+from sqlalchemy import func, insert
+from werkzeug.security import generate_password_hash
+
+from app import db, cache
+from app.foods import DEFAULT_FOODS
+from app.models import (User, Goal, ExerciseGoal, SleepRecord, ExerciseRecord, DietRecord, Friendship,
+                        DailyActivity, FeedEntry, UsernameTrigram, UserHistory)
+from app import feed, history, social, user_search
+
+# MET values, as in the exercise route
+EXERCISES = {'跑步': 7.0, '游泳': 8.0, '瑜伽': 2.5, '骑行': 6.8}
+DURATIONS = (15, 30, 45, 60, 90)
+PORTIONS = (50, 100, 150, 200)
+# Meal type, hour and the chance a user who logs meals records it on a given day
+MEALS = (('早餐', 8, 0.7), ('午餐', 12, 0.9), ('晚餐', 19, 0.9), ('加餐', 16, 0.25))
+FEED_DAYS = 7
+USERS_PER_COMMIT = 20 # bounds the history held in memory
+
+
+class _Ids:
+    """Hands out primary keys above what the tables already hold."""
+
+    def __init__(self, *models):
+        self._next = {model: (db.session.query(func.max(model.id)).scalar() or 0) + 1 for model in models}
+
+    def __call__(self, model):
+        value = self._next[model]
+        self._next[model] += 1
+        return value
+
+
+def _insert(model, rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(insert(model), rows[start:start + batch_size])
+
+
+def _profile(rng, user_id):
+    gender = rng.choice(('男', '女'))
+    height = round(rng.gauss(172 if gender == '男' else 160, 7), 1)
+    weight = round(rng.gauss(68 if gender == '男' else 55, 9), 1)
+    return {
+        'id': user_id, 'username': f'gen{user_id}', 'email': f'gen{user_id}@example.com',
+        'gender': gender, 'age': rng.randint(18, 65), 'height': height, 'weight': weight,
+        'bmi': round(weight / (height / 100) ** 2, 2),
+    }
+
+
+def _habits(rng):
+    favourites = rng.sample(list(EXERCISES), rng.randint(1, 3))
+    return {
+        'bedtime': rng.gauss(23.2, 0.8), # hours after midnight of the evening's day
+        'sleep_hours': min(max(rng.gauss(7.2, 0.7), 5), 9.5),
+        'sleep_logged': rng.uniform(0.7, 0.98),
+        'exercise_chance': rng.uniform(0.05, 0.7),
+        'favourites': favourites,
+        'meals_logged': rng.uniform(0.3, 1.0),
+    }
+
+
+def _history(rng, user, habits, ids, first_day, now, records):
+    """Append one user's records to ``records`` and return their DailyActivity rows."""
+    activity = defaultdict(lambda: [0.0, 0.0, 0.0])
+    day = first_day
+    while day <= now.date():
+        if rng.random() < habits['sleep_logged']:
+            sleep_time = datetime.combine(day - timedelta(days=1), clock()) \
+                + timedelta(hours=rng.gauss(habits['bedtime'], 0.6))
+            duration = round(min(max(rng.gauss(habits['sleep_hours'], 0.9), 3), 12), 2)
+            wakeup_time = sleep_time + timedelta(hours=duration)
+            if wakeup_time <= now:
+                records[SleepRecord].append({'id': ids(SleepRecord), 'user_id': user['id'], 'duration': duration,
+                                             'sleep_time': sleep_time, 'wakeup_time': wakeup_time})
+                activity[wakeup_time.date()][2] += duration
+
+        if rng.random() < habits['exercise_chance']:
+            kind = rng.choice(habits['favourites'])
+            duration = rng.choice(DURATIONS)
+            calories = round(duration * EXERCISES[kind] * 3.5 * user['weight'] / 200, 1)
+            # The exercise form records the date only
+            records[ExerciseRecord].append({'id': ids(ExerciseRecord), 'user_id': user['id'],
+                                            'exercise_type': kind, 'duration': duration,
+                                            'calories_burned': calories,
+                                            'timestamp': datetime.combine(day, clock())})
+            activity[day][0] += duration
+            activity[day][1] += calories
+
+        for meal, hour, chance in MEALS:
+            timestamp = datetime.combine(day, clock(hour)) + timedelta(minutes=rng.randint(-40, 40))
+            if rng.random() < chance * habits['meals_logged'] and timestamp <= now:
+                food = rng.choice(list(DEFAULT_FOODS))
+                portion = rng.choice(PORTIONS)
+                records[DietRecord].append({'id': ids(DietRecord), 'user_id': user['id'], 'food_name': food,
+                                            'portion': portion, 'meal_type': meal, 'timestamp': timestamp,
+                                            'calories': portion / 100 * DEFAULT_FOODS[food]})
+        day += timedelta(days=1)
+    return [{'user_id': user['id'], 'day': day, 'exercise_minutes': minutes, 'calories_burned': calories,
+             'sleep_hours': hours} for day, (minutes, calories, hours) in activity.items()]
+
+
+def _goals(rng, user_id):
+    goals, exercise_goals = [], []
+    if rng.random() < 0.7:
+        goals.append({'user_id': user_id, 'target_sleep_hours': rng.choice((7, 7.5, 8)),
+                      'target_calorie_intake': rng.randrange(1600, 2600, 100)})
+    if rng.random() < 0.5:
+        exercise_goals.append({'user_id': user_id, 'goal_type': 'duration', 'time_period': 'weekly',
+                               'target_value': rng.choice((90, 150, 200))})
+    if rng.random() < 0.3:
+        exercise_goals.append({'user_id': user_id, 'goal_type': 'frequency', 'time_period': 'weekly',
+                               'exercise_type': rng.choice(list(EXERCISES)), 'target_value': rng.randint(2, 5)})
+    return goals, exercise_goals
+
+
+def _feed_rows(recent, friends, fanout_limit):
+    """Feed entries for ``recent`` ``(model, row)`` pairs, as ``feed.publish`` would have written them."""
+    rows = []
+    for model, row in recent:
+        kind, summary = feed._describe(model(**row))
+        actor_id = row['user_id']
+        owners = [actor_id]
+        pulled = len(friends[actor_id]) > fanout_limit
+        if not pulled:
+            owners.extend(friends[actor_id])
+        created_at = row.get('wakeup_time') or row['timestamp']
+        rows.extend({'owner_id': owner_id, 'actor_id': actor_id, 'kind': kind, 'record_id': row['id'],
+                     'summary': summary, 'created_at': created_at, 'pulled': pulled and owner_id == actor_id}
+                    for owner_id in owners)
+    rows.sort(key=lambda entry: entry['created_at'])  # ids follow time, as they would have
+    return rows
+
+
+def generate(users=100, years=1.0, friends=10, seed=0, password='password', batch_size=5000, echo=None):
+    """Insert ``users`` users with ``years`` of history and about ``friends`` friends each.
+
+    Returns the number of rows written per table name.
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    first_day = (now - timedelta(days=round(365 * years))).date()
+    ids = _Ids(User, SleepRecord, ExerciseRecord, DietRecord)
+    password_hash = generate_password_hash(password) # one hash for all, hashing is slow on purpose
+    written = defaultdict(int)
+    user_ids = []
+    recent = []
+    recent_since = now - timedelta(days=FEED_DAYS)
+
+    chunk = USERS_PER_COMMIT
+    for start in range(0, users, chunk):
+        rows = {model: [] for model in (User, Goal, ExerciseGoal, SleepRecord, ExerciseRecord, DietRecord,
+                                        DailyActivity, UserHistory, UsernameTrigram)}
+        for _ in range(min(chunk, users - start)):
+            user = dict(_profile(rng, ids(User)), password_hash=password_hash)
+            user_ids.append(user['id'])
+            rows[User].append(user)
+            rows[UsernameTrigram].extend({'trigram': trigram, 'user_id': user['id']}
+                                         for trigram in user_search.trigrams(user['username']))
+            goals, exercise_goals = _goals(rng, user['id'])
+            rows[Goal].extend(goals)
+            rows[ExerciseGoal].extend(exercise_goals)
+            sleep_start, exercise_start = len(rows[SleepRecord]), len(rows[ExerciseRecord])
+            rows[DailyActivity].extend(_history(rng, user, _habits(rng), ids, first_day, now, rows))
+            rows[UserHistory].append({
+                'user_id': user['id'],
+                'sleep': history.sleep_array([(row['sleep_time'], row['duration'])
+                                              for row in rows[SleepRecord][sleep_start:]]).tobytes(),
+                'exercise': history.exercise_array([(row['timestamp'], row['duration'], row['calories_burned'])
+                                                    for row in rows[ExerciseRecord][exercise_start:]]).tobytes(),
+            })
+        for model in (SleepRecord, ExerciseRecord, DietRecord):
+            recent.extend((model, row) for row in rows[model]
+                          if (row.get('wakeup_time') or row['timestamp']) >= recent_since)
+        for model, model_rows in rows.items():
+            _insert(model, model_rows, batch_size)
+            written[model.__tablename__] += len(model_rows)
+        db.session.commit()
+        if echo and (len(user_ids) % (chunk * 10) == 0 or len(user_ids) == users):
+            echo(f'{len(user_ids)}/{users} users')
+
+    # Each user picks half their friends; the other half comes from others picking them
+    pairs = set()
+    for user_id in user_ids:
+        picks = friends // 2 + (rng.random() < friends % 2 / 2)
+        for _ in range(picks if len(user_ids) > 1 else 0):
+            other_id = rng.choice(user_ids)
+            if other_id != user_id:
+                pairs.add((min(user_id, other_id), max(user_id, other_id)))
+    _insert(Friendship, [{'user_id': low, 'friend_id': high} for low, high in sorted(pairs)], batch_size)
+    written[Friendship.__tablename__] = len(pairs)
+
+    friend_ids = defaultdict(set)
+    for low, high in pairs:
+        friend_ids[low].add(high)
+        friend_ids[high].add(low)
+    entries = _feed_rows(recent, friend_ids, current_app.config['FEED_FANOUT_LIMIT'])
+    _insert(FeedEntry, entries, batch_size)
+    written[FeedEntry.__tablename__] = len(entries)
+    db.session.commit()
+
+    cache.bump(social.GENERATION_KEY)
+    cache.bump(user_search.GENERATION_KEY)
+    return dict(written)
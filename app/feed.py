@@ -0,0 +1,90 @@
+"""
+Friend activity feed.
+
+Writes fan out: when a user logs a record, one ``FeedEntry`` is inserted
+into each friend's timeline, so reading a feed is a single range scan over
+the ``(owner_id, id)`` index.  Users with more than ``FEED_FANOUT_LIMIT``
+friends only write to their own outbox (``owner_id == actor_id``), marking
+the entry ``pulled``, and their friends pull it from there at read time.
+The path is fixed when the entry is written, so a friend whose friend
+count crosses the limit later is neither shown twice nor lost.
+
+Timelines are bounded by ``trim_timelines``, run from ``flask feed trim``.
+"""
+from flask import current_app
+from sqlalchemy import and_, insert, or_, text
+
+from app import db
+from app.models import FeedEntry, SleepRecord, ExerciseRecord, DietRecord, User
+from app.social import social_graph
+
+
+def _describe(record):
+    if isinstance(record, SleepRecord):
+        return 'sleep', f'记录了 {record.duration:.1f} 小时睡眠（{record.wakeup_time.strftime("%m-%d")} 醒来）'
+    if isinstance(record, ExerciseRecord):
+        return 'exercise', f'完成了 {record.duration:g} 分钟{record.exercise_type}，消耗 {record.calories_burned:.0f} 大卡'
+    if isinstance(record, DietRecord):
+        return 'diet', f'{record.meal_type}吃了{record.food_name}（{record.calories:.0f} 大卡）'
+    raise TypeError(f'Not a feed record: {record!r}')
+
+
+def _fans_out(user_id):
+    return len(social_graph.friend_ids(user_id)) <= current_app.config['FEED_FANOUT_LIMIT']
+
+
+def publish(record):
+    """Add ``record`` to its author's outbox and, for most users, to every friend's timeline.
+
+    Call before committing the record so the entries are written with it.
+    """
+    if record.id is None:
+        db.session.flush()
+    kind, summary = _describe(record)
+    actor_id = record.user_id
+    owners = [actor_id]
+    pulled = not _fans_out(actor_id)
+    if not pulled:
+        owners.extend(social_graph.friend_ids(actor_id))
+    db.session.execute(insert(FeedEntry), [
+        {'owner_id': owner_id, 'actor_id': actor_id, 'kind': kind,
+         'record_id': record.id, 'summary': summary, 'pulled': pulled and owner_id == actor_id}
+        for owner_id in owners
+    ])
+
+
+def unpublish(record):
+    kind, _ = _describe(record)
+    FeedEntry.query.filter_by(kind=kind, record_id=record.id).delete(synchronize_session=False)
+
+
+def timeline(user_id, cursor=None, limit=20):
+    """Newest entries from the user's friends, older than ``cursor`` if given.
+
+    Returns ``(rows, next_cursor)`` where each row is ``(FeedEntry, actor_username)``.
+    """
+    friend_ids = social_graph.friend_ids(user_id)
+    condition = and_(FeedEntry.owner_id == user_id, FeedEntry.actor_id != user_id)
+    if friend_ids:
+        # Fan-out-on-read for the friends' entries that were not copied to our timeline
+        condition = or_(condition, and_(FeedEntry.owner_id.in_(friend_ids), FeedEntry.pulled == True))
+    query = db.session.query(FeedEntry, User.username).join(User, User.id == FeedEntry.actor_id).filter(condition)
+    if cursor:
+        query = query.filter(FeedEntry.id < cursor)
+    rows = query.order_by(FeedEntry.id.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1][0].id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def trim_timelines(max_entries=None):
+    """Keep only the newest ``max_entries`` entries per timeline. Returns rows deleted."""
+    max_entries = max_entries or current_app.config['FEED_MAX_ENTRIES']
+    result = db.session.execute(text('''
+        DELETE FROM feed_entry WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY owner_id ORDER BY id DESC) AS position
+                FROM feed_entry
+            ) WHERE position > :max_entries
+        )'''), {'max_entries': max_entries})
+    db.session.commit()
+    return result.rowcount
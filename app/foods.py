@@ -0,0 +1,192 @@
+"""
+In-memory food catalog backed by the ``FoodItem`` table.
+
+The whole table is read once per worker into a sorted array of search keys
+(name, and pinyin when ``pypinyin`` is installed) for prefix lookups, plus a
+character bigram index for typo-tolerant matching.  Bigram matches are
+scored with NumPy (one ``bincount`` over the query's postings and a partial
+sort for the best few), which keeps a fuzzy lookup in a 100k-food catalog
+well under a millisecond.  The catalog reloads
+itself when the shared ``foods`` generation changes, which every bulk
+import bumps.
+"""
+import threading
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+import numpy as np
+
+from app import db, cache
+
+try:
+    from pypinyin import lazy_pinyin, Style
+except ImportError:  # pinyin matching is optional
+    lazy_pinyin = None
+
+# Calorie reference values per 100g, used to seed the catalog and as a
+# fallback while the FoodItem table is empty
+DEFAULT_FOODS = {
+    '米饭': 130, '馒头': 223, '鸡胸肉': 165, '牛肉': 250,
+    '鸡蛋': 155, '牛奶': 54, '苹果': 52, '香蕉': 89,
+    '西兰花': 55, '胡萝卜': 41
+}
+
+GENERATION_KEY = 'foods'
+
+
+def _search_keys(name):
+    keys = {name.lower()}
+    if lazy_pinyin is not None:
+        syllables = lazy_pinyin(name)
+        keys.add(''.join(syllables).lower())
+        keys.add(''.join(lazy_pinyin(name, style=Style.FIRST_LETTER)).lower())
+    return keys
+
+
+def _bigrams(text):
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class FoodCatalog:
+    # Bigrams shared by more foods than this carry little signal and are
+    # skipped, which keeps fuzzy lookups bounded on very large catalogs
+    MAX_POSTINGS = 5000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._names = []
+        self._calories = array('f')
+        self._by_name = {}
+        self._keys = []
+        self._key_ids = array('I')
+        self._bigrams = {}
+        self._name_lengths = np.empty(0, dtype=np.int64)
+
+    def preload(self):
+        """Load the catalog now instead of on the first lookup."""
+        self._ensure_loaded()
+
+    def _ensure_loaded(self):
+        generation = cache.generation(GENERATION_KEY)
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    self._load(generation)
+
+    def _load(self, generation):
+        from app.models import FoodItem
+        rows = db.session.query(FoodItem.name, FoodItem.calories_per_100g).order_by(FoodItem.name).all()
+        names = [name for name, _ in rows]
+        calories = array('f', (kcal for _, kcal in rows))
+
+        keyed = []
+        postings = defaultdict(list)
+        for i, name in enumerate(names):
+            for key in _search_keys(name):
+                keyed.append((key, i))
+                for gram in _bigrams(key):
+                    postings[gram].append(i)
+        keyed.sort()
+
+        self._names = names
+        self._calories = calories
+        self._by_name = {name: i for i, name in enumerate(names)}
+        self._keys = [key for key, _ in keyed]
+        self._key_ids = array('I', (i for _, i in keyed))
+        self._bigrams = {gram: np.unique(np.array(ids, dtype=np.int32)) for gram, ids in postings.items()}
+        self._name_lengths = np.array([len(name) for name in names], dtype=np.int64)
+        self._generation = generation
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._names)
+
+    def calories_per_100g(self, name):
+        """Calories per 100g of ``name``, falling back to DEFAULT_FOODS, or None if unknown."""
+        self._ensure_loaded()
+        i = self._by_name.get(name)
+        if i is None:
+            return DEFAULT_FOODS.get(name)
+        return float(self._calories[i])
+
+    def search(self, query, limit=10):
+        """Prefix matches first, then foods sharing most bigrams with ``query``."""
+        self._ensure_loaded()
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        found = []
+        seen = set()
+        pos = bisect_left(self._keys, query)
+        while pos < len(self._keys) and len(found) < limit and self._keys[pos].startswith(query):
+            i = self._key_ids[pos]
+            if i not in seen:
+                seen.add(i)
+                found.append(i)
+            pos += 1
+
+        if len(found) < limit:
+            found.extend(self._fuzzy(query, limit - len(found), seen))
+
+        return [{'name': self._names[i], 'calories_per_100g': round(float(self._calories[i]), 1)} for i in found]
+
+    def _fuzzy(self, query, wanted, seen):
+        """Up to ``wanted`` foods sharing at least half of the query's bigrams.
+
+        Ranked by shared bigrams, then shorter name, then name.
+        """
+        grams = _bigrams(query)
+        postings = [ids for ids in map(self._bigrams.get, grams) if ids is not None and len(ids) <= self.MAX_POSTINGS]
+        threshold = max(1, (len(grams) + 1) // 2)
+        if len(postings) < threshold:
+            return []
+        scores = np.bincount(np.concatenate(postings), minlength=len(self._names))
+        candidates = np.flatnonzero(scores >= threshold)
+        if seen:
+            candidates = candidates[~np.isin(candidates, list(seen))]
+        if not len(candidates):
+            return []
+        # One sortable key per candidate: fewer missing bigrams, then name length, then id
+        keys = ((len(grams) - scores[candidates]) << 48) | (self._name_lengths[candidates] << 32) | candidates
+        if len(keys) > wanted:
+            keys = np.partition(keys, wanted - 1)[:wanted]
+        keys.sort()
+        return (keys & 0xFFFFFFFF).tolist()
+
+
+food_catalog = FoodCatalog()
+
+
+def import_foods(rows, batch_size=5000):
+    """Insert or update ``(name, calories_per_100g)`` rows in batches.
+
+    Returns the number of rows written.
+    """
+    from sqlalchemy.dialects.sqlite import insert
+    from app.models import FoodItem
+
+    stmt = insert(FoodItem)
+    stmt = stmt.on_conflict_do_update(index_elements=['name'],
+                                      set_={'calories_per_100g': stmt.excluded.calories_per_100g})
+    written = 0
+    batch = {}
+    for name, calories in rows:
+        name = name.strip()
+        if not name:
+            continue
+        batch[name] = float(calories)
+        if len(batch) >= batch_size:
+            db.session.execute(stmt, [{'name': n, 'calories_per_100g': c} for n, c in batch.items()])
+            written += len(batch)
+            batch = {}
+    if batch:
+        db.session.execute(stmt, [{'name': n, 'calories_per_100g': c} for n, c in batch.items()])
+        written += len(batch)
+    db.session.commit()
+    cache.bump(GENERATION_KEY)
+    return written
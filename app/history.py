@@ -0,0 +1,121 @@
+"""
+Columnar per-user history for app/analysis.py.
+
+Each user's sleep and exercise records are kept in one ``UserHistory``
+row as two BLOBs of packed NumPy structured arrays:
+
+* ``sleep``: ``day`` (days since 1970-01-01 of the sleep time) and ``hours``;
+* ``exercise``: ``day``, ``minutes`` and ``calories``.
+
+``load`` reads both with one query and hands them out as read-only arrays
+over the fetched bytes, without building a record object per row.
+
+The record routes call ``track_record`` next to the leaderboard's, inside
+the same transaction as the record itself.  A new record is appended with
+``sleep = CAST(sleep || ? AS BLOB)``, so adding one does not read or
+rewrite the rest.  A deleted record drops the row instead.  Users without
+a row (after a delete, or registered before this table) are built from a
+narrow column query: on read it is only returned, and on the next write it
+is stored.  ``flask history rebuild`` builds every user's row up front.
+"""
+from datetime import date
+
+import numpy as np
+from sqlalchemy import select, update, delete, cast, LargeBinary
+from sqlalchemy.dialects.sqlite import insert
+
+from app import db
+from app.models import SleepRecord, ExerciseRecord, UserHistory
+
+SLEEP_DTYPE = np.dtype([('day', '<i4'), ('hours', '<f8')])
+EXERCISE_DTYPE = np.dtype([('day', '<i4'), ('minutes', '<f8'), ('calories', '<f8')])
+EPOCH = date(1970, 1, 1)
+_EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def day_index(moment):
+    return moment.toordinal() - _EPOCH_ORDINAL
+
+
+def day_date(index):
+    return date.fromordinal(int(index) + _EPOCH_ORDINAL)
+
+
+def sleep_array(rows):
+    """``(sleep_time, duration)`` pairs as a ``SLEEP_DTYPE`` array."""
+    return np.array([(day_index(sleep_time), duration or 0) for sleep_time, duration in rows], dtype=SLEEP_DTYPE)
+
+
+def exercise_array(rows):
+    """``(timestamp, duration, calories_burned)`` triples as an ``EXERCISE_DTYPE`` array."""
+    return np.array([(day_index(timestamp), duration or 0, calories or 0) for timestamp, duration, calories in rows],
+                    dtype=EXERCISE_DTYPE)
+
+
+def build(user_id):
+    """``(sleep, exercise)`` arrays read from the record tables."""
+    sleep = db.session.execute(select(SleepRecord.sleep_time, SleepRecord.duration)
+                               .where(SleepRecord.user_id == user_id)).all()
+    exercise = db.session.execute(select(ExerciseRecord.timestamp, ExerciseRecord.duration,
+                                         ExerciseRecord.calories_burned)
+                                  .where(ExerciseRecord.user_id == user_id)).all()
+    return sleep_array(sleep), exercise_array(exercise)
+
+
+def store(user_id, sleep, exercise):
+    stmt = insert(UserHistory).values(user_id=user_id, sleep=sleep.tobytes(), exercise=exercise.tobytes())
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id'], set_={'sleep': stmt.excluded.sleep, 'exercise': stmt.excluded.exercise}))
+
+
+def load(user_id):
+    """The user's ``(sleep, exercise)`` arrays, in the order the records were added."""
+    row = db.session.execute(select(UserHistory.sleep, UserHistory.exercise)
+                             .where(UserHistory.user_id == user_id)).first()
+    if row is None:
+        return build(user_id)
+    return np.frombuffer(row.sleep, dtype=SLEEP_DTYPE), np.frombuffer(row.exercise, dtype=EXERCISE_DTYPE)
+
+
+def add_user(user):
+    """Give a new user an empty history.  Call before committing the user."""
+    if user.id is None:
+        db.session.flush()
+    store(user.id, np.empty(0, SLEEP_DTYPE), np.empty(0, EXERCISE_DTYPE))
+
+
+def track_record(record, sign=1):
+    """Append (``sign=1``) a new record to its user's history, or drop the history (``sign=-1``).
+
+    Call before committing the record change so both are written together.
+    """
+    if isinstance(record, SleepRecord):
+        column, data = 'sleep', sleep_array([(record.sleep_time, record.duration)])
+    elif isinstance(record, ExerciseRecord):
+        column, data = 'exercise', exercise_array([(record.timestamp, record.duration, record.calories_burned)])
+    else:
+        return
+    user_id = record.user_id if record.user_id is not None else record.author.id
+    if sign < 0:
+        db.session.execute(delete(UserHistory).where(UserHistory.user_id == user_id)
+                           .execution_options(synchronize_session=False))
+        return
+    stored = getattr(UserHistory, column)
+    appended = db.session.execute(update(UserHistory).where(UserHistory.user_id == user_id)
+                                  .values({column: cast(stored.concat(data.tobytes()), LargeBinary)})
+                                  .execution_options(synchronize_session=False)).rowcount
+    if not appended:
+        # The build's queries flush the new record first, so it is included
+        store(user_id, *build(user_id))
+
+
+def rebuild(user_ids=None, batch_size=500):
+    """Rebuild the history of every user (or of ``user_ids``); returns the number rebuilt."""
+    from app.models import User
+    if user_ids is None:
+        user_ids = db.session.execute(select(User.id).order_by(User.id)).scalars().all()
+    for start in range(0, len(user_ids), batch_size):
+        for user_id in user_ids[start:start + batch_size]:
+            store(user_id, *build(user_id))
+        db.session.commit()
+    return len(user_ids)
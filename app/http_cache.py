@@ -0,0 +1,132 @@
+"""
+HTTP-level caching: conditional GETs, response compression and
+fingerprinted static URLs.
+
+``conditional`` answers ``304 Not Modified`` before a view runs when the
+browser already holds the current version of a page.  Page versions are
+derived from the user's data generation (see ``Cache.bump_user``), so a
+record list, dashboard or report is only rendered again after the user
+actually changed something.
+"""
+import gzip
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, request, session, make_response, url_for
+from flask_login import current_user
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+}
+
+_build_id = None
+_static_hashes = {}
+
+
+def _get_build_id():
+    # Changes whenever templates or code are redeployed, so old ETags stop matching
+    global _build_id
+    if _build_id is None:
+        root = current_app.root_path
+        latest = 0
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith(('.py', '.html', '.css', '.js')):
+                    latest = max(latest, os.path.getmtime(os.path.join(dirpath, filename)))
+        _build_id = format(int(latest), 'x')
+    return _build_id
+
+
+def conditional(view):
+    """Serve GET requests with a weak ETag and answer 304 when it still matches.
+
+    Only use it on pages that depend on nothing but the logged-in user's own
+    data and the current date.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Pending flash messages are part of the next page, so it must be rendered
+        if request.method != 'GET' or not current_user.is_authenticated or '_flashes' in session:
+            return view(*args, **kwargs)
+
+        cache = current_app.extensions['cache']
+        user_key = f'user:{current_user.id}'
+        generation = cache.generation(user_key)
+        # The half-hour bucket keeps embedded CSRF tokens and rolling windows fresh
+        bucket = int(time.time() // 1800)
+        raw = f'{_get_build_id()}|{request.full_path}|{current_user.id}|{generation}|{bucket}'
+        etag = hashlib.blake2b(raw.encode(), digest_size=12).hexdigest()
+
+        last_modified = cache.last_modified(user_key)
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        if last_modified:
+            response.last_modified = datetime.fromtimestamp(last_modified, tz=timezone.utc)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
+def static_url(filename):
+    """URL for a static file with a content hash, safe to cache for a year."""
+    digest = _static_hashes.get(filename)
+    if digest is None:
+        with open(os.path.join(current_app.static_folder, filename), 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()[:12]
+        if not current_app.debug:
+            _static_hashes[filename] = digest
+    return url_for('static', filename=filename, v=digest)
+
+
+def _compress(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(data, quality=current_app.config['COMPRESS_BROTLI_QUALITY']))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=current_app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _after_request(response):
+    if request.endpoint == 'static' and 'v' in request.args:
+        # Fingerprinted URLs change with the content, so they never need revalidating
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return _compress(response)
+
+
+def init_http_caching(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024) # bytes
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+    app.after_request(_after_request)
+    app.add_template_global(static_url)
@@ -0,0 +1,76 @@
+"""
+Cached loading of the logged-in user.
+
+Flask-Login calls ``load_user`` on every authenticated request, and most
+pages then read ``current_user.goal`` and ``current_user.exercise_goals``.
+We keep a snapshot of those rows per worker process and rebuild session
+bound objects from it without touching the database.
+
+Snapshots are tagged with the user's ``identity`` generation in the shared
+cache, so a profile or goal change made through any worker invalidates the
+copies held by all the others.
+"""
+from flask import current_app, g
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import db, cache
+from app.cache import LRUCache
+
+identity_cache = LRUCache(max_entries=1024)
+
+
+def _columns(obj):
+    return {attr.key: getattr(obj, attr.key) for attr in obj.__mapper__.column_attrs}
+
+
+def _restore(model, columns):
+    obj = model(**columns)
+    make_transient_to_detached(obj)
+    return obj
+
+
+def _snapshot(user):
+    return {
+        'user': _columns(user),
+        'goal': _columns(user.goal) if user.goal else None,
+        'exercise_goals': [_columns(goal) for goal in user.exercise_goals],
+    }
+
+
+def load_user(user_id):
+    from app.models import User, Goal, ExerciseGoal
+
+    generation = cache.generation(f'identity:{user_id}')
+    cached = identity_cache.get(user_id)
+    if cached is None or cached[0] != generation:
+        user = User.query.options(joinedload(User.goal)).get(user_id)
+        if user is None:
+            return None
+        snapshot = _snapshot(user)
+        identity_cache.set(user_id, (generation, snapshot), ttl=current_app.config['IDENTITY_CACHE_TTL'])
+        g.exercise_goals = list(user.exercise_goals)
+        return user
+
+    snapshot = cached[1]
+    user = _restore(User, snapshot['user'])
+    set_committed_value(user, 'goal', _restore(Goal, snapshot['goal']) if snapshot['goal'] else None)
+    # merge(load=False) attaches the rebuilt objects to this request's session without a query
+    user = db.session.merge(user, load=False)
+    g.exercise_goals = [db.session.merge(_restore(ExerciseGoal, columns), load=False)
+                        for columns in snapshot['exercise_goals']]
+    return user
+
+
+def get_exercise_goals(user):
+    """Exercise goals of ``user``, loaded at most once per request."""
+    if 'exercise_goals' not in g:
+        g.exercise_goals = user.exercise_goals.all()
+    return g.exercise_goals
+
+
+def invalidate_user(user_id):
+    """Call after committing a change to the user's profile, goal or exercise goals."""
+    identity_cache.delete(user_id)
+    cache.bump(f'identity:{user_id}')
+    g.pop('exercise_goals', None)
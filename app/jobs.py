@@ -0,0 +1,90 @@
+"""
+Periodic jobs, run by app/scheduler.py.
+
+Each job may run twice or stop half way without harm.  The per-user ones
+walk users in id order and checkpoint after every batch, so a failed run
+resumes with the next batch.
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from app import db, cache
+from app.models import DailyActivity
+from app.scheduler import scheduler
+from app.social import load_users
+
+BATCH_SIZE = 100
+
+
+def _active_user_ids(since, after_id):
+    """The next batch of ids of users with sleep or exercise logged since ``since``."""
+    rows = db.session.query(DailyActivity.user_id).distinct() \
+        .filter(DailyActivity.day >= since, DailyActivity.user_id > after_id) \
+        .order_by(DailyActivity.user_id).limit(BATCH_SIZE)
+    return [user_id for user_id, in rows]
+
+
+def _for_active_users(ctx, period, fn):
+    """Call ``fn(user)`` for every user active in the past week, resuming a run of the same ``period``."""
+    if ctx.state.get('period') != period:
+        ctx.state.clear()  # what an older run left behind is stale now
+    after_id = ctx.state.get('after_id', 0)
+    since = datetime.utcnow().date() - timedelta(days=7)
+    done = 0
+    while True:
+        user_ids = _active_user_ids(since, after_id)
+        if not user_ids:
+            return done
+        users = load_users(user_ids)
+        for user_id in user_ids:
+            if user_id in users and fn(users[user_id]):
+                done += 1
+        after_id = user_ids[-1]
+        ctx.checkpoint(period=period, after_id=after_id)
+        db.session.expunge_all()
+
+
+@scheduler.job('purge-sessions', '*/10 * * * *')
+def purge_sessions(ctx):
+    """Delete expired server-side sessions."""
+    store = current_app.extensions.get('sessions')
+    if store is None:
+        return 'cookie sessions, nothing to purge'
+    return f'{store.purge_expired()} sessions deleted'
+
+
+@scheduler.job('trim-feeds', '30 * * * *')
+def trim_feeds(ctx):
+    """Bound every activity timeline to FEED_MAX_ENTRIES."""
+    from app.feed import trim_timelines
+    return f'{trim_timelines()} feed entries deleted'
+
+
+@scheduler.job('warm-reports', '1 * * * *')
+def warm_reports(ctx):
+    """Build this hour's report for every active user before they ask for it."""
+    from app.routes import build_report, report_cache_key
+    now = datetime.utcnow()
+    ttl = current_app.config['REPORT_CACHE_TTL']
+
+    def warm(user):
+        key = report_cache_key(user.id, now)
+        if cache.get(key) is not None:
+            return False
+        cache.set(key, build_report(user), ttl=ttl)
+        return True
+
+    return f'{_for_active_users(ctx, now.strftime("%Y%m%d%H"), warm)} reports built'
+
+
+@scheduler.job('warm-leaderboards', '5 0 * * *')
+def warm_leaderboards(ctx):
+    """Build today's friend leaderboard for every active user; yesterday's keys expire."""
+    from app.leaderboard import weekly_leaderboard
+
+    def warm(user):
+        weekly_leaderboard(user.id)
+        return True
+
+    return f'{_for_active_users(ctx, datetime.utcnow().date().isoformat(), warm)} leaderboards ready'
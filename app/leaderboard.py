@@ -0,0 +1,93 @@
+"""
+Weekly friend leaderboard.
+
+Rankings are read from the ``DailyActivity`` rollup, which the record
+routes keep up to date with ``track_record`` inside the same transaction
+as the record itself.  A leaderboard for any number of friends is then one
+aggregate query over at most seven rows per member, and the sorted result
+is cached until one of the members logs something new.
+"""
+import hashlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from app import db, cache
+from app.models import DailyActivity, SleepRecord, ExerciseRecord
+from app.social import social_graph, load_users
+
+METRICS = ('exercise_minutes', 'calories_burned', 'avg_sleep')
+
+
+def track_record(record, sign=1):
+    """Add (``sign=1``) or remove (``sign=-1``) a record's contribution to the rollup.
+
+    Call before committing the record change so both are written together.
+    """
+    if isinstance(record, SleepRecord):
+        day = record.wakeup_time.date()
+        values = {'exercise_minutes': 0.0, 'calories_burned': 0.0, 'sleep_hours': sign * (record.duration or 0)}
+    elif isinstance(record, ExerciseRecord):
+        day = record.timestamp.date()
+        values = {'exercise_minutes': sign * (record.duration or 0),
+                  'calories_burned': sign * (record.calories_burned or 0),
+                  'sleep_hours': 0.0}
+    else:
+        return
+    user_id = record.user_id if record.user_id is not None else record.author.id
+    stmt = insert(DailyActivity).values(user_id=user_id, day=day, **values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day'],
+        set_={name: getattr(DailyActivity, name) + stmt.excluded[name] for name in values})
+    db.session.execute(stmt)
+
+
+def weekly_leaderboard(user_id):
+    """Rank the user and their friends for the current week.
+
+    Returns ``{metric: [{'user_id', 'username', 'value', 'rank'}, ...]}``
+    with each list sorted best first.
+    """
+    today = datetime.utcnow().date()
+    monday = today - timedelta(days=today.weekday())
+    members = sorted(social_graph.friend_ids(user_id) | {user_id})
+
+    # The key changes when the member set changes or any member logs a record
+    generations = cache.generations([f'user:{member}' for member in members])
+    fingerprint = hashlib.blake2b(repr(sorted(generations.items())).encode(), digest_size=12).hexdigest()
+    key = f'leaderboard:{user_id}:{today.isoformat()}:{fingerprint}'
+    return cache.get_or_set(key, lambda: _build_leaderboard(members, monday, today), ttl=86400)
+
+
+def _build_leaderboard(members, monday, today):
+    days_so_far = (today - monday).days + 1
+    totals = {member: {'exercise_minutes': 0.0, 'calories_burned': 0.0, 'avg_sleep': 0.0} for member in members}
+    rows = db.session.query(
+        DailyActivity.user_id,
+        func.sum(DailyActivity.exercise_minutes),
+        func.sum(DailyActivity.calories_burned),
+        func.sum(DailyActivity.sleep_hours),
+    ).filter(
+        DailyActivity.user_id.in_(members),
+        DailyActivity.day >= monday,
+        DailyActivity.day <= today,
+    ).group_by(DailyActivity.user_id)
+    for member, minutes, calories, sleep_hours in rows:
+        totals[member] = {
+            'exercise_minutes': round(minutes or 0, 1),
+            'calories_burned': round(calories or 0, 1),
+            'avg_sleep': round((sleep_hours or 0) / days_so_far, 2),
+        }
+
+    users = load_users(members)
+    rankings = {}
+    for metric in METRICS:
+        ordered = sorted(members, key=lambda member: (-totals[member][metric], member))
+        rankings[metric] = [{
+            'user_id': member,
+            'username': users[member].username if member in users else '未知用户',
+            'value': totals[member][metric],
+            'rank': rank,
+        } for rank, member in enumerate(ordered, start=1)]
+    return rankings
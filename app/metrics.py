@@ -0,0 +1,371 @@
+"""
+Request metrics in the Prometheus text format.
+
+Every request records its latency per endpoint, together with the number
+of SQL statements it ran and their time (from SQLAlchemy engine events)
+and its template render time (from app/templating.py).  ``/metrics``
+exposes them along with failed SQL statements (``database is locked``
+among them), the shared cache's hit and miss counts and chart render times
+and queue depth (from app/charts.py).
+
+``METRICS_MODE`` picks the cost:
+
+* ``'full'`` - latency, SQL count, SQL time and render time histograms
+  per endpoint;
+* ``'light'`` - a latency histogram and plain counters for the rest.  One
+  histogram per endpoint instead of four, which is what production runs;
+* ``'off'`` - nothing is recorded and ``/metrics`` is not registered.
+
+Each worker process keeps its numbers in memory and writes a snapshot to
+``METRICS_DIR/<pid>.json`` every ``METRICS_FLUSH_INTERVAL`` seconds, and
+``/metrics`` adds up the snapshots of all workers, so a scrape sees the
+whole server whichever worker answers it.  Snapshots of workers that have
+exited are folded into ``retired.json`` so their counts are kept.  Set
+``METRICS_TOKEN`` to require ``Authorization: Bearer <token>``.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import current_app, g, request, abort, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from app import sqltiming
+
+try:
+    import fcntl
+except ImportError:  # Windows; snapshots of exited workers are then left in place
+    fcntl = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# name -> (type, help)
+METRICS = {
+    'hms_requests_total': ('counter', 'Requests by endpoint, method and status.'),
+    'hms_request_duration_seconds': ('histogram', 'Time from the start of a request to its response.'),
+    'hms_sql_queries_total': ('counter', 'SQL statements executed while handling requests.'),
+    'hms_sql_duration_seconds_total': ('counter', 'Time spent in SQL statements while handling requests.'),
+    'hms_render_duration_seconds_total': ('counter', 'Time spent rendering templates.'),
+    'hms_request_sql_queries': ('histogram', 'SQL statements per request.'),
+    'hms_request_sql_duration_seconds': ('histogram', 'SQL time per request.'),
+    'hms_request_render_duration_seconds': ('histogram', 'Template render time per request.'),
+    'hms_sql_errors_total': ('counter', 'Failed SQL statements by endpoint and kind (locked, integrity, other).'),
+    'hms_cache_hits_total': ('counter', 'Shared cache reads that found a value.'),
+    'hms_cache_misses_total': ('counter', 'Shared cache reads that found nothing.'),
+    'hms_chart_render_duration_seconds': ('histogram', 'Time a renderer process spent drawing a chart.'),
+    'hms_chart_wait_duration_seconds': ('histogram', 'Time from asking for a chart to getting it, queueing included.'),
+    'hms_chart_errors_total': ('counter', 'Charts that failed or timed out.'),
+    'hms_chart_queue_depth': ('gauge', 'Charts queued or being drawn.'),
+}
+
+
+class Registry:
+    """Counters and histograms of one process, keyed by ``(name, labels)``."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.counters = {}
+        self.histograms = {}  # key -> [bucket bounds, counts per bucket, sum, count]
+
+    def _check_pid(self):
+        # A forked worker must not report what its parent counted
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._check_pid()
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_counter(self, name, value, labels=()):
+        """For counters and gauges kept elsewhere, like the cache's hit count."""
+        with self._lock:
+            self._check_pid()
+            self.counters[(name, labels)] = value
+
+    def observe(self, name, value, buckets, labels=()):
+        with self._lock:
+            self._check_pid()
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [list(buckets), [0] * len(buckets), 0, 0]
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+
+    def snapshot(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), *histogram] for (name, labels), histogram in self.histograms.items()],
+            }
+
+
+def _labels(pairs):
+    return tuple(tuple(pair) for pair in pairs)
+
+
+def merge(snapshots):
+    """Add up snapshots into ``(counters, histograms)`` dicts."""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot.get('counters', ()):
+            key = (name, _labels(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, counts, total, count in snapshot.get('histograms', ()):
+            key = (name, _labels(labels))
+            merged = histograms.get(key)
+            if merged is None or merged[0] != buckets:
+                histograms[key] = [buckets, list(counts), total, count]
+            else:
+                merged[1] = [a + b for a, b in zip(merged[1], counts)]
+                merged[2] += total
+                merged[3] += count
+    return counters, histograms
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_text(counters, histograms):
+    """Prometheus text exposition format, version 0.0.4."""
+    series = {}
+    for (name, labels), value in counters.items():
+        series.setdefault(name, []).append((labels, value))
+    for (name, labels), histogram in histograms.items():
+        series.setdefault(name, []).append((labels, histogram))
+
+    lines = []
+    for name in sorted(series):
+        kind, help_text = METRICS.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(series[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_number(value)}')
+                continue
+            buckets, counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", _number(bound))])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_number(total)}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics:
+
+    def __init__(self):
+        self.registry = Registry()
+        self._flush_lock = threading.Lock()
+        self._flusher_pid = None
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_MODE', 'light')
+        app.config.setdefault('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 5) # seconds
+        app.config.setdefault('METRICS_TOKEN', None)
+        if app.config['METRICS_MODE'] == 'off':
+            return
+        if app.config['METRICS_MODE'] not in ('full', 'light'):
+            raise ValueError(f"Unknown METRICS_MODE: {app.config['METRICS_MODE']}")
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+
+        app.before_request(self._start)
+        app.after_request(self._record)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        with app.app_context():
+            from app import db
+            engine = db.engine
+        sqltiming.watch(engine, _count_statement)
+        if not event.contains(engine, 'handle_error', self._record_sql_error):
+            event.listen(engine, 'handle_error', self._record_sql_error)
+        app.extensions['metrics'] = self
+
+    # --- per request ---
+
+    def _start(self):
+        if self._flusher_pid != os.getpid():
+            self._start_flusher(current_app._get_current_object())
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql_count = 0
+        g.metrics_sql_time = 0.0
+
+    def _record(self, response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        labels = (('endpoint', endpoint),)
+        registry = self.registry
+        registry.inc('hms_requests_total', labels + (('method', request.method), ('status', response.status_code)))
+        registry.observe('hms_request_duration_seconds', elapsed, LATENCY_BUCKETS, labels)
+
+        sql_count = g.get('metrics_sql_count', 0)
+        sql_time = g.get('metrics_sql_time', 0.0)
+        render_time = g.get('template_render_time', 0.0)
+        if current_app.config['METRICS_MODE'] == 'full':
+            registry.observe('hms_request_sql_queries', sql_count, QUERY_COUNT_BUCKETS, labels)
+            registry.observe('hms_request_sql_duration_seconds', sql_time, LATENCY_BUCKETS, labels)
+            registry.observe('hms_request_render_duration_seconds', render_time, LATENCY_BUCKETS, labels)
+        else:
+            registry.inc('hms_sql_queries_total', labels, sql_count)
+            registry.inc('hms_sql_duration_seconds_total', labels, sql_time)
+            registry.inc('hms_render_duration_seconds_total', labels, render_time)
+        return response
+
+    def _record_sql_error(self, context):
+        # Counted in both modes: under load, 'locked' is SQLite refusing a second writer
+        message = str(context.original_exception)
+        if 'database is locked' in message or 'database table is locked' in message:
+            kind = 'locked'
+        elif isinstance(context.sqlalchemy_exception, IntegrityError):
+            kind = 'integrity'
+        else:
+            kind = 'other'
+        endpoint = (request.endpoint or 'unmatched') if has_request_context() else 'background'
+        self.registry.inc('hms_sql_errors_total', (('endpoint', endpoint), ('kind', kind)))
+
+    # --- snapshots ---
+
+    def flush(self):
+        """Write this process's snapshot for the other workers' ``/metrics``."""
+        with self._flush_lock:
+            cache = current_app.extensions.get('cache')
+            if cache is not None:
+                self.registry.set_counter('hms_cache_hits_total', cache.hits)
+                self.registry.set_counter('hms_cache_misses_total', cache.misses)
+            charts = current_app.extensions.get('charts')
+            if charts is not None:
+                self.registry.set_counter('hms_chart_queue_depth', charts.pending)
+            directory = current_app.config['METRICS_DIR']
+            path = os.path.join(directory, f'{os.getpid()}.json')
+            temporary = f'{path}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(self.registry.snapshot(), f)
+            os.replace(temporary, path)
+
+    def _start_flusher(self, app):
+        # One per worker, started from its first request like the session collector
+        with self._flush_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+
+        def flush_in_context():
+            with app.app_context():
+                self.flush()
+
+        def run():
+            while True:
+                time.sleep(app.config['METRICS_FLUSH_INTERVAL'])
+                try:
+                    flush_in_context()
+                except OSError:
+                    pass  # e.g. the directory was cleaned up; try again next round
+
+        threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+        atexit.register(flush_in_context)
+
+    def collect(self):
+        """All workers' numbers, merged. Folds in snapshots of workers that have exited."""
+        self.flush()
+        directory = current_app.config['METRICS_DIR']
+        if fcntl is not None:
+            with open(os.path.join(directory, '.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                _retire_exited(directory)
+        snapshots = []
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # replaced or retired while we were listing
+        return merge(snapshots)
+
+    def view(self):
+        token = current_app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            abort(403)
+        body = render_text(*self.collect())
+        return current_app.response_class(body, mimetype='text/plain',
+                                          headers={'Cache-Control': 'no-store', 'Content-Type':
+                                                   'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _retire_exited(directory):
+    retired_path = os.path.join(directory, 'retired.json')
+    exited = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        stem = os.path.basename(path)[:-len('.json')]
+        if stem.isdigit() and not _pid_alive(int(stem)):
+            exited.append(path)
+    if not exited:
+        return
+    snapshots = []
+    for path in [retired_path] + exited:
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    counters, histograms = merge(snapshots)
+    # Gauges describe a live worker; an exited one no longer has a queue
+    counters = {key: value for key, value in counters.items() if METRICS.get(key[0], ('',))[0] != 'gauge'}
+    retired = {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), *histogram] for (name, labels), histogram in histograms.items()],
+    }
+    with open(f'{retired_path}.tmp', 'w') as f:
+        json.dump(retired, f)
+    os.replace(f'{retired_path}.tmp', retired_path)
+    for path in exited:
+        os.remove(path)
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany, elapsed):
+    # Only statements run for a request are counted; g also exists in CLI and job app contexts
+    if has_app_context() and 'metrics_sql_count' in g:
+        g.metrics_sql_count += 1
+        g.metrics_sql_time += elapsed
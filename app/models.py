@@ -5,9 +5,16 @@ from datetime import datetime
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # Served from a per-process snapshot, see app/identity.py
+    from app.identity import load_user as load_cached_user
+    return load_cached_user(int(id))
 
 class User(UserMixin, db.Model):
+    __table_args__ = (
+        # Case-insensitive prefix search, see app/user_search.py
+        db.Index('ix_user_username_lower', db.text('lower(username)')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
@@ -107,19 +114,132 @@ class DietRecord(db.Model):
     def __repr__(self):
         return f'<DietRecord {self.food_name}>'
 
+def _pair_low(context):
+    params = context.get_current_parameters()
+    return min(params['sender_id'], params['receiver_id'])
+
+def _pair_high(context):
+    params = context.get_current_parameters()
+    return max(params['sender_id'], params['receiver_id'])
+
 class FriendRequest(db.Model):
+    __table_args__ = (
+        # At most one pending request per pair of users, whichever of them sent it
+        db.Index('uq_friend_request_pending_pair', 'user_low', 'user_high', unique=True,
+                 sqlite_where=db.text("status = 'pending'")),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     status = db.Column(db.String(20), default='pending')  # pending, accepted, rejected
+    # The pair in canonical order, filled in from sender_id and receiver_id
+    user_low = db.Column(db.Integer, nullable=False, default=_pair_low)
+    user_high = db.Column(db.Integer, nullable=False, default=_pair_high)
 
     def __repr__(self):
         return f'<FriendRequest from {self.sender_id} to {self.receiver_id}: {self.status}>'
 
 class Friendship(db.Model):
+    """One row per pair of friends, always stored with ``user_id < friend_id``."""
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'friend_id', name='uq_friendship_pair'),
+        db.CheckConstraint('user_id < friend_id', name='ck_friendship_canonical'),
+        db.Index('ix_friendship_friend_id', 'friend_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     friend_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     friend = db.relationship('User', foreign_keys=[friend_id])
+
+    @staticmethod
+    def pair(user_id, other_id):
+        """Column values for the friendship between two users."""
+        return {'user_id': min(user_id, other_id), 'friend_id': max(user_id, other_id)}
+
+    def __repr__(self):
+        return f'<Friendship between {self.user_id} and {self.friend_id}>'
+
+class DailyActivity(db.Model):
+    """Per-user, per-day rollup maintained by app/leaderboard.py as records are added or deleted."""
+    __table_args__ = (db.UniqueConstraint('user_id', 'day', name='uq_daily_activity_user_day'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    exercise_minutes = db.Column(db.Float, nullable=False, default=0)
+    calories_burned = db.Column(db.Float, nullable=False, default=0)
+    sleep_hours = db.Column(db.Float, nullable=False, default=0) # attributed to the wake-up day
+
+    def __repr__(self):
+        return f'<DailyActivity {self.user_id} {self.day}>'
+
+class UserHistory(db.Model):
+    """A user's sleep and exercise records as packed NumPy arrays, maintained by app/history.py."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    sleep = db.Column(db.LargeBinary, nullable=False, default=b'')
+    exercise = db.Column(db.LargeBinary, nullable=False, default=b'')
+
+    def __repr__(self):
+        return f'<UserHistory {self.user_id}>'
+
+class FeedEntry(db.Model):
+    """One item in a user's friend activity timeline (see app/feed.py).
+
+    Rows with ``owner_id == actor_id`` form the actor's outbox.  Those with
+    ``pulled`` set were not copied to friends' timelines when published, so
+    friends read them from the outbox instead.
+    """
+    __table_args__ = (
+        db.Index('ix_feed_entry_owner_id_id', 'owner_id', 'id'),
+        db.Index('ix_feed_entry_kind_record_id', 'kind', 'record_id'),
+        db.Index('ix_feed_entry_pulled_owner_id_id', 'owner_id', 'id', sqlite_where=db.text('pulled = 1')),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False) # 'sleep', 'exercise' or 'diet'
+    record_id = db.Column(db.Integer, nullable=False)
+    summary = db.Column(db.String(200), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    pulled = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false()) # outbox entry not fanned out
+
+    def __repr__(self):
+        return f'<FeedEntry {self.kind} {self.record_id} for user {self.owner_id}>'
+
+
+class UsernameTrigram(db.Model):
+    """Trigram index over usernames for typo-tolerant search (see app/user_search.py)."""
+    __table_args__ = (
+        db.Index('ix_username_trigram_user_id', 'user_id'),
+        {'sqlite_with_rowid': False},
+    )
+
+    trigram = db.Column(db.String(3), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+
+    def __repr__(self):
+        return f'<UsernameTrigram {self.trigram!r} {self.user_id}>'
+
+
+class ScheduledJob(db.Model):
+    """Run history, lock and checkpoint of one periodic job (see app/scheduler.py)."""
+
+    name = db.Column(db.String(64), primary_key=True)
+    schedule = db.Column(db.String(64), nullable=False) # cron expression
+    next_run_at = db.Column(db.DateTime, nullable=False)
+    locked_by = db.Column(db.String(128)) # 'host:pid' of the process running the job
+    locked_until = db.Column(db.DateTime) # lease; an expired lock is free again
+    last_started_at = db.Column(db.DateTime)
+    last_finished_at = db.Column(db.DateTime)
+    last_duration = db.Column(db.Float) # seconds
+    last_status = db.Column(db.String(16)) # 'success' or 'failed'
+    last_error = db.Column(db.Text)
+    failure_count = db.Column(db.Integer, nullable=False, default=0) # consecutive
+    run_count = db.Column(db.Integer, nullable=False, default=0)
+    state = db.Column(db.Text) # JSON checkpoint left by an unfinished run
+
     def __repr__(self):
-        return f'<Friendship between {self.user_id} and {self.friend_id}>'
\ No newline at end of file
+        return f'<ScheduledJob {self.name} {self.schedule!r}>'
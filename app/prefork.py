@@ -0,0 +1,40 @@
+"""
+Process lifecycle for preforking servers.
+
+``warm_up(app)`` runs in the master before workers are forked (gunicorn
+with ``preload_app = True`` imports ``wsgi.py`` there).  Whatever it loads is
+shared copy-on-write by every worker instead of being built once per worker:
+compiled templates, the food catalog and the social graph.  The heavy
+imports (numpy, scikit-learn) already happen when the routes are imported
+by ``create_app``; matplotlib is only loaded by the chart renderers (see
+app/charts.py).
+
+Database connections are the opposite: a pooled connection must never be
+used by two processes, so the master closes its pool after warming up and
+every forked child drops whatever pool it inherited.
+"""
+import os
+
+from app import db
+from app.foods import food_catalog
+from app.social import social_graph
+
+
+def warm_up(app):
+    with app.app_context():
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        try:
+            food_catalog.preload()
+            social_graph.preload()
+        except Exception as e:
+            # e.g. migrations not applied yet; the workers load lazily instead
+            app.logger.warning(f'Skipped warming caches: {e}')
+        db.engine.dispose()
+
+    def reset_after_fork():
+        with app.app_context():
+            # close=False: leave the parent's connections alone, just forget them
+            db.engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,265 @@
+"""
+On-demand sampling profiler.
+
+A request is profiled when an admin (a user named in ``ADMIN_USERNAMES``)
+asks for it with ``?_profile=1`` or an ``X-Profile: 1`` header, or when it
+falls in the ``PROFILER_SAMPLE_RATE`` fraction of all traffic.  While the
+view runs, a helper thread reads the request thread's stack every
+``PROFILER_INTERVAL`` seconds, and an engine listener records every SQL
+statement the request thread runs, with its time.
+
+Each profile is saved under ``PROFILER_DIR`` as ``<id>.folded``, one
+``frame;frame;frame count`` line per distinct stack, as read by
+flamegraph.pl, speedscope and inferno, plus ``<id>.json`` with the request,
+timings and SQL.  Only the newest ``PROFILER_MAX_PROFILES`` are kept.
+Admins list them at ``/admin/profiles``; a profiled response carries its
+id in ``X-Profile-Id``.
+
+Requests that are not profiled cost one query-string and header lookup,
+plus one random number when sampling is on.
+"""
+import glob
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+from itertools import count
+
+from flask import current_app, g, request, abort, render_template, send_file
+from flask_login import current_user, login_required
+from sqlalchemy import event
+
+SKIPPED_ENDPOINTS = {'static', 'metrics', 'profiles', 'profile_detail', 'profile_folded'}
+TOP_FRAMES = 25
+_ids = count(1)
+
+
+def is_admin(user):
+    return user.is_authenticated and user.username in current_app.config['ADMIN_USERNAMES']
+
+
+def admin_required(view):
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if not is_admin(current_user):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _frame_name(code, root):
+    filename = code.co_filename
+    if filename.startswith(root):
+        filename = os.path.relpath(filename, root)
+    else:
+        filename = os.path.basename(filename)
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'
+
+
+class Profile:
+    """Stack samples and SQL of one request, taken from another thread."""
+
+    def __init__(self, interval, root):
+        self.interval = interval
+        self.root = root
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.statements = []  # [statement, seconds or None if it failed]
+        self._executing = None
+        self.started = time.perf_counter()
+        self.duration = None
+        self._stop = threading.Event()
+        self._names = {}  # code object -> frame name, most frames repeat
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+
+    def start(self):
+        from app import db
+        event.listen(db.engine, 'before_cursor_execute', self._before_execute)
+        event.listen(db.engine, 'after_cursor_execute', self._after_execute)
+        self._engine = db.engine
+        self._sampler.start()
+
+    def stop(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.started
+        self._stop.set()
+        self._sampler.join()
+        event.remove(self._engine, 'before_cursor_execute', self._before_execute)
+        event.remove(self._engine, 'after_cursor_execute', self._after_execute)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = self._names.get(code)
+                if name is None:
+                    name = self._names[code] = _frame_name(code, self.root)
+                stack.append(name)
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread_id:
+            self.statements.append([' '.join(statement.split()), None])
+            self._executing = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread_id and self.statements:
+            self.statements[-1][1] = round(time.perf_counter() - self._executing, 6)
+
+    def folded(self):
+        return ''.join(f'{stack} {samples}\n' for stack, samples in self.stacks.most_common())
+
+
+def top_frames(folded_lines, limit=TOP_FRAMES):
+    """``[(frame, self samples, total samples)]`` for the frames with the most samples."""
+    own = Counter()
+    total = Counter()
+    for line in folded_lines:
+        stack, _, samples = line.rstrip('\n').rpartition(' ')
+        if not stack:
+            continue
+        frames = stack.split(';')
+        own[frames[-1]] += int(samples)
+        for frame in set(frames):
+            total[frame] += int(samples)
+    return [(frame, own[frame], total[frame]) for frame, _ in total.most_common(limit)]
+
+
+class Profiler:
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILER_INTERVAL', 0.005) # seconds between stack samples
+        app.config.setdefault('PROFILER_DIR', os.path.join(app.instance_path, 'profiles'))
+        app.config.setdefault('PROFILER_MAX_PROFILES', 200)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+        app.add_url_rule('/admin/profiles', 'profiles', admin_required(self.list_view))
+        app.add_url_rule('/admin/profiles/<profile_id>', 'profile_detail', admin_required(self.detail_view))
+        app.add_url_rule('/admin/profiles/<profile_id>.folded', 'profile_folded',
+                         admin_required(self.folded_view))
+        app.extensions['profiler'] = self
+
+    def _trigger(self):
+        if request.args.get('_profile') or request.headers.get('X-Profile'):
+            # Only now load the user, and only to turn the request down if they are no admin
+            return 'admin' if is_admin(current_user) else None
+        rate = current_app.config['PROFILER_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            return 'sampled'
+        return None
+
+    def _start(self):
+        if request.endpoint in SKIPPED_ENDPOINTS:
+            return
+        trigger = self._trigger()
+        if trigger is None:
+            return
+        profile = Profile(current_app.config['PROFILER_INTERVAL'], os.path.dirname(current_app.root_path))
+        profile.trigger = trigger
+        g.profile = profile
+        profile.start()
+
+    def _finish(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        profile.stop()
+        profile_id = self.save(profile, response.status_code)
+        response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    def _teardown(self, exc):
+        # The request failed before after_request ran
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.stop()
+            self.save(profile, 500)
+
+    def save(self, profile, status):
+        directory = current_app.config['PROFILER_DIR']
+        os.makedirs(directory, exist_ok=True)
+        now = datetime.utcnow()
+        profile_id = f'{now:%Y%m%d%H%M%S}-{os.getpid()}-{next(_ids)}'
+        user_id = current_user.get_id() if current_user else None
+        meta = {
+            'id': profile_id,
+            'created_at': now.isoformat(timespec='seconds'),
+            'method': request.method,
+            'url': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': status,
+            'user_id': user_id,
+            'trigger': profile.trigger,
+            'duration': round(profile.duration, 6),
+            'interval': profile.interval,
+            'samples': sum(profile.stacks.values()),
+            'sql_count': len(profile.statements),
+            'sql_time': round(sum(seconds or 0 for _, seconds in profile.statements), 6),
+            'sql': profile.statements,
+        }
+        with open(os.path.join(directory, f'{profile_id}.folded'), 'w') as f:
+            f.write(profile.folded())
+        with open(os.path.join(directory, f'{profile_id}.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(directory, f'{profile_id}.json.tmp'), os.path.join(directory, f'{profile_id}.json'))
+        self._prune(directory)
+        return profile_id
+
+    def _prune(self, directory):
+        paths = sorted(glob.glob(os.path.join(directory, '*.json')), key=os.path.getmtime)
+        for path in paths[:-current_app.config['PROFILER_MAX_PROFILES']]:
+            for stale in (path, path[:-len('.json')] + '.folded'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass  # another worker pruned it first
+
+    def _load(self, profile_id):
+        path = os.path.join(current_app.config['PROFILER_DIR'], f'{os.path.basename(profile_id)}.json')
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            abort(404)
+
+    # --- admin pages ---
+
+    def list_view(self):
+        profiles = []
+        for path in glob.glob(os.path.join(current_app.config['PROFILER_DIR'], '*.json')):
+            try:
+                with open(path) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            meta.pop('sql', None)
+            profiles.append(meta)
+        profiles.sort(key=lambda meta: meta['created_at'], reverse=True)
+        return render_template('admin_profiles.html', title='性能剖析', profiles=profiles,
+                               sample_rate=current_app.config['PROFILER_SAMPLE_RATE'])
+
+    def detail_view(self, profile_id):
+        meta = self._load(profile_id)
+        try:
+            with open(os.path.join(current_app.config['PROFILER_DIR'], f"{meta['id']}.folded")) as f:
+                frames = top_frames(f)
+        except OSError:
+            frames = []
+        return render_template('admin_profile.html', title='性能剖析', profile=meta, frames=frames)
+
+    def folded_view(self, profile_id):
+        meta = self._load(profile_id)
+        return send_file(os.path.join(current_app.config['PROFILER_DIR'], f"{meta['id']}.folded"),
+                         mimetype='text/plain', as_attachment=True, download_name=f"{meta['id']}.folded")
@@ -0,0 +1,231 @@
+"""
+Query budgets: fail when a block of code runs more SQL than it should.
+
+    with query_budget(6):
+        client.get('/friends')
+
+    @query_budget(3, label='weekly_leaderboard')
+    def check_leaderboard():
+        ...
+
+A block that goes over budget raises ``QueryBudgetExceeded``, whose message
+lists the statements grouped by text with their counts; the same SELECT
+repeated once per row is what an N+1 looks like.  ``query_budget(None)``
+only counts.
+
+``flask check-query-budgets`` (``check_routes`` below) builds a scratch
+in-memory database with users of several data shapes, requests every page
+as each of them and compares the counts with ``ROUTE_BUDGETS``.  A route
+fails if it goes over its budget for any shape, or if it runs more
+statements for a user with 1000 records than for one with 10.
+"""
+import re
+import threading
+from collections import Counter
+from contextlib import ContextDecorator
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app import db
+
+SELECT_COLUMNS = re.compile(r'^SELECT (?:DISTINCT )?.*? FROM ')
+IN_LIST = re.compile(r'IN \((?:\?, )+\?\)')
+
+RECORD_COUNTS = (0, 10, 1000) # sleep, exercise and diet records each
+FRIEND_COUNTS = (0, 100) # also the number of pending incoming friend requests
+
+# Most statements a page may run for any shape, with warm per-process
+# identity, social graph and food catalog caches and an empty shared cache
+ROUTE_BUDGETS = {
+    'main.index': 6,
+    'main.sleep': 3,
+    'main.sleep_heatmap': 1,
+    'main.exercise': 2,
+    'main.diet': 1,
+    'main.report': 5,
+    'main.friends': 4,
+    'main.friend_requests': 1,
+    'main.friend_profile': 3,
+}
+
+
+class QueryBudgetExceeded(AssertionError):
+
+    def __init__(self, label, budget, statements):
+        self.label = label
+        self.budget = budget
+        self.statements = statements
+        super().__init__(f'{label or "block"} ran {len(statements)} SQL statements, budget {budget}:\n'
+                         + format_statements(statements))
+
+
+def _condense(statement):
+    # Column and IN lists hide what tells the statements apart
+    statement = SELECT_COLUMNS.sub('SELECT ... FROM ', ' '.join(statement.split()), count=1)
+    return IN_LIST.sub('IN (?, ...)', statement)
+
+
+def format_statements(statements, width=160):
+    """One line per distinct statement, most repeated first."""
+    lines = []
+    for statement, count in Counter(_condense(s) for s in statements).most_common():
+        lines.append(f'  {count:>4} x {statement[:width]}{"..." if len(statement) > width else ""}')
+    return '\n'.join(lines)
+
+
+class query_budget(ContextDecorator):
+    """Count the SQL statements the current thread runs in a block; raise if more than ``max_queries``."""
+
+    def __init__(self, max_queries, label=None, engine=None):
+        self.max_queries = max_queries
+        self.label = label
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        # Background threads (session collector, scheduler) share the engine
+        if threading.get_ident() == self._thread:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        self._engine = self.engine if self.engine is not None else db.engine
+        self._thread = threading.get_ident()
+        self.statements = []
+        event.listen(self._engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        event.remove(self._engine, 'before_cursor_execute', self._record)
+        if exc_type is None and self.max_queries is not None and self.count > self.max_queries:
+            raise QueryBudgetExceeded(self.label, self.max_queries, self.statements)
+        return False
+
+
+# --- route checks ---
+
+def _seed_shape(index, records, friends, now):
+    """A user with ``records`` of each record type and ``friends`` friends (and as many pending requests)."""
+    from app import history
+    from app.leaderboard import track_record
+    from app.models import (User, Goal, ExerciseGoal, SleepRecord, ExerciseRecord, DietRecord,
+                            Friendship, FriendRequest)
+
+    user = User(username=f'budget{index}', email=f'budget{index}@example.com', weight=65, height=170)
+    db.session.add(user)
+    db.session.add(Goal(user=user, target_sleep_hours=8, target_calorie_intake=2000))
+    db.session.add(ExerciseGoal(user=user, goal_type='duration', target_value=150))
+    db.session.add(ExerciseGoal(user=user, goal_type='frequency', target_value=3, exercise_type='跑步'))
+    db.session.flush()
+    history.add_user(user)
+    for i in range(records):
+        # Eight hours apart, so the first three weeks' worth fall in this week's windows
+        moment = now - timedelta(hours=8 * i)
+        sleep_record = SleepRecord(sleep_time=moment - timedelta(hours=7), wakeup_time=moment, duration=7,
+                                   author=user)
+        exercise_record = ExerciseRecord(exercise_type='跑步', duration=30, calories_burned=250,
+                                         timestamp=moment, author=user)
+        db.session.add_all([sleep_record, exercise_record,
+                            DietRecord(food_name='米饭', portion=200, calories=260, meal_type='午餐',
+                                       timestamp=moment, author=user)])
+        track_record(sleep_record)
+        track_record(exercise_record)
+        history.track_record(sleep_record)
+        history.track_record(exercise_record)
+
+    # Friends of the user's friends, for the suggestions on the friends page
+    strangers = [User(username=f'budget{index}s{i}', email=f'budget{index}s{i}@example.com') for i in range(5)]
+    others = [User(username=f'budget{index}f{i}', email=f'budget{index}f{i}@example.com') for i in range(friends)]
+    senders = [User(username=f'budget{index}r{i}', email=f'budget{index}r{i}@example.com') for i in range(friends)]
+    db.session.add_all(strangers + others + senders)
+    db.session.flush()
+    for i, friend in enumerate(others):
+        db.session.add(Friendship(**Friendship.pair(user.id, friend.id)))
+        db.session.add(Friendship(**Friendship.pair(friend.id, strangers[i % len(strangers)].id)))
+        exercise_record = ExerciseRecord(exercise_type='骑行', duration=20 + i % 40, calories_burned=150,
+                                         timestamp=now, author=friend)
+        db.session.add(exercise_record)
+        track_record(exercise_record)
+        history.track_record(exercise_record)
+    for sender in senders:
+        db.session.add(FriendRequest(sender_id=sender.id, receiver_id=user.id))
+    db.session.commit()
+    return user.id
+
+
+def _log_in(client, user_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+
+def check_routes(config='testing', echo=print):
+    """Measure every route in ``ROUTE_BUDGETS`` for every data shape.
+
+    Returns ``(counts, failures)``: ``counts[endpoint][(records, friends)]``
+    is a statement count and ``failures`` a list of messages, empty if every
+    route kept to its budget.
+    """
+    from flask import url_for
+    from app import create_app
+    from app.foods import import_foods, food_catalog, DEFAULT_FOODS
+    from app.social import social_graph
+
+    app = create_app(config)
+    counts = {endpoint: {} for endpoint in ROUTE_BUDGETS}
+    statements = {endpoint: {} for endpoint in ROUTE_BUDGETS}
+    failures = []
+    with app.app_context():
+        db.create_all()
+        import_foods(DEFAULT_FOODS.items())
+        now = datetime.utcnow().replace(microsecond=0)
+        shapes = [(records, friends) for friends in FRIEND_COUNTS for records in RECORD_COUNTS]
+        echo(f'Seeding {len(shapes)} users...')
+        users = {shape: _seed_shape(index, *shape, now) for index, shape in enumerate(shapes)}
+        social_graph.preload()
+        food_catalog.preload()
+        engine = db.engine
+
+    # Requests run outside that context so each one gets its own app context and session
+    try:
+        for shape, user_id in users.items():
+            client = app.test_client()
+            _log_in(client, user_id)
+            with app.test_request_context():
+                urls = {endpoint: url_for(endpoint, **({'friend_id': user_id}
+                                                       if endpoint == 'main.friend_profile' else {}))
+                        for endpoint in ROUTE_BUDGETS}
+            client.get(urls['main.index'])  # loads the user into the identity cache
+            for endpoint, url in urls.items():
+                with query_budget(None, engine=engine) as counter:
+                    response = client.get(url)
+                if response.status_code != 200:
+                    failures.append(f'{endpoint} answered {response.status_code} for {_describe(shape)}')
+                counts[endpoint][shape] = counter.count
+                statements[endpoint][shape] = counter.statements
+    finally:
+        with app.app_context():
+            db.drop_all()
+
+    smallest, largest = RECORD_COUNTS[1], RECORD_COUNTS[-1]
+    for endpoint, budget in ROUTE_BUDGETS.items():
+        worst = max(counts[endpoint], key=counts[endpoint].get)
+        if counts[endpoint][worst] > budget:
+            failures.append(f'{endpoint} ran {counts[endpoint][worst]} statements for {_describe(worst)}, '
+                            f'budget {budget}:\n{format_statements(statements[endpoint][worst])}')
+        for friends in FRIEND_COUNTS:
+            few, many = (counts[endpoint][(records, friends)] for records in (smallest, largest))
+            if many > few:
+                failures.append(f'{endpoint} ran {few} statements for {_describe((smallest, friends))} but '
+                                f'{many} for {_describe((largest, friends))}:\n'
+                                f'{format_statements(statements[endpoint][(largest, friends)])}')
+    return counts, failures
+
+
+def _describe(shape):
+    records, friends = shape
+    return f'{records} records/{friends} friends'
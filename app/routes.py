@@ -1,27 +1,37 @@
-from app import app, db
-from flask import jsonify,render_template, flash, redirect, url_for, request, abort
+from app import db, cache, advice_client
+from flask import Blueprint, current_app, jsonify,render_template, flash, redirect, url_for, request, abort, stream_with_context
 from app.forms import (LoginForm, RegistrationForm, EditProfileForm, GoalForm, 
                        AddExerciseGoalForm, SleepForm, ExerciseForm, DietForm)
 from flask_login import current_user, login_user, logout_user, login_required
 from app.models import User, SleepRecord, ExerciseRecord, DietRecord, Goal, ExerciseGoal, FriendRequest, Friendship
 from datetime import datetime, timedelta
 from urllib.parse import urlsplit
-import matplotlib.pyplot as plt
 import io
+import json
 import base64
 from collections import defaultdict
 import os
-import requests
 from flask import session, Flask
-from sqlalchemy import desc
-from app.analysis import generate_sleep_prediction, analyze_exercise_sleep_correlation, get_weekly_avg_sleep
-
-@app.route('/')
-@app.route('/index')
+from sqlalchemy import desc, func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from app.analysis import generate_sleep_prediction, analyze_exercise_sleep_correlation, get_weekly_avg_sleep, render_plot
+from app.identity import get_exercise_goals, invalidate_user
+from app.foods import food_catalog
+from app.http_cache import conditional
+from app.social import PendingRequest, social_graph, load_users
+from app.leaderboard import track_record, weekly_leaderboard
+from app import feed, user_search, history, timeline
+from app.advice import AdviceUnavailable
+
+bp = Blueprint('main', __name__)
+
+@bp.route('/')
+@bp.route('/index')
 @login_required
+@conditional
 def index():
     user_goal = current_user.goal
-    exercise_goals = current_user.exercise_goals.all()
+    exercise_goals = get_exercise_goals(current_user)
     progress_data = {}
     alert_messages = []  # 新增：用于存放预警信息
 
@@ -136,47 +146,53 @@ def index():
                            alert_messages=alert_messages,
                            avg_sleep=get_weekly_avg_sleep(current_user))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
             flash('无效的用户名或密码')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
+        if hasattr(session, 'regenerate'):
+            session.regenerate() # don't keep a session id that existed before login
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
-            next_page = url_for('index')
+            next_page = url_for('main.index')
         return redirect(next_page)
     return render_template('login.html', title='登录', form=form)
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = RegistrationForm()
     if form.validate_on_submit():
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
+        user_search.index_username(user)
+        history.add_user(user)
         db.session.commit()
+        cache.bump(user_search.GENERATION_KEY)
         flash('恭喜，您已成功注册！')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('register.html', title='注册', form=form)
 
-@app.route('/profile', methods=['GET', 'POST'])
+@bp.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     form = EditProfileForm()
     if form.validate_on_submit():
+        username_changed = form.username.data != current_user.username
         current_user.username = form.username.data
         current_user.gender = form.gender.data
         current_user.age = form.age.data
@@ -190,9 +206,15 @@ def profile():
         else:
             current_user.bmi = None
 
+        if username_changed:
+            user_search.index_username(current_user)
         db.session.commit()
+        cache.bump_user(current_user.id)
+        invalidate_user(current_user.id)
+        if username_changed:
+            cache.bump(user_search.GENERATION_KEY)
         flash('你的个人资料已更新！')
-        return redirect(url_for('profile'))
+        return redirect(url_for('main.profile'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.gender.data = current_user.gender
@@ -201,8 +223,9 @@ def profile():
         form.weight.data = current_user.weight
     return render_template('profile.html', title='个人资料', form=form)
 
-@app.route('/goals', methods=['GET', 'POST'])
+@bp.route('/goals', methods=['GET', 'POST'])
 @login_required
+@conditional
 def goals():
     form = GoalForm()
     add_exercise_goal_form = AddExerciseGoalForm()
@@ -217,8 +240,10 @@ def goals():
         goal.target_sleep_hours = form.target_sleep_hours.data
         goal.target_calorie_intake = form.target_calorie_intake.data
         db.session.commit()
+        cache.bump_user(current_user.id)
+        invalidate_user(current_user.id)
         flash('你的通用健康目标已更新！')
-        return redirect(url_for('goals'))
+        return redirect(url_for('main.goals'))
 
     if add_exercise_goal_form.add_exercise_goal.data and add_exercise_goal_form.validate_on_submit():
         new_goal = ExerciseGoal(
@@ -229,21 +254,23 @@ def goals():
         )
         db.session.add(new_goal)
         db.session.commit()
+        cache.bump_user(current_user.id)
+        invalidate_user(current_user.id)
         flash('新的运动目标已添加！')
-        return redirect(url_for('goals'))
+        return redirect(url_for('main.goals'))
 
     if request.method == 'GET':
         if current_user.goal:
             form.target_sleep_hours.data = current_user.goal.target_sleep_hours
             form.target_calorie_intake.data = current_user.goal.target_calorie_intake
 
-    exercise_goals = current_user.exercise_goals.all()
+    exercise_goals = get_exercise_goals(current_user)
 
     return render_template('goals.html', title='健康目标', form=form, 
                            add_exercise_goal_form=add_exercise_goal_form, 
                            exercise_goals=exercise_goals)
 
-@app.route('/delete_exercise_goal/<int:goal_id>', methods=['POST'])
+@bp.route('/delete_exercise_goal/<int:goal_id>', methods=['POST'])
 @login_required
 def delete_exercise_goal(goal_id):
     goal = ExerciseGoal.query.get_or_404(goal_id)
@@ -251,12 +278,15 @@ def delete_exercise_goal(goal_id):
         abort(403)
     db.session.delete(goal)
     db.session.commit()
+    cache.bump_user(current_user.id)
+    invalidate_user(current_user.id)
     flash('运动目标已删除。')
-    return redirect(url_for('goals'))
+    return redirect(url_for('main.goals'))
 
 
-@app.route('/sleep', methods=['GET', 'POST'])
+@bp.route('/sleep', methods=['GET', 'POST'])
 @login_required
+@conditional
 def sleep():
     form = SleepForm()
     if form.validate_on_submit():
@@ -266,7 +296,7 @@ def sleep():
 
             if wakeup_time_obj <= sleep_time_obj:
                 flash('起床时间必须晚于入睡时间。')
-                return redirect(url_for('sleep'))
+                return redirect(url_for('main.sleep'))
 
             overlapping_records = SleepRecord.query.filter(
                 SleepRecord.author == current_user,
@@ -276,7 +306,7 @@ def sleep():
 
             if overlapping_records:
                 flash('错误：该时间段与已有的睡眠记录重叠。')
-                return redirect(url_for('sleep'))
+                return redirect(url_for('main.sleep'))
 
             duration = (wakeup_time_obj - sleep_time_obj).total_seconds() / 3600
             sleep_record = SleepRecord(
@@ -286,15 +316,20 @@ def sleep():
                 author=current_user
             )
             db.session.add(sleep_record)
+            track_record(sleep_record)
+            history.track_record(sleep_record)
+            feed.publish(sleep_record)
             db.session.commit()
+            cache.bump_user(current_user.id)
             flash('新的睡眠记录已添加！')
-            return redirect(url_for('sleep'))
+            return redirect(url_for('main.sleep'))
         except ValueError:
             flash('日期格式不正确，请使用 YYYY-MM-DD HH:MM 格式。')
-            return redirect(url_for('sleep'))
+            return redirect(url_for('main.sleep'))
 
     # GET request logic
-    sleep_records = current_user.sleep_records.order_by(SleepRecord.sleep_time.desc()).all()
+    # Left unexecuted: the template only iterates it when the cached fragment is stale
+    sleep_records = current_user.sleep_records.order_by(SleepRecord.sleep_time.desc())
     today_utc = datetime.utcnow().date()
     monday = today_utc - timedelta(days=today_utc.weekday())
     next_monday = monday + timedelta(days=7)
@@ -326,8 +361,21 @@ def sleep():
     target_sleep_hours = current_user.goal.target_sleep_hours if current_user.goal and current_user.goal.target_sleep_hours else None
     return render_template('sleep.html', title='睡眠', form=form, sleep_records=sleep_records, sleep_dates=sleep_dates, sleep_durations=sleep_durations, avg_sleep=avg_sleep, target_sleep_hours=target_sleep_hours, sleep_times=sleep_times, wakeup_times=wakeup_times)
 
-@app.route('/exercise', methods=['GET', 'POST'])
+@bp.route('/api/sleep/heatmap')
+@login_required
+@conditional
+def sleep_heatmap():
+    # ?year=2025 for a year, plus &month=3 for one month; &split=0 counts whole nights on the wake-up day
+    year = request.args.get('year', datetime.utcnow().year, type=int)
+    month = request.args.get('month', type=int)
+    if not 1970 <= year <= 9998 or (month is not None and not 1 <= month <= 12):
+        abort(400)
+    split_midnight = request.args.get('split', 1, type=int) != 0
+    return jsonify(timeline.heatmap(current_user.id, year, month, split_midnight))
+
+@bp.route('/exercise', methods=['GET', 'POST'])
 @login_required
+@conditional
 def exercise():
     form = ExerciseForm()
 
@@ -350,7 +398,7 @@ def exercise():
             exercise_date = datetime.strptime(exercise_date_str, '%Y-%m-%d')
         except ValueError:
             flash('日期格式不正确，请使用 YYYY-MM-DD 格式。')
-            return redirect(url_for('exercise'))
+            return redirect(url_for('main.exercise'))
 
         exercise_type = form.exercise_type.data
         duration = form.duration.data
@@ -359,7 +407,7 @@ def exercise():
         if exercise_type == '其它':
             if not calories_burned:
                 flash('当运动类型为“其它”时，必须手动填写消耗的卡路里。')
-                return redirect(url_for('exercise'))
+                return redirect(url_for('main.exercise'))
         else:
             met = MET_VALUES.get(exercise_type, 0)
             calories_burned = (duration * met * 3.5 * user_weight_kg) / 200
@@ -372,9 +420,13 @@ def exercise():
             author=current_user
         )
         db.session.add(exercise_record)
+        track_record(exercise_record)
+        history.track_record(exercise_record)
+        feed.publish(exercise_record)
         db.session.commit()
+        cache.bump_user(current_user.id)
         flash('新的运动记录已添加！')
-        return redirect(url_for('exercise'))
+        return redirect(url_for('main.exercise'))
 
     # 统计最近一周每种运动类型的总时长
     monday = datetime.utcnow().date() - timedelta(days=datetime.utcnow().date().weekday())
@@ -391,21 +443,15 @@ def exercise():
     duration_stats = [
         {'type': k, 'duration': round(v, 1)} for k, v in duration_by_type.items()
     ]
-    exercise_records = current_user.exercise_records.order_by(ExerciseRecord.timestamp.desc()).all()
+    exercise_records = current_user.exercise_records.order_by(ExerciseRecord.timestamp.desc())
     return render_template('exercise.html', title='运动', form=form, exercise_records=exercise_records, duration_stats=duration_stats)
 
-@app.route('/diet', methods=['GET', 'POST'])
+@bp.route('/diet', methods=['GET', 'POST'])
 @login_required
+@conditional
 def diet():
     form = DietForm()
 
-    # Calorie reference values per 100g, hardcoded like in the exercise module
-    CALORIES_PER_100G = {
-        '米饭': 130, '馒头': 223, '鸡胸肉': 165, '牛肉': 250, 
-        '鸡蛋': 155, '牛奶': 54, '苹果': 52, '香蕉': 89, 
-        '西兰花': 55, '胡萝卜': 41
-    }
-
     if form.validate_on_submit():
         food_choice = form.food_choice.data
         portion = form.portion.data
@@ -417,14 +463,19 @@ def diet():
         if food_choice == '其它':
             food_name = form.other_food_name.data
             calories = form.other_calories.data
-            # For 'Other', we consider the entered portion as 1 serving, not in grams
-            portion = 1 
+            catalog_calories = food_catalog.calories_per_100g(food_name) if food_name else None
+            if not calories and catalog_calories:
+                # A food picked from the catalog is measured in grams like the fixed choices
+                calories = (portion / 100) * catalog_calories
+            else:
+                # For 'Other', we consider the entered portion as 1 serving, not in grams
+                portion = 1
             if not food_name or not calories:
                 flash('当选择“其它”时，必须手动填写食物名称和总卡路里。')
-                return redirect(url_for('diet'))
+                return redirect(url_for('main.diet'))
         else:
             food_name = food_choice
-            calories_per_100g = CALORIES_PER_100G.get(food_name, 0)
+            calories_per_100g = food_catalog.calories_per_100g(food_name) or 0
             calories = (portion / 100) * calories_per_100g
 
         if calories > 0:
@@ -436,12 +487,14 @@ def diet():
                 author=current_user
             )
             db.session.add(diet_record)
+            feed.publish(diet_record)
             db.session.commit()
+            cache.bump_user(current_user.id)
             flash('新的饮食记录已添加！')
         else:
             flash('无法计算卡路里，请检查输入。')
 
-        return redirect(url_for('diet'))
+        return redirect(url_for('main.diet'))
 
     monday = datetime.utcnow().date() - timedelta(days=datetime.utcnow().date().weekday())
     next_monday = monday + timedelta(days=7)
@@ -451,17 +504,62 @@ def diet():
     ).order_by(DietRecord.timestamp.desc()).all()
     return render_template('diet.html', title='饮食', form=form, diet_records=diet_records)
 
-@app.route('/report')
+@bp.route('/api/foods')
+@login_required
+def food_autocomplete():
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify({'results': food_catalog.search(query, limit=limit)})
+
+@bp.route('/report')
 @login_required
+@conditional
 def report():
+    now = datetime.utcnow()
+    key = report_cache_key(current_user.id, now)
+    context = cache.get_or_set(key, lambda: build_report(current_user), ttl=current_app.config['REPORT_CACHE_TTL'])
+    plots = report_plots(key, context)
+
+    # Convert UTC time to Beijing Time (UTC+8)
+    report_time_beijing = now + timedelta(hours=8)
+
+    return render_template('report.html', title='健康报告', report_time=report_time_beijing, plots=plots, **context)
+
+def report_plots(key, context):
+    """The report's charts as base64 PNGs, by context entry.
+
+    Drawn after the report's cache lookup, and cached only once drawn, so a
+    chart that failed to render is tried again on the next view.
+    """
+    plots = {}
+    for entry in ('sleep_prediction', 'correlation_analysis'):
+        chart = context[entry].get('chart')
+        if chart is None:
+            continue
+        plot_key = f'{key}:plot:{entry}'
+        plot = cache.get(plot_key)
+        if plot is None:
+            plot = render_plot(*chart)
+            if plot is not None:
+                cache.set(plot_key, plot, ttl=current_app.config['REPORT_CACHE_TTL'])
+        plots[entry] = plot
+    return plots
+
+def report_cache_key(user_id, now):
+    # Keyed by the user's data generation, so any add/delete makes older entries unreachable.
+    # The hour bucket keeps the rolling one-week window from drifting too far.
+    return f"report:{user_id}:{cache.user_generation(user_id)}:{now.strftime('%Y%m%d%H')}"
+
+def build_report(user):
+    """Compute everything shown on the report page except the generation time."""
     one_week_ago = datetime.utcnow() - timedelta(days=7)
-    sleep_records = current_user.sleep_records.filter(SleepRecord.sleep_time >= one_week_ago).all()
-    exercise_records = current_user.exercise_records.filter(ExerciseRecord.timestamp >= one_week_ago).all()
-    diet_records = current_user.diet_records.filter(DietRecord.timestamp >= one_week_ago).all()
+    sleep_records = user.sleep_records.filter(SleepRecord.sleep_time >= one_week_ago).all()
+    exercise_records = user.exercise_records.filter(ExerciseRecord.timestamp >= one_week_ago).all()
+    diet_records = user.diet_records.filter(DietRecord.timestamp >= one_week_ago).all()
 
     total_sleep_hours = sum(r.duration for r in sleep_records)
     # avg_sleep = total_sleep_hours / 7 if sleep_records else 0
-    avg_sleep = get_weekly_avg_sleep(current_user)
+    avg_sleep = get_weekly_avg_sleep(user)
 
     total_calories_burned = sum(r.calories_burned for r in exercise_records)
     avg_calories_burned = total_calories_burned / 7 if exercise_records else 0
@@ -493,8 +591,8 @@ def report():
 
     # Add BMI advice
     bmi_status = None
-    if current_user.bmi:
-        bmi = current_user.bmi
+    if user.bmi:
+        bmi = user.bmi
         if bmi < 18.5:
             bmi_status = "偏瘦"
             advice_list.append(f"你的BMI为 {bmi}，属于偏瘦范围，请注意均衡营养。")
@@ -508,15 +606,14 @@ def report():
             bmi_status = "肥胖"
             advice_list.append(f"你的BMI为 {bmi}，属于肥胖范围，请关注相关健康风险。")
 
-    # Get all sleep records for prediction (not just last week)
-    all_sleep_records = current_user.sleep_records.all()
+    # All sleep and exercise history for prediction (not just last week), as arrays
+    all_sleep, all_exercise = history.load(user.id)
 
     # Generate sleep prediction
-    sleep_prediction = generate_sleep_prediction(all_sleep_records)
+    sleep_prediction = generate_sleep_prediction(all_sleep)
 
     # Analyze correlation between exercise and sleep
-    all_exercise_records = current_user.exercise_records.all()
-    correlation_analysis = analyze_exercise_sleep_correlation(all_exercise_records, all_sleep_records)
+    correlation_analysis = analyze_exercise_sleep_correlation(all_exercise, all_sleep)
 
     # Add analysis insights to advice list if successful
     if sleep_prediction.get('success'):
@@ -529,251 +626,290 @@ def report():
     if correlation_analysis.get('success'):
         advice_list.append(f"数据分析显示：{correlation_analysis.get('interpretation', '')}")
 
-    # Convert UTC time to Beijing Time (UTC+8)
-    report_time_utc = datetime.utcnow()
-    report_time_beijing = report_time_utc + timedelta(hours=8)
-
-    return render_template('report.html', title='健康报告', 
-                           advice_list=advice_list, 
-                           avg_sleep=avg_sleep, 
-                           avg_calories_burned=avg_calories_burned, 
-                           avg_calories_eaten=avg_calories_eaten,
-                           bmi_status=bmi_status,
-                           report_time=report_time_beijing,
-                           sleep_prediction=sleep_prediction,
-                           correlation_analysis=correlation_analysis)
-
-@app.route('/delete_sleep/<int:record_id>', methods=['POST'])
+    return dict(advice_list=advice_list,
+                avg_sleep=avg_sleep,
+                avg_calories_burned=avg_calories_burned,
+                avg_calories_eaten=avg_calories_eaten,
+                bmi_status=bmi_status,
+                sleep_prediction=sleep_prediction,
+                correlation_analysis=correlation_analysis)
+
+@bp.route('/delete_sleep/<int:record_id>', methods=['POST'])
 @login_required
 def delete_sleep(record_id):
     record = SleepRecord.query.get_or_404(record_id)
     if record.author != current_user:
         abort(403)
+    track_record(record, sign=-1)
+    history.track_record(record, sign=-1)
+    feed.unpublish(record)
     db.session.delete(record)
     db.session.commit()
+    cache.bump_user(current_user.id)
     flash('睡眠记录已删除！')
-    return redirect(url_for('sleep'))
+    return redirect(url_for('main.sleep'))
 
-@app.route('/delete_exercise/<int:record_id>', methods=['POST'])
+@bp.route('/delete_exercise/<int:record_id>', methods=['POST'])
 @login_required
 def delete_exercise(record_id):
     record = ExerciseRecord.query.get_or_404(record_id)
     if record.author != current_user:
         abort(403)
+    track_record(record, sign=-1)
+    history.track_record(record, sign=-1)
+    feed.unpublish(record)
     db.session.delete(record)
     db.session.commit()
+    cache.bump_user(current_user.id)
     flash('运动记录已删除！')
-    return redirect(url_for('exercise'))
+    return redirect(url_for('main.exercise'))
 
-@app.route('/delete_diet/<int:record_id>', methods=['POST'])
+@bp.route('/delete_diet/<int:record_id>', methods=['POST'])
 @login_required
 def delete_diet(record_id):
     record = DietRecord.query.get_or_404(record_id)
     if record.author != current_user:
         abort(403)
+    feed.unpublish(record)
     db.session.delete(record)
     db.session.commit()
+    cache.bump_user(current_user.id)
     flash('饮食记录已删除！')
-    return redirect(url_for('diet'))
+    return redirect(url_for('main.diet'))
 
-@app.route('/get_deepseek_advice', methods=['POST'])
+@bp.route('/get_deepseek_advice', methods=['POST'])
 @login_required
 def get_deepseek_advice():
-    one_week_ago = datetime.utcnow() - timedelta(days=7)
-    sleep_records = current_user.sleep_records.filter(SleepRecord.sleep_time >= one_week_ago).all()
-    exercise_records = current_user.exercise_records.filter(ExerciseRecord.timestamp >= one_week_ago).all()
-    diet_records = current_user.diet_records.filter(DietRecord.timestamp >= one_week_ago).all()
-
-    total_sleep_hours = sum(r.duration for r in sleep_records)
-    avg_sleep = total_sleep_hours / 7 if sleep_records else 0
+    try:
+        deepseek_advice = advice_client.get_advice(weekly_metrics(current_user))
+        save_last_advice(current_user.id, deepseek_advice)
+    except AdviceUnavailable as e:
+        deepseek_advice = str(e)
+    return jsonify({'advice': deepseek_advice})
 
-    total_calories_burned = sum(r.calories_burned for r in exercise_records)
-    avg_calories_burned = total_calories_burned / 7 if exercise_records else 0
+@bp.route('/advice/stream')
+@login_required
+def stream_deepseek_advice():
+    """Relay the advice as server-sent events while DeepSeek generates it."""
+    # Query first: only the response's close hook returns the slot, so nothing may fail in between
+    metrics = weekly_metrics(current_user)
+    if not advice_client.stream_slots.acquire(blocking=False):
+        # The page falls back to get_deepseek_advice
+        return jsonify({'error': '当前请求过多，请稍后重试。'}), 503
+    user_id = current_user.id
+    pieces = advice_client.stream_advice(metrics)
 
-    total_calories_eaten = sum(r.calories for r in diet_records)
-    avg_calories_eaten = total_calories_eaten / 7 if diet_records else 0
+    def events():
+        text = []
+        try:
+            for piece in pieces:
+                text.append(piece)
+                yield f'data: {json.dumps({"text": piece}, ensure_ascii=False)}\n\n'
+        except AdviceUnavailable as e:
+            yield f'event: failed\ndata: {json.dumps({"message": str(e)}, ensure_ascii=False)}\n\n'
+            return
+        save_last_advice(user_id, ''.join(text))
+        yield 'event: done\ndata: {}\n\n'
+
+    response = current_app.response_class(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # tell nginx not to buffer the stream
+    response.call_on_close(advice_client.stream_slots.release)
+    return response
+
+@bp.route('/advice/last')
+@login_required
+def last_deepseek_advice():
+    return jsonify({'advice': cache.get(f'advice:last:{current_user.id}')})
 
-    prompt = "请根据以下健康数据给出健康评估和建议，数据包含周平均睡眠时长（小时/天）、身体质量指数（BMI）、周日均摄入热量（大卡）和周日均运动消耗（大卡）。并且给出食谱建议。"
+def save_last_advice(user_id, text):
+    # Kept server-side so the report page can show it again without a new call
+    cache.set(f'advice:last:{user_id}', text, ttl=current_app.config['ADVICE_CACHE_TTL'])
 
-    messages = [
-        {
-            "role": "user",
-            "content": f"{prompt} 周平均睡眠时长：{avg_sleep} 小时/天，BMI：{current_user.bmi if current_user.bmi else '无数据'}，周日均摄入热量：{avg_calories_eaten} 大卡，周日均运动消耗：{avg_calories_burned} 大卡"
-        }
-    ]
-
-    payload = {
-        "model": "deepseek-chat",
-        "messages": messages,
-        "max_tokens": 1000,
-        "temperature": 0.3
+def weekly_metrics(user):
+    """Daily averages over the past seven days, as sent to DeepSeek."""
+    one_week_ago = datetime.utcnow() - timedelta(days=7)
+    total_sleep_hours = db.session.query(func.sum(SleepRecord.duration)) \
+        .filter(SleepRecord.user_id == user.id, SleepRecord.sleep_time >= one_week_ago).scalar()
+    total_calories_burned = db.session.query(func.sum(ExerciseRecord.calories_burned)) \
+        .filter(ExerciseRecord.user_id == user.id, ExerciseRecord.timestamp >= one_week_ago).scalar()
+    total_calories_eaten = db.session.query(func.sum(DietRecord.calories)) \
+        .filter(DietRecord.user_id == user.id, DietRecord.timestamp >= one_week_ago).scalar()
+    return {
+        'avg_sleep': (total_sleep_hours or 0) / 7,
+        'bmi': user.bmi,
+        'avg_calories_eaten': (total_calories_eaten or 0) / 7,
+        'avg_calories_burned': (total_calories_burned or 0) / 7,
     }
 
-    deepseek_api_key = 'sk-19cca959be3243b89eb3e2f5e986e78b'
-    deepseek_advice = None
-    if deepseek_api_key:
-        headers = {
-            "Authorization": f"Bearer {deepseek_api_key}",
-            "Content-Type": "application/json"
-        }
-        try:
-            response = requests.post(
-                "https://api.deepseek.com/v1/chat/completions",
-                json=payload,
-                headers=headers
-            )
-            response.raise_for_status()
-            deepseek_response = response.json()
-            if 'choices' in deepseek_response and deepseek_response['choices']:
-                message_content = deepseek_response['choices'][0]['message']['content']
-                deepseek_advice = message_content
-        except requests.RequestException as e:
-            app.logger.error(f"调用 DeepSeek API 出错: {e}")
-            deepseek_advice = "无法获取 DeepSeek 的健康评估建议，请稍后重试。"
-    else:
-        deepseek_advice = "未配置 DeepSeek API 密钥，无法获取额外的健康评估建议。"
-
-    session['deepseek_advice'] = deepseek_advice
-    return jsonify({'advice': deepseek_advice})
-
-@app.route('/search_user', methods=['GET', 'POST'])
+@bp.route('/search_user', methods=['GET', 'POST'])
 @login_required
 def search_user():
     if request.method == 'POST':
-        username = request.form.get('username')
-        if not username:
-            flash('请输入要搜索的用户名', 'danger')
-            return redirect(url_for('search_user'))
-        user = User.query.filter_by(username=username).first()
-        if user:
-            if user.id == current_user.id:
-                flash('不能搜索自己', 'warning')
-                return redirect(url_for('search_user'))
-
-            is_friend = Friendship.query.filter(
-                ((Friendship.user_id == current_user.id) & (Friendship.friend_id == user.id)) |
-                ((Friendship.user_id == user.id) & (Friendship.friend_id == current_user.id))
-            ).first()
-
-            existing_request = FriendRequest.query.filter(
-                ((FriendRequest.sender_id == current_user.id) & (FriendRequest.receiver_id == user.id)) |
-                ((FriendRequest.sender_id == user.id) & (FriendRequest.receiver_id == current_user.id))
-            ).first()
-            return render_template('user_found.html', user=user, is_friend=is_friend, existing_request=existing_request)
-        else:
+        # Old form posts; searches are plain GETs so result pages can be linked
+        return redirect(url_for('main.search_user', q=request.form.get('username', '')))
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 20
+    users, total = [], 0
+    if q:
+        users, total = user_search.search_users(q, page=page, per_page=per_page, exclude_id=current_user.id)
+        if not total:
             flash('未找到该用户', 'danger')
-            return redirect(url_for('search_user'))
-    return render_template('search_user.html')
+    statuses = social_graph.relationships(current_user.id, [user.id for user in users])
+    pages = (total + per_page - 1) // per_page
+    return render_template('search_user.html', title='搜索用户', q=q, users=users, statuses=statuses,
+                           page=page, pages=pages, total=total)
 
-@app.route('/send_friend_request/<int:user_id>')
+@bp.route('/send_friend_request/<int:user_id>')
 @login_required
 def send_friend_request(user_id):
     sender_id = current_user.id
 
-    is_friend = Friendship.query.filter(
-        ((Friendship.user_id == sender_id) & (Friendship.friend_id == user_id)) |
-        ((Friendship.user_id == user_id) & (Friendship.friend_id == sender_id))
-    ).first()
-    if is_friend:
+    if user_id == sender_id or db.session.get(User, user_id) is None:
+        flash('无效的用户', 'danger')
+        return redirect(url_for('main.search_user'))
+
+    if social_graph.is_friend(sender_id, user_id):
         flash('你们已经是好友了', 'warning')
-        return redirect(url_for('search_user'))
+        return redirect(url_for('main.search_user'))
 
-    existing_request = FriendRequest.query.filter(
-        ((FriendRequest.sender_id == sender_id) & (FriendRequest.receiver_id == user_id)) |
-        ((FriendRequest.sender_id == user_id) & (FriendRequest.receiver_id == sender_id))
-    ).first()
+    existing_request = social_graph.pending_request(sender_id, user_id)
     if existing_request:
         if existing_request.sender_id == sender_id:
             flash('你已经发送过好友请求了', 'warning')
         else:
             flash('对方已经向你发送过好友请求，请到好友请求列表处理', 'info')
-        return redirect(url_for('search_user'))
-    friend_request = FriendRequest(sender_id=sender_id, receiver_id=user_id)
-    db.session.add(friend_request)
+        return redirect(url_for('main.search_user'))
+    # The partial unique index turns a duplicate or crossing request into a no-op
+    stmt = sqlite_insert(FriendRequest).values(
+        sender_id=sender_id, receiver_id=user_id, status='pending',
+        user_low=min(sender_id, user_id), user_high=max(sender_id, user_id),
+    ).on_conflict_do_nothing(index_elements=['user_low', 'user_high'], index_where=FriendRequest.status == 'pending')
+    result = db.session.execute(stmt)
     db.session.commit()
-    flash('好友请求已发送', 'success')
-    return redirect(url_for('search_user'))
+    if result.rowcount:
+        social_graph.add_request(PendingRequest(result.inserted_primary_key[0], sender_id, user_id))
+        flash('好友请求已发送', 'success')
+    else:
+        flash('你们之间已有待处理的好友请求', 'info')
+    return redirect(url_for('main.search_user'))
 
-@app.route('/friend_requests')
+@bp.route('/friend_requests')
 @login_required
 def friend_requests():
-    friend_requests = FriendRequest.query.filter_by(receiver_id=current_user.id, status='pending').all()
+    friend_requests = social_graph.incoming_requests(current_user.id)
+    senders = load_users(r.sender_id for r in friend_requests)
     requests_with_usernames = []
     for request in friend_requests:
-        sender = User.query.get(request.sender_id)
+        sender = senders.get(request.sender_id)
         requests_with_usernames.append({
             'request': request,
             'sender_username': sender.username if sender else '未知用户'
         })
     return render_template('friend_requests.html', requests=requests_with_usernames)
 
-@app.route('/accept_friend_request/<int:request_id>', methods=['POST'])
+@bp.route('/accept_friend_request/<int:request_id>', methods=['POST'])
 @login_required
 def accept_friend_request(request_id):
-    friend_request = FriendRequest.query.get(request_id)
-    if friend_request and friend_request.receiver_id == current_user.id:
-        friend_request.status = 'accepted'
-        friendship1 = Friendship(user_id=friend_request.sender_id, friend_id=friend_request.receiver_id)
-        friendship2 = Friendship(user_id=friend_request.receiver_id, friend_id=friend_request.sender_id)
-        db.session.add(friendship1)
-        db.session.add(friendship2)
+    friend_request = db.session.get(FriendRequest, request_id)
+    if friend_request is None or friend_request.receiver_id != current_user.id:
+        flash('无效的好友请求', 'danger')
+        return redirect(url_for('main.friend_requests'))
+
+    sender_id = friend_request.sender_id
+    # Only the request that flips pending -> accepted creates the friendship,
+    # so double submits and concurrent accepts are harmless
+    result = db.session.execute(
+        update(FriendRequest)
+        .where(FriendRequest.id == request_id, FriendRequest.status == 'pending')
+        .values(status='accepted')
+        .execution_options(synchronize_session=False))
+    if result.rowcount:
+        db.session.execute(
+            sqlite_insert(Friendship).values(**Friendship.pair(sender_id, current_user.id))
+            .on_conflict_do_nothing(index_elements=['user_id', 'friend_id']))
         db.session.commit()
+        social_graph.remove_request(sender_id, current_user.id)
+        social_graph.add_friendship(sender_id, current_user.id)
         flash('已接受好友请求', 'success')
     else:
-        flash('无效的好友请求', 'danger')
-    return redirect(url_for('friend_requests'))
+        db.session.rollback()
+        if friend_request.status == 'accepted':
+            flash('已接受好友请求', 'success')
+        else:
+            flash('无效的好友请求', 'danger')
+    return redirect(url_for('main.friend_requests'))
 
-@app.route('/reject_friend_request/<int:request_id>', methods=['POST'])
+@bp.route('/reject_friend_request/<int:request_id>', methods=['POST'])
 @login_required
 def reject_friend_request(request_id):
-    friend_request = FriendRequest.query.get(request_id)
-    if friend_request and friend_request.receiver_id == current_user.id:
-        # 删除好友请求记录
-        db.session.delete(friend_request)
+    # 删除好友请求记录
+    friend_request = FriendRequest.query.filter_by(id=request_id, receiver_id=current_user.id, status='pending').first()
+    if friend_request:
+        sender_id = friend_request.sender_id
+        deleted = FriendRequest.query.filter_by(id=request_id, status='pending').delete(synchronize_session=False)
         db.session.commit()
+        if deleted:
+            social_graph.remove_request(sender_id, current_user.id)
         flash('已拒绝好友请求', 'success')
     else:
         flash('无效的好友请求', 'danger')
-    return redirect(url_for('friend_requests'))
+    return redirect(url_for('main.friend_requests'))
 
-@app.route('/friends')
+@bp.route('/friends')
 @login_required
 def friends():
     user_id = current_user.id
-    friendships = Friendship.query.filter_by(user_id=user_id).all()
-    friend_list = []
-    for friendship in friendships:
-        friend = User.query.get(friendship.friend_id)
-        friend_list.append(friend)
-    return render_template('friends.html', friends=friend_list)
-
-@app.route('/friend_profile/<int:friend_id>')
+    friend_list = sorted(load_users(social_graph.friend_ids(user_id)).values(), key=lambda u: u.username)
+
+    # 好友推荐：共同好友最多的“好友的好友”
+    suggested = social_graph.suggestions(user_id)
+    suggested_users = load_users(uid for uid, _ in suggested)
+    suggestions = [{'user': suggested_users[uid], 'mutual_friends': mutual}
+                   for uid, mutual in suggested if uid in suggested_users]
+    return render_template('friends.html', friends=friend_list, suggestions=suggestions,
+                           leaderboard=weekly_leaderboard(user_id))
+
+@bp.route('/feed')
+@login_required
+def friend_feed():
+    cursor = request.args.get('cursor', type=int)
+    entries, next_cursor = feed.timeline(current_user.id, cursor=cursor)
+    return render_template('feed.html', title='好友动态', entries=entries, next_cursor=next_cursor)
+
+@bp.route('/friend_profile/<int:friend_id>')
 @login_required
 def friend_profile(friend_id):
     friend = User.query.get(friend_id)
     if not friend:
         return "未找到该用户", 404
 
-    one_week_ago = datetime.utcnow() - timedelta(days=7)
+    # Whole days, so the window only moves when the ``today`` in the fragment keys changes
+    today = datetime.utcnow().date()
+    one_week_ago = datetime.combine(today - timedelta(days=7), datetime.min.time())
 
+    # The queries run only if the template's cached fragment for this friend is stale
     recent_sleep = SleepRecord.query.filter(
         SleepRecord.user_id == friend.id,
         SleepRecord.sleep_time >= one_week_ago
-    ).order_by(desc(SleepRecord.sleep_time)).all()
+    ).order_by(desc(SleepRecord.sleep_time))
 
     recent_exercise = ExerciseRecord.query.filter(
         ExerciseRecord.user_id == friend.id,
         ExerciseRecord.timestamp >= one_week_ago
-    ).order_by(desc(ExerciseRecord.timestamp)).all()
+    ).order_by(desc(ExerciseRecord.timestamp))
 
     recent_diet = DietRecord.query.filter(
         DietRecord.user_id == friend.id,
         DietRecord.timestamp >= one_week_ago
-    ).order_by(desc(DietRecord.timestamp)).all()
+    ).order_by(desc(DietRecord.timestamp))
 
     return render_template(
         'friend_profile.html',
         friend=friend,
+        friend_version=cache.user_generation(friend.id),
+        today=today,
         recent_sleep=recent_sleep,
         recent_exercise=recent_exercise,
         recent_diet=recent_diet
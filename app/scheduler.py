@@ -0,0 +1,293 @@
+"""
+Periodic jobs.
+
+Jobs are functions registered with a cron expression (see app/jobs.py)::
+
+    @scheduler.job('trim-feeds', '30 * * * *')
+    def trim_feeds(ctx):
+        ...
+
+They are run by ``flask scheduler run`` (a daemon loop), ``flask scheduler
+tick`` (a single pass, for system cron) or, with ``SCHEDULER_IN_WORKER``, a
+background thread in each web worker.  Any number of runners may be active
+at once: each job has a ``ScheduledJob`` row that doubles as its lock.  A
+runner claims a due job with one conditional UPDATE and holds it for
+``SCHEDULER_LOCK_TTL`` seconds, renewed at every checkpoint, so the lock of
+a runner that died simply expires.
+
+The row also records the last start, duration, outcome and error.  Jobs
+must be idempotent, and long ones should be resumable: ``ctx.state`` holds
+what the job last passed to ``ctx.checkpoint()``.  It is kept when a run
+fails or is cut off, so the next run continues from there, and cleared
+after a successful run.
+
+Cron expressions have the usual five fields - minute, hour, day of month,
+month, day of week (0 or 7 is Sunday) - in UTC, with ``*``, lists, ranges
+and steps, or one of ``@hourly``, ``@daily``, ``@weekly`` and ``@monthly``.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, time as clock
+
+from flask import current_app
+from sqlalchemy import or_, update
+from sqlalchemy.dialects.sqlite import insert
+
+from app import db
+from app.models import ScheduledJob
+
+ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+class LockLost(Exception):
+    """Another runner took over the job, e.g. after this one stalled past its lease."""
+
+
+def _parse_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        span, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if span == '*':
+            start, end = low, high
+        elif '-' in span:
+            start, end = (int(bound) for bound in span.split('-', 1))
+        else:
+            # '5/15' means every 15 starting at 5
+            start = int(span)
+            end = high if '/' in part else start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError(f'Invalid cron field {field!r}')
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSpec:
+    """A parsed five-field cron expression."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression {expression!r} must have five fields')
+        minutes, hours, days, months, weekdays = (
+            _parse_field(field, low, high) for field, (low, high) in zip(fields, FIELD_RANGES))
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        # As in cron: if both day fields are restricted, a day matching either one runs
+        self._either_day = fields[2] != '*' and fields[4] != '*'
+
+    def matches_day(self, date):
+        if date.month not in self.months:
+            return False
+        in_days = date.day in self.days
+        in_weekdays = (date.weekday() + 1) % 7 in self.weekdays  # cron counts from Sunday
+        return in_days or in_weekdays if self._either_day else in_days and in_weekdays
+
+    def next_after(self, moment):
+        """The first matching minute strictly after ``moment``."""
+        start = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        date = start.date()
+        # Five years covers even '0 0 29 2 *'
+        for _ in range(366 * 5):
+            if self.matches_day(date):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime.combine(date, clock(hour, minute))
+                        if candidate >= start:
+                            return candidate
+            date += timedelta(days=1)
+        raise ValueError(f'Cron expression {self.expression!r} never matches')
+
+    def __repr__(self):
+        return f'<CronSpec {self.expression!r}>'
+
+
+class Job:
+
+    def __init__(self, name, cron, fn):
+        self.name = name
+        self.cron = cron
+        self.fn = fn
+
+
+class JobContext:
+    """Handed to a running job."""
+
+    def __init__(self, scheduler, job, state):
+        self.scheduler = scheduler
+        self.job = job
+        self.state = state
+
+    def checkpoint(self, **state):
+        """Record progress and renew the lock.
+
+        Commits the session, so changes the job made since the last
+        checkpoint are saved together with the state that covers them.
+        Raises ``LockLost`` if another runner has taken the job over.
+        """
+        self.state.update(state)
+        self.scheduler._checkpoint(self.job, self.state)
+
+
+class Scheduler:
+
+    def __init__(self, app=None):
+        self.jobs = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SCHEDULER_IN_WORKER', False)
+        app.config.setdefault('SCHEDULER_LOCK_TTL', 600) # seconds
+        app.config.setdefault('SCHEDULER_TICK', 30) # seconds between passes
+        app.extensions['scheduler'] = self
+        if app.config['SCHEDULER_IN_WORKER']:
+            # Started from the first request so a preforking server starts one per worker
+            app.before_request(self.ensure_running)
+
+    def job(self, name, schedule):
+        """Register the decorated function as job ``name``, run on the cron ``schedule``."""
+        def decorator(fn):
+            self.jobs[name] = Job(name, CronSpec(schedule), fn)
+            return fn
+        return decorator
+
+    @property
+    def owner(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def sync(self):
+        """Create rows for new jobs and re-plan jobs whose schedule changed."""
+        now = datetime.utcnow()
+        schedules = dict(db.session.query(ScheduledJob.name, ScheduledJob.schedule))
+        for job in self.jobs.values():
+            if job.name not in schedules:
+                db.session.execute(insert(ScheduledJob).values(
+                    name=job.name, schedule=job.cron.expression, next_run_at=job.cron.next_after(now),
+                    failure_count=0, run_count=0,
+                ).on_conflict_do_nothing(index_elements=['name']))
+            elif schedules[job.name] != job.cron.expression:
+                db.session.execute(update(ScheduledJob).where(ScheduledJob.name == job.name).values(
+                    schedule=job.cron.expression, next_run_at=job.cron.next_after(now)))
+        db.session.commit()
+
+    def run_pending(self):
+        """Run every due job this process can lock. Returns ``{name: status}`` for the jobs it ran."""
+        self.sync()
+        due = db.session.query(ScheduledJob.name) \
+            .filter(ScheduledJob.next_run_at <= datetime.utcnow()).order_by(ScheduledJob.next_run_at)
+        results = {}
+        for name in [name for name, in due]:
+            if name in self.jobs:
+                status = self.run(name)
+                if status is not None:
+                    results[name] = status
+        return results
+
+    def run(self, name, force=False):
+        """Run job ``name`` if it is due (or ``force``) and not locked by another runner.
+
+        Returns ``'success'`` or ``'failed'``, or None if the job did not run.
+        """
+        job = self.jobs[name]
+        if not self._acquire(job, force):
+            return None
+        row = db.session.get(ScheduledJob, name)
+        context = JobContext(self, job, json.loads(row.state) if row.state else {})
+        started = time.monotonic()
+        try:
+            result = job.fn(context)
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception(f'Scheduled job {name} failed')
+            self._finish(job, time.monotonic() - started, error=traceback.format_exc(), state=context.state)
+            return 'failed'
+        self._finish(job, time.monotonic() - started)
+        current_app.logger.info(f'Scheduled job {name} finished in {time.monotonic() - started:.2f}s: {result}')
+        return 'success'
+
+    def _acquire(self, job, force):
+        now = datetime.utcnow()
+        stmt = update(ScheduledJob).where(
+            ScheduledJob.name == job.name,
+            or_(ScheduledJob.locked_until.is_(None), ScheduledJob.locked_until < now))
+        if not force:
+            stmt = stmt.where(ScheduledJob.next_run_at <= now)
+        stmt = stmt.values(locked_by=self.owner, last_started_at=now,
+                           locked_until=now + timedelta(seconds=current_app.config['SCHEDULER_LOCK_TTL']))
+        acquired = db.session.execute(stmt).rowcount == 1
+        db.session.commit()
+        return acquired
+
+    def _checkpoint(self, job, state):
+        lease = timedelta(seconds=current_app.config['SCHEDULER_LOCK_TTL'])
+        renewed = db.session.execute(
+            update(ScheduledJob)
+            .where(ScheduledJob.name == job.name, ScheduledJob.locked_by == self.owner)
+            .values(state=json.dumps(state), locked_until=datetime.utcnow() + lease)
+        ).rowcount == 1
+        if not renewed:
+            db.session.rollback()
+            raise LockLost(job.name)
+        db.session.commit()
+
+    def _finish(self, job, duration, error=None, state=None):
+        now = datetime.utcnow()
+        values = dict(
+            locked_by=None, locked_until=None, last_finished_at=now, last_duration=duration,
+            last_status='failed' if error else 'success', last_error=error,
+            failure_count=ScheduledJob.failure_count + 1 if error else 0,
+            run_count=ScheduledJob.run_count + 1,
+            state=json.dumps(state) if error and state else None,
+            next_run_at=job.cron.next_after(now),
+        )
+        finished = db.session.execute(
+            update(ScheduledJob)
+            .where(ScheduledJob.name == job.name, ScheduledJob.locked_by == self.owner)
+            .values(**values)
+        ).rowcount == 1
+        db.session.commit()
+        if not finished:
+            current_app.logger.warning(f'Scheduled job {job.name} lost its lock before finishing')
+
+    def run_forever(self, app, stop=None):
+        """Run due jobs every ``SCHEDULER_TICK`` seconds until ``stop`` (an Event) is set."""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            with app.app_context():
+                try:
+                    self.run_pending()
+                except Exception:
+                    # A locked database or the like; the next pass tries again
+                    app.logger.exception('Scheduler pass failed')
+            stop.wait(app.config['SCHEDULER_TICK'])
+
+    def ensure_running(self):
+        """Start the background runner of this process if it is not running yet."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                thread = threading.Thread(target=self.run_forever, args=(current_app._get_current_object(),),
+                                          name='scheduler', daemon=True)
+                thread.start()
+                self._pid = os.getpid()
+
+
+scheduler = Scheduler()
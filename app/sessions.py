@@ -0,0 +1,244 @@
+"""
+Server-side sessions.
+
+Flask's default session serializes everything into a signed cookie that the
+browser sends back on every request.  With ``ServerSideSessionInterface``
+the cookie carries only a random session id and the data lives in a store:
+
+* ``SQLiteSessionStore`` (default) - a SQLite file in the instance folder,
+  shared by all worker processes on the host;
+* ``RedisSessionStore`` - any client with a redis-py style interface.
+
+Session data is written back only when it changed, and the expiry is
+refreshed at most once per ``SESSION_REFRESH_INTERVAL``.  A daemon thread
+deletes expired sessions every ``SESSION_GC_INTERVAL`` seconds (Redis
+expires keys by itself), unless that is 0 and the ``purge-sessions`` job
+of app/jobs.py does it.  Set ``SESSION_BACKEND = 'cookie'`` to keep
+Flask's cookie sessions.
+"""
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False, expires_at=None):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires_at = expires_at
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Move the data to a fresh id, e.g. after login, so an id planted
+        before authentication is worthless."""
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = new_sid()
+        self.modified = True
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+class SQLiteSessionStore:
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        # One connection per thread, reopened after a fork (see SQLiteBackend in app/cache.py)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS session (
+                    id TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_session_expires_at ON session (expires_at);
+            ''')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, sid):
+        """Return ``(data, expires_at)`` or None if missing or expired."""
+        row = self._conn().execute('SELECT data, expires_at FROM session WHERE id = ?', (sid,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0], row[1]
+
+    def set(self, sid, data, ttl):
+        self._conn().execute('INSERT OR REPLACE INTO session (id, data, expires_at) VALUES (?, ?, ?)',
+                             (sid, data, time.time() + ttl))
+
+    def touch(self, sid, ttl):
+        self._conn().execute('UPDATE session SET expires_at = ? WHERE id = ?', (time.time() + ttl, sid))
+
+    def delete(self, sid):
+        self._conn().execute('DELETE FROM session WHERE id = ?', (sid,))
+
+    def purge_expired(self):
+        return self._conn().execute('DELETE FROM session WHERE expires_at < ?', (time.time(),)).rowcount
+
+    def __len__(self):
+        return self._conn().execute('SELECT count(*) FROM session').fetchone()[0]
+
+
+class RedisSessionStore:
+    """Adapter for a redis-py compatible client; Redis expires the keys itself."""
+
+    def __init__(self, client, prefix='hms:session:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, sid):
+        pipe = self.client.pipeline()
+        pipe.get(self.prefix + sid)
+        pipe.ttl(self.prefix + sid)
+        data, ttl = pipe.execute()
+        if data is None:
+            return None
+        return data, time.time() + max(ttl, 0)
+
+    def set(self, sid, data, ttl):
+        self.client.set(self.prefix + sid, data, ex=int(ttl))
+
+    def touch(self, sid, ttl):
+        self.client.expire(self.prefix + sid, int(ttl))
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+    def purge_expired(self):
+        return 0
+
+
+class ServerSideSessionInterface(SessionInterface):
+
+    def __init__(self, store):
+        self.store = store
+
+    def _ttl(self, app):
+        return int(app.permanent_session_lifetime.total_seconds())
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and len(sid) <= 64:
+            stored = self.store.get(sid)
+            if stored is not None:
+                data, expires_at = stored
+                try:
+                    return ServerSideSession(serializer.loads(data), sid=sid, expires_at=expires_at)
+                except ValueError:
+                    pass
+        return ServerSideSession(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            # Emptied (e.g. logout): drop the stored copy and the cookie
+            if not session.new and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+            return
+
+        ttl = self._ttl(app)
+        if session.modified:
+            self.store.set(session.sid, serializer.dumps(dict(session)), ttl)
+        elif session.expires_at and session.expires_at - time.time() < ttl - app.config['SESSION_REFRESH_INTERVAL']:
+            self.store.touch(session.sid, ttl)
+        else:
+            return
+
+        # Only the id goes to the browser; the cookie outlives the browser
+        # session only for permanent sessions, like Flask's default
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=httponly, domain=domain, path=path, secure=secure, samesite=samesite)
+
+
+class SessionGarbageCollector:
+    """Deletes expired sessions from a daemon thread, started once per process."""
+
+    def __init__(self, store, interval):
+        self.store = store
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_running(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                thread = threading.Thread(target=self._run, name='session-gc', daemon=True)
+                thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.store.purge_expired()
+            except Exception:
+                pass  # try again next round; a locked database is not worth a dead thread
+
+
+def create_store(app):
+    kind = app.config['SESSION_BACKEND']
+    if kind == 'sqlite':
+        return SQLiteSessionStore(app.config['SESSION_PATH'])
+    if kind == 'redis':
+        import redis  # optional dependency, only needed for this backend
+        return RedisSessionStore(redis.Redis.from_url(app.config['SESSION_REDIS_URL']))
+    raise ValueError(f'Unknown SESSION_BACKEND: {kind}')
+
+
+def init_sessions(app):
+    app.config.setdefault('SESSION_BACKEND', 'sqlite')
+    app.config.setdefault('SESSION_PATH', os.path.join(app.instance_path, 'sessions.db'))
+    app.config.setdefault('SESSION_REDIS_URL', None)
+    app.config.setdefault('SESSION_REFRESH_INTERVAL', 3600) # seconds
+    app.config.setdefault('SESSION_GC_INTERVAL', 600) # seconds; 0 leaves it to the purge-sessions job
+    if app.config['SESSION_BACKEND'] == 'cookie':
+        return
+
+    store = create_store(app)
+    app.session_interface = ServerSideSessionInterface(store)
+    if app.config['SESSION_GC_INTERVAL']:
+        collector = SessionGarbageCollector(store, app.config['SESSION_GC_INTERVAL'])
+        # Started from the first request so a preforking server starts one per worker
+        app.before_request(collector.ensure_running)
+    app.extensions['sessions'] = store
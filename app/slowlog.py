@@ -0,0 +1,216 @@
+"""
+Slow-query log.
+
+Every SQL statement that takes longer than ``SLOW_QUERY_THRESHOLD`` seconds
+is appended to ``SLOW_QUERY_LOG`` (``instance/slow_queries.jsonl``) as one
+JSON line with:
+
+* the statement, its bound parameters and its time;
+* the endpoint and path of the request that ran it, or ``background``;
+* SQLite's ``EXPLAIN QUERY PLAN`` for it, run on the same connection.
+
+Plans are cached per statement text in each process, so a statement that
+is slow again and again is explained only once.  Statements that touch
+``password_hash`` are logged without parameters.  When the log grows past
+``SLOW_QUERY_LOG_MAX_BYTES`` it is moved to ``<log>.1``, replacing the
+previous one.
+
+``aggregate`` groups the entries of both files by normalized statement
+(whitespace, ``IN`` lists and literals collapsed) with count, p50, p95,
+max and last seen, and marks statements whose plan scans a whole table
+or index.  ``flask slow-queries`` prints that, and admins see it at
+``/admin/slow-queries``.  ``SLOW_QUERY_THRESHOLD = None`` turns it off.
+
+Statements below the threshold cost two clock reads.
+"""
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import defaultdict, Counter
+from datetime import datetime, timedelta
+
+from flask import current_app, render_template, request, has_request_context
+from app import sqltiming
+from app.profiler import admin_required
+
+IN_LIST = re.compile(r'IN \((?:\?, )+\?\)')
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+REDACTED_COLUMNS = ('password_hash',)
+MAX_PARAMETER_LENGTH = 200
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(statement):
+    """The statement with its literals and ``IN`` lists collapsed, one line."""
+    statement = ' '.join(statement.split())
+    statement = STRING_LITERAL.sub('?', statement)
+    statement = NUMBER_LITERAL.sub('?', statement)
+    return IN_LIST.sub('IN (?, ...)', statement)
+
+
+def _loggable(parameters, statement, executemany):
+    if any(column in statement for column in REDACTED_COLUMNS):
+        return '<redacted>'
+    if executemany:
+        # The first row shows the shape; the rest only add size
+        parameters = parameters[0] if parameters else ()
+    if isinstance(parameters, dict):
+        return {key: _loggable_value(value) for key, value in parameters.items()}
+    return [_loggable_value(value) for value in parameters or ()]
+
+
+def _loggable_value(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = str(value)
+    return text if len(text) <= MAX_PARAMETER_LENGTH else text[:MAX_PARAMETER_LENGTH] + '...'
+
+
+def _format_plan(rows):
+    """EXPLAIN QUERY PLAN rows ``(id, parent, notused, detail)`` as indented lines."""
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node_id] + detail)
+    return lines
+
+
+def scans_table(plan):
+    """Whether a plan reads every row of a table or index, rather than searching a range of one.
+
+    ``SCAN t USING INDEX i`` is such a read too: the index only gives the order.
+    """
+    return any(line.strip().startswith('SCAN ') and line.strip() != 'SCAN CONSTANT ROW' for line in plan or ())
+
+
+class SlowQueryLog:
+
+    def __init__(self):
+        self._settings = {}  # engine -> (threshold, path, max bytes)
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_LOG', os.path.join(app.instance_path, 'slow_queries.jsonl'))
+        app.config.setdefault('SLOW_QUERY_LOG_MAX_BYTES', 20 * 1024 * 1024)
+        app.extensions['slow_query_log'] = self
+        app.add_url_rule('/admin/slow-queries', 'slow_queries', admin_required(self.view))
+        if app.config['SLOW_QUERY_THRESHOLD'] is None:
+            return
+        with app.app_context():
+            from app import db
+            engine = db.engine
+        self._settings[engine] = (app.config['SLOW_QUERY_THRESHOLD'], app.config['SLOW_QUERY_LOG'],
+                                  app.config['SLOW_QUERY_LOG_MAX_BYTES'])
+        sqltiming.watch(engine, self._check_statement)
+
+    def _check_statement(self, conn, cursor, statement, parameters, context, executemany, elapsed):
+        threshold, path, max_bytes = self._settings[conn.engine]
+        if elapsed < threshold:
+            return
+        entry = {
+            'at': datetime.utcnow().isoformat(timespec='milliseconds'),
+            'duration': round(elapsed, 6),
+            'statement': ' '.join(statement.split()),
+            'parameters': _loggable(parameters, statement, executemany),
+            'executemany': bool(executemany),
+            'endpoint': request.endpoint if has_request_context() else 'background',
+            'path': request.path if has_request_context() else None,
+            'plan': self._plan(conn, cursor, statement, parameters, executemany),
+            'pid': os.getpid(),
+        }
+        self._write(path, max_bytes, json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+
+    def _plan(self, conn, cursor, statement, parameters, executemany):
+        if conn.dialect.name != 'sqlite':
+            return None
+        plan = self._plans.get(statement)
+        if plan is None:
+            try:
+                # A cursor of its own, since the statement's rows may not have been read yet
+                explain = cursor.connection.cursor()
+                try:
+                    explain.execute('EXPLAIN QUERY PLAN ' + statement,
+                                    (parameters[0] if parameters else ()) if executemany else parameters)
+                    plan = _format_plan(explain.fetchall())
+                finally:
+                    explain.close()
+            except Exception as exc:  # some statements (PRAGMA, DDL) cannot be explained
+                return [f'(no plan: {exc})']
+            self._plans[statement] = plan
+        return plan
+
+    def _write(self, path, max_bytes, line):
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(line)  # one write per entry, so workers' lines do not interleave
+                    size = f.tell()
+                if size > max_bytes:
+                    os.replace(path, path + '.1')
+            except OSError:
+                logger.exception('could not write the slow query log')
+
+    def view(self):
+        hours = request.args.get('hours', 24, type=int)
+        groups = aggregate(read_entries(current_app.config['SLOW_QUERY_LOG'],
+                                        since=datetime.utcnow() - timedelta(hours=hours)))
+        return render_template('admin_slow_queries.html', title='慢查询', groups=groups, hours=hours,
+                               threshold=current_app.config['SLOW_QUERY_THRESHOLD'])
+
+
+def read_entries(path, since=None):
+    """The entries of the log and its rotated predecessor, oldest first."""
+    since = since.isoformat() if since else ''
+    entries = []
+    for name in (path + '.1', path):
+        try:
+            with open(name, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # cut off by a crash mid-write
+                    if entry['at'] >= since:
+                        entries.append(entry)
+        except FileNotFoundError:
+            continue
+    return entries
+
+
+def _percentile(ordered, fraction):
+    # Nearest rank
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def aggregate(entries):
+    """Group entries by normalized statement, the most total time first."""
+    groups = defaultdict(list)
+    for entry in entries:
+        groups[normalize(entry['statement'])].append(entry)
+    result = []
+    for statement, group in groups.items():
+        durations = sorted(entry['duration'] for entry in group)
+        last = max(group, key=lambda entry: entry['at'])
+        result.append({
+            'statement': statement,
+            'count': len(group),
+            'p50': _percentile(durations, 0.5),
+            'p95': _percentile(durations, 0.95),
+            'max': durations[-1],
+            'total': sum(durations),
+            'last_seen': last['at'],
+            'endpoints': Counter(entry['endpoint'] for entry in group).most_common(),
+            'plan': last['plan'],
+            'full_scan': scans_table(last['plan']),
+            'example': last,
+        })
+    result.sort(key=lambda group: group['total'], reverse=True)
+    return result
@@ -0,0 +1,191 @@
+"""
+In-memory social graph.
+
+Each worker keeps every user's friend set and pending friend requests in
+memory, so relationship checks, mutual friend counts and suggestions need
+no queries.  Routes that change a relationship update the local graph,
+bump the shared ``social`` generation and store the change in the shared
+cache under the new generation.  Other workers see the new generation on
+their next lookup and apply just the changes they missed.  They reload the
+whole graph only when a change is missing (evicted, or a bump made without
+one, such as ``flask generate-data``'s) or when they are more than
+``MAX_REPLAY`` changes behind.
+"""
+import threading
+from collections import Counter, defaultdict, namedtuple
+
+from app import db, cache
+
+GENERATION_KEY = 'social'
+CHANGE_KEY = 'social-change'
+CHANGE_TTL = 3600 # seconds; a worker further behind than this reloads
+MAX_REPLAY = 500 # changes; past this a reload is cheaper
+
+PendingRequest = namedtuple('PendingRequest', ['id', 'sender_id', 'receiver_id'])
+
+
+class SocialGraph:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._generation = None
+        self._friends = defaultdict(set)
+        self._outgoing = defaultdict(dict)  # sender_id -> {receiver_id: PendingRequest}
+        self._incoming = defaultdict(dict)  # receiver_id -> {sender_id: PendingRequest}
+
+    def preload(self):
+        """Load the graph now instead of on the first lookup."""
+        self._ensure_loaded()
+
+    def _ensure_loaded(self):
+        generation = cache.generation(GENERATION_KEY)
+        if generation != self._generation:
+            with self._lock:
+                # Read again: another thread may have caught up while we waited
+                generation = cache.generation(GENERATION_KEY)
+                if generation != self._generation and not self._replay(generation):
+                    self._load(generation)
+
+    def _replay(self, generation):
+        """Apply the logged changes up to ``generation``; False if one is missing."""
+        if self._generation is None or not 0 < generation - self._generation <= MAX_REPLAY:
+            return False
+        changes = [cache.get(f'{CHANGE_KEY}:{n}') for n in range(self._generation + 1, generation + 1)]
+        if None in changes:
+            return False
+        for change in changes:
+            self._apply(change)
+        self._generation = generation
+        return True
+
+    def _load(self, generation):
+        from app.models import Friendship, FriendRequest
+        friends = defaultdict(set)
+        for user_id, friend_id in db.session.query(Friendship.user_id, Friendship.friend_id):
+            friends[user_id].add(friend_id)
+            friends[friend_id].add(user_id)
+        outgoing = defaultdict(dict)
+        incoming = defaultdict(dict)
+        pending = db.session.query(FriendRequest.id, FriendRequest.sender_id, FriendRequest.receiver_id) \
+            .filter(FriendRequest.status == 'pending')
+        for row in pending:
+            request = PendingRequest(*row)
+            outgoing[request.sender_id][request.receiver_id] = request
+            incoming[request.receiver_id][request.sender_id] = request
+        self._friends, self._outgoing, self._incoming = friends, outgoing, incoming
+        self._generation = generation
+
+    def _apply(self, change):
+        kind, *args = change
+        if kind == 'add_request':
+            pending = PendingRequest(*args)
+            self._outgoing[pending.sender_id][pending.receiver_id] = pending
+            self._incoming[pending.receiver_id][pending.sender_id] = pending
+        elif kind == 'remove_request':
+            sender_id, receiver_id = args
+            self._outgoing[sender_id].pop(receiver_id, None)
+            self._incoming[receiver_id].pop(sender_id, None)
+        elif kind == 'add_friendship':
+            user_id, friend_id = args
+            self._friends[user_id].add(friend_id)
+            self._friends[friend_id].add(user_id)
+
+    def _record(self, change):
+        with self._lock:
+            self._ensure_loaded()
+            self._apply(change)
+            previous = self._generation
+            generation = cache.bump(GENERATION_KEY)
+            cache.set(f'{CHANGE_KEY}:{generation}', change, ttl=CHANGE_TTL)
+            if generation == previous + 1:
+                self._generation = generation
+            elif not self._replay(generation):
+                # Another worker changed the graph in between and its change is gone
+                self._generation = None
+
+    # --- lookups ---
+
+    def friend_ids(self, user_id):
+        self._ensure_loaded()
+        return frozenset(self._friends.get(user_id, ()))
+
+    def is_friend(self, user_id, other_id):
+        self._ensure_loaded()
+        return other_id in self._friends.get(user_id, ())
+
+    def pending_request(self, user_id, other_id):
+        """The pending request between the two users in either direction, or None."""
+        self._ensure_loaded()
+        return self._outgoing.get(user_id, {}).get(other_id) or self._incoming.get(user_id, {}).get(other_id)
+
+    def incoming_requests(self, user_id):
+        self._ensure_loaded()
+        return sorted(self._incoming.get(user_id, {}).values())
+
+    def relationships(self, user_id, other_ids):
+        """The user's status towards each of ``other_ids`` in one pass.
+
+        Returns ``{other_id: status}`` with status ``'friend'``, ``'outgoing'``
+        (request sent), ``'incoming'`` (request received) or None.
+        """
+        self._ensure_loaded()
+        # Snapshots: add_friendship and the request updates change these in other threads
+        with self._lock:
+            friends = frozenset(self._friends.get(user_id, ()))
+            outgoing = frozenset(self._outgoing.get(user_id, {}))
+            incoming = frozenset(self._incoming.get(user_id, {}))
+        statuses = {}
+        for other_id in other_ids:
+            if other_id in friends:
+                statuses[other_id] = 'friend'
+            elif other_id in outgoing:
+                statuses[other_id] = 'outgoing'
+            elif other_id in incoming:
+                statuses[other_id] = 'incoming'
+            else:
+                statuses[other_id] = None
+        return statuses
+
+    def mutual_friend_count(self, user_id, other_id):
+        self._ensure_loaded()
+        with self._lock:
+            friends = frozenset(self._friends.get(user_id, ()))
+            others = frozenset(self._friends.get(other_id, ()))
+        return len(friends & others)
+
+    def suggestions(self, user_id, limit=5):
+        """Friends of friends ranked by mutual friend count, as ``(user_id, mutual)`` pairs."""
+        self._ensure_loaded()
+        counts = Counter()
+        # The friend sets are changed in place by add_friendship, so count under the lock
+        with self._lock:
+            friends = frozenset(self._friends.get(user_id, ()))
+            pending = self._outgoing.get(user_id, {}).keys() | self._incoming.get(user_id, {}).keys()
+            for friend_id in friends:
+                counts.update(self._friends.get(friend_id, ()))
+        for excluded in friends | pending | {user_id}:
+            counts.pop(excluded, None)
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    # --- updates, call after committing ---
+
+    def add_request(self, request):
+        self._record(('add_request', request.id, request.sender_id, request.receiver_id))
+
+    def remove_request(self, sender_id, receiver_id):
+        self._record(('remove_request', sender_id, receiver_id))
+
+    def add_friendship(self, user_id, friend_id):
+        self._record(('add_friendship', user_id, friend_id))
+
+
+social_graph = SocialGraph()
+
+
+def load_users(user_ids):
+    """Load users with a single IN query, returned as ``{id: User}``."""
+    from app.models import User
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    return {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
@@ -0,0 +1,50 @@
+"""
+Statement timer shared by the SQL instrumentation.
+
+``watch(engine, callback)`` times every statement the engine runs, once,
+and calls ``callback(conn, cursor, statement, parameters, context,
+executemany, elapsed)`` after each one that succeeds.  app/metrics.py and
+app/slowlog.py both use it, so a statement costs two clock reads however
+many of them listen.
+
+Start times are kept in ``conn.info`` keyed by DBAPI cursor, since that
+dict lives as long as the pooled connection.  A failed statement gets no
+``after_cursor_execute``, so ``handle_error`` drops its start time.
+"""
+import time
+
+from sqlalchemy import event
+
+INFO_KEY = 'statement_started'
+
+_callbacks = {}  # engine -> [callback]
+
+
+def watch(engine, callback):
+    """Call ``callback`` with the elapsed time after each statement ``engine`` runs."""
+    callbacks = _callbacks.setdefault(engine, [])
+    if callback not in callbacks:
+        callbacks.append(callback)
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _forget_failed_statement)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(INFO_KEY, {})[cursor] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get(INFO_KEY, {}).pop(cursor, None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    for callback in _callbacks.get(conn.engine, ()):
+        callback(conn, cursor, statement, parameters, context, executemany, elapsed)
+
+
+def _forget_failed_statement(context):
+    cursor = getattr(context.execution_context, 'cursor', None)
+    if context.connection is not None and cursor is not None:
+        context.connection.info.get(INFO_KEY, {}).pop(cursor, None)
@@ -0,0 +1,89 @@
+"""
+Template rendering helpers: fragment caching, the bytecode cache and
+render timing.
+
+Wrap an expensive section of a template in a ``cache`` block.  All values
+after the tag form the cache key, so include whatever the section depends
+on, usually the owner's ``data_version``::
+
+    {% cache 'sleep-records', current_user.id, data_version %}
+        ... loop over records ...
+    {% endcache %}
+
+Because Jinja only evaluates the body on a miss, views can pass unexecuted
+queries (``user.sleep_records.order_by(...)``) and skip the database too.
+The blocks render uncached when the cache backend cannot share generations
+between processes (``CACHE_BACKEND = 'null'``), since a write in another
+worker would not change the key.
+"""
+import os
+import time
+
+from flask import current_app, g, template_rendered, before_render_template
+from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+from app.cache import LRUCache
+
+fragment_cache = LRUCache(max_entries=4096)
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        call = self.call_method('_cache_support', [nodes.List(parts)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, parts, caller):
+        if not current_app.extensions['cache'].tracks_generations:
+            return caller()
+        key = '|'.join(str(part) for part in parts)
+        rendered = fragment_cache.get(key)
+        if rendered is None:
+            rendered = caller()
+            fragment_cache.set(key, rendered, ttl=current_app.config['FRAGMENT_CACHE_TTL'])
+        return rendered
+
+
+def _data_version():
+    if current_user.is_authenticated:
+        return {'data_version': current_app.extensions['cache'].user_generation(current_user.id)}
+    return {'data_version': 0}
+
+
+def _render_started(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+
+def _render_finished(sender, template, context, **extra):
+    started = g.get('render_started')
+    if started:
+        elapsed = time.perf_counter() - started.pop()
+        g.template_render_time = g.get('template_render_time', 0.0) + elapsed
+
+
+def _add_server_timing(response):
+    render_time = g.get('template_render_time')
+    if render_time is not None:
+        response.headers.add('Server-Timing', f'render;dur={render_time * 1000:.2f}')
+    return response
+
+
+def init_templating(app):
+    app.config.setdefault('FRAGMENT_CACHE_TTL', 3600) # seconds
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    # Compiled templates are kept on disk so new workers skip recompiling them
+    bytecode_dir = os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(bytecode_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+    app.context_processor(_data_version)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+    app.after_request(_add_server_timing)
@@ -0,0 +1,118 @@
+"""
+Sleep timeline: minutes slept on each calendar day.
+
+``attribute`` turns sleep intervals into minutes per day over a range of
+days with NumPy interval arithmetic, without a loop over the records:
+
+* by default a session is cut at midnight, so a night from 23:00 to 07:00
+  counts one hour for the first day and seven for the second;
+* with ``split_midnight=False`` a whole session counts for the day it ends
+  on, as on the weekly sleep chart;
+* naps, sessions of at most ``NAP_MAX_MINUTES`` that start between the
+  ``NAP_WINDOW`` hours, are counted apart from night sleep.
+
+``year_timeline`` computes a whole year for a user from one range query
+and keeps it in the shared cache, keyed by the user's data generation.
+The month and year heatmaps at ``/api/sleep/heatmap`` are slices of it,
+so after the first request they cost the same for a user with ten
+records as for one with ten thousand.  Days are UTC dates, as on the
+rest of the site.
+"""
+import calendar
+from datetime import date, datetime
+
+import numpy as np
+from sqlalchemy import select
+
+from app import db, cache
+from app.models import SleepRecord
+
+MINUTES_PER_DAY = 24 * 60
+NAP_MAX_MINUTES = 180
+NAP_WINDOW = (9, 20) # hours of the day a nap may start in
+TIMELINE_TTL = 7 * 86400 # seconds; new records change the key anyway
+
+
+def _minutes(moments):
+    """Datetimes as minutes since 1970-01-01."""
+    return np.array(moments, dtype='datetime64[m]').astype(np.int64)
+
+
+def is_nap(starts, ends):
+    """Which of the sessions ``[starts, ends)`` (minutes since the epoch) are naps."""
+    start_of_day = starts % MINUTES_PER_DAY
+    return ((ends - starts <= NAP_MAX_MINUTES)
+            & (start_of_day >= NAP_WINDOW[0] * 60) & (start_of_day < NAP_WINDOW[1] * 60))
+
+
+def attribute(starts, ends, first_day, days, split_midnight=True):
+    """Minutes of night sleep and of naps on each of ``days`` days.
+
+    ``starts`` and ``ends`` are the sessions in minutes since the epoch and
+    ``first_day`` is the first day of the range, in days since the epoch.
+    Returns two float arrays of length ``days``.  Parts of sessions outside
+    the range are left out.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    valid = ends > starts
+    starts, ends = starts[valid], ends[valid]
+    nap = is_nap(starts, ends)
+    if split_midnight:
+        # One piece per day a session touches: its first day plus the piece's position within it
+        first = starts // MINUTES_PER_DAY
+        pieces = (ends - 1) // MINUTES_PER_DAY - first + 1
+        session = np.repeat(np.arange(len(starts)), pieces)
+        position = np.arange(len(session)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        day = first[session] + position
+        minutes = (np.minimum(ends[session], (day + 1) * MINUTES_PER_DAY)
+                   - np.maximum(starts[session], day * MINUTES_PER_DAY))
+    else:
+        session = np.arange(len(starts))
+        day = ends // MINUTES_PER_DAY
+        minutes = ends - starts
+    index = day - first_day
+    inside = (index >= 0) & (index < days)
+    night = inside & ~nap[session]
+    naps = inside & nap[session]
+    # float even with no sessions, where bincount would return integers
+    return (np.bincount(index[night], weights=minutes[night], minlength=days).astype(np.float64),
+            np.bincount(index[naps], weights=minutes[naps], minlength=days).astype(np.float64))
+
+
+def build_year(user_id, year, split_midnight=True):
+    """``(night, nap)`` minutes for every day of ``year``, read from the sleep records."""
+    start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    rows = db.session.execute(select(SleepRecord.sleep_time, SleepRecord.wakeup_time)
+                              .where(SleepRecord.user_id == user_id,
+                                     SleepRecord.sleep_time < end,
+                                     SleepRecord.wakeup_time >= start)).all()
+    first_day = (start - datetime(1970, 1, 1)).days
+    days = 366 if calendar.isleap(year) else 365
+    return attribute(_minutes([row.sleep_time for row in rows]), _minutes([row.wakeup_time for row in rows]),
+                     first_day, days, split_midnight)
+
+
+def year_timeline(user_id, year, split_midnight=True):
+    """``build_year``, from the shared cache when the user's records have not changed since."""
+    key = f'sleep-timeline:{user_id}:{cache.user_generation(user_id)}:{year}:{int(split_midnight)}'
+    return cache.get_or_set(key, lambda: build_year(user_id, year, split_midnight), ttl=TIMELINE_TTL)
+
+
+def heatmap(user_id, year, month=None, split_midnight=True):
+    """Hours slept per day of a year, or of one month of it, for the sleep page's calendar."""
+    night, nap = year_timeline(user_id, year, split_midnight)
+    first = date(year, month or 1, 1)
+    last = date(year, month, calendar.monthrange(year, month)[1]) if month else date(year, 12, 31)
+    offset = (first - date(year, 1, 1)).days
+    days = (last - first).days + 1
+    night = np.round(night[offset:offset + days] / 60, 2)
+    nap = np.round(nap[offset:offset + days] / 60, 2)
+    dates = np.arange(np.datetime64(first), np.datetime64(last) + 1).astype(str)
+    return {
+        'start': first.isoformat(),
+        'end': last.isoformat(),
+        'split_midnight': split_midnight,
+        'days': [list(day) for day in zip(dates.tolist(), night.tolist(), nap.tolist())],
+        'max': float((night + nap).max()),
+    }
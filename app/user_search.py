@@ -0,0 +1,109 @@
+"""
+Username search.
+
+Two strategies are merged into one ranked list:
+
+* prefix matches are a range scan over the ``lower(username)`` index
+  (``lower(q) <= lower(username) < lower(q) + U+10FFFF``), so they ignore
+  case and cost the same with ten users or ten million;
+* typo-tolerant matches come from the ``username_trigram`` table.  Each
+  username is lower-cased, padded and split into trigrams
+  (``'bob'`` -> ``'  b', ' bo', 'bob', 'ob '``); users sharing enough
+  trigrams with the query are ranked by Jaccard similarity.
+
+The ranked id list for a query is cached until any username changes, so
+paging through results re-runs neither search.
+"""
+import hashlib
+
+from sqlalchemy import delete, func, insert, literal
+
+from app import db, cache
+from app.models import User, UsernameTrigram
+
+GENERATION_KEY = 'usernames'
+MAX_RESULTS = 200
+MAX_CANDIDATES = 500
+MIN_SIMILARITY = 0.2
+
+
+def trigrams(name):
+    padded = f'  {name.lower()} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def index_username(user):
+    """(Re)write a user's trigrams.
+
+    Call before committing a new or renamed user, and bump ``GENERATION_KEY``
+    after the commit.
+    """
+    if user.id is None:
+        db.session.flush()
+    db.session.execute(delete(UsernameTrigram).where(UsernameTrigram.user_id == user.id))
+    if user.username:
+        db.session.execute(insert(UsernameTrigram), [
+            {'trigram': trigram, 'user_id': user.id} for trigram in trigrams(user.username)
+        ])
+
+
+def search_user_ids(q):
+    """Ids of users matching ``q``, best first, at most ``MAX_RESULTS``."""
+    q = q.strip()
+    if not q:
+        return []
+    generation = cache.generation(GENERATION_KEY)
+    digest = hashlib.blake2b(q.encode(), digest_size=12).hexdigest()
+    return cache.get_or_set(f'user_search:{generation}:{digest}', lambda: _search(q), ttl=3600)
+
+
+def search_users(q, page=1, per_page=20, exclude_id=None):
+    """One page of matching users as ``(users, total)``."""
+    ids = [user_id for user_id in search_user_ids(q) if user_id != exclude_id]
+    page_ids = ids[(page - 1) * per_page:page * per_page]
+    if not page_ids:
+        return [], len(ids)
+    users = {user.id: user for user in User.query.filter(User.id.in_(page_ids))}
+    return [users[user_id] for user_id in page_ids if user_id in users], len(ids)
+
+
+def _search(q):
+    ranked = _prefix_matches(q)
+    # One-character queries would pull in a large share of all users
+    if len(q) >= 2 and len(ranked) < MAX_RESULTS:
+        seen = set(ranked)
+        ranked.extend(user_id for user_id in _fuzzy_matches(q) if user_id not in seen)
+    return ranked[:MAX_RESULTS]
+
+
+def _prefix_matches(q):
+    # Both sides lowered by SQLite, so they fold case the same way and the expression index applies
+    username = func.lower(User.username)
+    prefix = func.lower(literal(q))
+    rows = db.session.query(User.id) \
+        .filter(username >= prefix, username < prefix.concat('\U0010ffff')) \
+        .order_by(username, User.id).limit(MAX_RESULTS)
+    return [user_id for user_id, in rows]
+
+
+def _fuzzy_matches(q):
+    query_grams = trigrams(q)
+    # similarity >= MIN_SIMILARITY implies at least this many shared trigrams
+    required = max(1, int(len(query_grams) * MIN_SIMILARITY))
+    shared = func.count().label('shared')
+    candidates = db.session.query(UsernameTrigram.user_id, shared) \
+        .filter(UsernameTrigram.trigram.in_(query_grams)) \
+        .group_by(UsernameTrigram.user_id).having(shared >= required) \
+        .order_by(shared.desc()).limit(MAX_CANDIDATES).all()
+    if not candidates:
+        return []
+
+    sizes = dict(db.session.query(UsernameTrigram.user_id, func.count())
+                 .filter(UsernameTrigram.user_id.in_([user_id for user_id, _ in candidates]))
+                 .group_by(UsernameTrigram.user_id))
+    scored = []
+    for user_id, count in candidates:
+        similarity = count / (len(query_grams) + sizes[user_id] - count)
+        if similarity >= MIN_SIMILARITY:
+            scored.append((-similarity, user_id))
+    return [user_id for _, user_id in sorted(scored)]
@@ -0,0 +1,18 @@
+"""
+ASGI entry point, for serving the I/O-bound routes on an event loop.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+
+See app/asgi.py.  Uses the ``production`` config unless ``APP_CONFIG``
+says otherwise; the other requests still run the Flask views, in a pool of
+``ASGI_THREADS`` threads per worker.
+"""
+import os
+
+from app import create_app
+from app.asgi import AsyncRoutes
+from app.prefork import warm_up
+
+flask_app = create_app(os.environ.get('APP_CONFIG', 'production'))
+warm_up(flask_app)
+app = AsyncRoutes(flask_app)
@@ -0,0 +1,206 @@
+"""
+Concurrent advice streams: gunicorn (wsgi.py) against uvicorn (asgi.py).
+
+    python benchmarks/asgi_vs_wsgi.py --concurrency 10 100 1000 --workers 2
+
+Starts llm_stub.py, then each server in turn on a scratch database, logs in
+one user and opens N ``/advice/stream`` connections at once for every N in
+``--concurrency``.  The shared cache is off (``CACHE_BACKEND=null``) so
+every stream waits on the stub.  Per level it prints how many streams
+completed, how many were turned away with 503 (the WSGI view allows
+``ADVICE_MAX_STREAMS`` per worker), ended with a ``failed`` event (the
+upstream call failed) or broke off, and the time to the first
+event and to the end of the stream.  ``--json`` also writes the results to
+a file.
+
+Needs gunicorn, uvicorn and httpx.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'nothing listening on port {port} after {timeout}s')
+
+
+def start(command, env):
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+def stop(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 3)
+
+
+def log_in(base_url):
+    """Register and log in a user; returns the session cookies."""
+    with httpx.Client(base_url=base_url, timeout=30) as client:
+        def csrf(path):
+            return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', client.get(path).text).group(1)
+        name = f'bench{int(time.time() * 1000) % 10 ** 8}'
+        client.post('/register', data={'csrf_token': csrf('/register'), 'username': name,
+                                       'email': f'{name}@example.com', 'password': 'bench-pass',
+                                       'password2': 'bench-pass'})
+        response = client.post('/login', data={'csrf_token': csrf('/login'), 'username': name,
+                                               'password': 'bench-pass'})
+        if response.status_code != 302 or not response.headers['location'].endswith('/index'):
+            raise RuntimeError('could not log in')
+        return dict(client.cookies)
+
+
+async def one_stream(client, results):
+    started = time.monotonic()
+    first = None
+    try:
+        async with client.stream('GET', '/advice/stream') as response:
+            if response.status_code == 503:
+                results['rejected'] += 1
+                return
+            if response.status_code != 200:
+                results['errors'] += 1
+                return
+            done = False
+            async for line in response.aiter_lines():
+                if first is None and line.startswith('data:'):
+                    first = time.monotonic() - started
+                if line == 'event: failed':
+                    results['failed'] += 1
+                    return
+                if line == 'event: done':
+                    done = True
+            if not done:
+                results['errors'] += 1
+                return
+    except httpx.HTTPError:
+        results['errors'] += 1
+        return
+    results['ok'] += 1
+    results['first_event'].append(first)
+    results['total'].append(time.monotonic() - started)
+
+
+async def run_level(base_url, cookies, concurrency, timeout):
+    results = {'ok': 0, 'rejected': 0, 'failed': 0, 'errors': 0, 'first_event': [], 'total': []}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, cookies=cookies, limits=limits,
+                                 timeout=httpx.Timeout(timeout, pool=None)) as client:
+        started = time.monotonic()
+        await asyncio.gather(*(one_stream(client, results) for _ in range(concurrency)))
+        wall = time.monotonic() - started
+    return {
+        'concurrency': concurrency,
+        'ok': results['ok'],
+        'rejected': results['rejected'],
+        'failed': results['failed'],
+        'errors': results['errors'],
+        'wall_s': round(wall, 3),
+        'first_event_p50_s': percentile(results['first_event'], 0.5),
+        'first_event_p95_s': percentile(results['first_event'], 0.95),
+        'total_p50_s': percentile(results['total'], 0.5),
+        'total_p95_s': percentile(results['total'], 0.95),
+        'total_mean_s': round(statistics.mean(results['total']), 3) if results['total'] else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--workers', type=int, default=2, help='server processes for both modes')
+    parser.add_argument('--threads', type=int, default=4, help='gthread threads per gunicorn worker')
+    parser.add_argument('--latency', type=float, default=1.0, help='stub latency before the first chunk')
+    parser.add_argument('--chunk-size', type=int, default=32, help='stub characters per chunk')
+    parser.add_argument('--chunk-delay', type=float, default=0.05, help='stub delay between chunks')
+    parser.add_argument('--timeout', type=float, default=120, help='client read timeout per stream')
+    parser.add_argument('--modes', nargs='+', choices=['wsgi', 'asgi'], default=['wsgi', 'asgi'])
+    parser.add_argument('--port', type=int, default=8100, help='first of three ports to use')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    stub_port, wsgi_port, asgi_port = args.port, args.port + 1, args.port + 2
+    scratch = tempfile.mkdtemp(prefix='hms-bench-')
+    env = dict(os.environ,
+               APP_CONFIG='production',
+               DATABASE_URL=f"sqlite:///{os.path.join(scratch, 'app.db')}",
+               CACHE_BACKEND='null',
+               SESSION_BACKEND='cookie',
+               SESSION_COOKIE_SECURE='false',
+               DEEPSEEK_API_KEY='stub',
+               DEEPSEEK_API_URL=f'http://127.0.0.1:{stub_port}/v1/chat/completions',
+               WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_THREADS=str(args.threads),
+               FLASK_APP='run.py')
+    subprocess.run([sys.executable, '-m', 'flask', 'db', 'upgrade'], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    commands = {
+        'wsgi': [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{wsgi_port}',
+                 'wsgi:app'],
+        'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(asgi_port),
+                 '--workers', str(args.workers), '--log-level', 'warning'],
+    }
+    ports = {'wsgi': wsgi_port, 'asgi': asgi_port}
+
+    stub = start([sys.executable, 'llm_stub.py', '--port', str(stub_port), '--latency', str(args.latency),
+                  '--jitter', '0', '--chunk-size', str(args.chunk_size), '--chunk-delay', str(args.chunk_delay),
+                  '--quiet'], env)
+    report = {'settings': vars(args), 'results': {}}
+    try:
+        wait_for_port(stub_port)
+        for mode in args.modes:
+            server = start(commands[mode], env)
+            try:
+                wait_for_port(ports[mode])
+                base_url = f'http://127.0.0.1:{ports[mode]}'
+                cookies = log_in(base_url)
+                report['results'][mode] = []
+                for concurrency in args.concurrency:
+                    row = asyncio.run(run_level(base_url, cookies, concurrency, args.timeout))
+                    report['results'][mode].append(row)
+                    print(f"{mode}  n={concurrency:<5} ok={row['ok']:<5} 503={row['rejected']:<5} "
+                          f"failed={row['failed']:<4} errors={row['errors']:<4} wall={row['wall_s']:.2f}s  "
+                          f"first event p50/p95={row['first_event_p50_s']}/{row['first_event_p95_s']}s  "
+                          f"total p50/p95={row['total_p50_s']}/{row['total_p95_s']}s", flush=True)
+            finally:
+                stop(server)
+    finally:
+        stop(stub)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
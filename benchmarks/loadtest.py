@@ -0,0 +1,357 @@
+"""
+End-to-end load test: many logged-in users browsing, logging records and asking for advice.
+
+    python benchmarks/loadtest.py --users 200 --duration 120 --server wsgi --workers 4
+    python benchmarks/loadtest.py --users 200 --server asgi --env SQLALCHEMY_ENGINE_OPTIONS=...
+    python benchmarks/loadtest.py --url http://staging:8000 --metrics-token secret --users 50
+
+Without ``--url`` it builds a scratch database with ``flask generate-data``
+(``--accounts`` users with ``--years`` of history), starts llm_stub.py in
+place of DeepSeek (``--llm-latency``) and serves the app with gunicorn
+(``--server wsgi``) or uvicorn (``--server asgi``).  ``--env KEY=VALUE``
+passes settings through to the server, for comparing database or cache
+configurations.  With ``--url`` it drives a running server whose users are
+named ``<--user-prefix><n>`` with ``--password``, as the generator makes
+them.
+
+Each virtual user logs in as its own account, ramping up over ``--ramp-up``
+seconds, then picks actions from ``--mix`` (weights, see ``ACTIONS``) with
+an exponential think time of mean ``--think`` seconds until ``--duration``
+is over.  Form posts fetch the form page first, as a browser would.
+
+Per action and overall it prints requests, requests per second, error
+rate and latency percentiles.  It also prints how many SQL statements
+failed on the server during the run, read from ``/metrics``: in total and
+with ``database is locked``.  ``--json`` writes everything to a file.
+
+Needs httpx, and gunicorn or uvicorn for the server it starts.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+import httpx
+
+from asgi_vs_wsgi import ROOT, wait_for_port, start, stop, percentile
+
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+METRIC_LINE = re.compile(r'^(hms_sql_errors_total)\{(.*)\} (\S+)$', re.M)
+
+# action -> default weight
+ACTIONS = {
+    'dashboard': 30,
+    'sleep_page': 8,
+    'exercise_page': 8,
+    'diet_page': 8,
+    'add_sleep': 4,
+    'add_exercise': 5,
+    'add_diet': 8,
+    'report': 10,
+    'friends': 5,
+    'feed': 5,
+    'advice': 3,
+    'advice_stream': 2,
+}
+PAGES = {'dashboard': '/index', 'sleep_page': '/sleep', 'exercise_page': '/exercise', 'diet_page': '/diet',
+         'report': '/report', 'friends': '/friends', 'feed': '/feed'}
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int)) # action -> status or exception name -> count
+
+    def record(self, action, started, error=None):
+        self.latencies[action].append(time.monotonic() - started)
+        if error is not None:
+            self.errors[action][str(error)] += 1
+
+    def summary(self, action, latencies, errors, elapsed):
+        failed = sum(errors.values())
+        return {
+            'action': action,
+            'requests': len(latencies),
+            'rps': round(len(latencies) / elapsed, 2),
+            'errors': failed,
+            'error_rate': round(failed / len(latencies), 4) if latencies else 0,
+            'error_kinds': dict(errors),
+            'p50_s': percentile(latencies, 0.5),
+            'p90_s': percentile(latencies, 0.9),
+            'p99_s': percentile(latencies, 0.99),
+            'max_s': round(max(latencies), 3) if latencies else None,
+        }
+
+    def report(self, elapsed):
+        rows = [self.summary(action, latencies, self.errors[action], elapsed)
+                for action, latencies in sorted(self.latencies.items())]
+        everything = [value for latencies in self.latencies.values() for value in latencies]
+        errors = defaultdict(int)
+        for kinds in self.errors.values():
+            for kind, count in kinds.items():
+                errors[kind] += count
+        rows.append(self.summary('TOTAL', everything, errors, elapsed))
+        return rows
+
+
+class VirtualUser:
+
+    def __init__(self, index, client, stats, mix, think):
+        self.index = index
+        self.client = client
+        self.stats = stats
+        self.actions, self.weights = zip(*mix.items())
+        self.think = think
+        self.naps = 0
+
+    async def request(self, action, method, url, expect=(200,), **kwargs):
+        """Send one request and record it; returns the response or None on failure."""
+        started = time.monotonic()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.stats.record(action, started, type(e).__name__)
+            return None
+        if response.status_code not in expect:
+            self.stats.record(action, started, response.status_code)
+            return None
+        self.stats.record(action, started)
+        return response
+
+    async def form_token(self, action, url):
+        response = await self.request(action, 'GET', url)
+        match = CSRF.search(response.text) if response is not None else None
+        return match.group(1) if match else None
+
+    async def log_in(self, username, password):
+        token = await self.form_token('login_page', '/login')
+        if token is None:
+            return False
+        response = await self.request('login', 'POST', '/login', expect=(302,),
+                                      data={'csrf_token': token, 'username': username, 'password': password})
+        return response is not None and response.headers.get('location', '').endswith('/index')
+
+    async def add_sleep(self):
+        token = await self.form_token('sleep_page', '/sleep')
+        if token is None:
+            return
+        # An afternoon nap one day further back each time, clear of the generated nights
+        self.naps += 1
+        nap = datetime.combine(date.today() - timedelta(days=self.naps), datetime.min.time()) + timedelta(hours=13)
+        await self.request('add_sleep', 'POST', '/sleep', expect=(302,), data={
+            'csrf_token': token, 'sleep_time': nap.strftime('%Y-%m-%d %H:%M'),
+            'wakeup_time': (nap + timedelta(minutes=random.choice([20, 30, 45]))).strftime('%Y-%m-%d %H:%M')})
+
+    async def add_exercise(self):
+        token = await self.form_token('exercise_page', '/exercise')
+        if token is None:
+            return
+        await self.request('add_exercise', 'POST', '/exercise', expect=(302,), data={
+            'csrf_token': token, 'exercise_date': date.today().isoformat(),
+            'exercise_type': random.choice(['跑步', '游泳', '瑜伽', '骑行']),
+            'duration': random.choice(['15', '30', '45', '60'])})
+
+    async def add_diet(self):
+        token = await self.form_token('diet_page', '/diet')
+        if token is None:
+            return
+        await self.request('add_diet', 'POST', '/diet', expect=(302,), data={
+            'csrf_token': token, 'food_choice': random.choice(['米饭', '鸡蛋', '牛奶', '苹果', '鸡胸肉']),
+            'portion': random.choice(['50', '100', '150', '200']),
+            'meal_type': random.choice(['早餐', '午餐', '晚餐', '加餐'])})
+
+    async def advice(self):
+        await self.request('advice', 'POST', '/get_deepseek_advice')
+
+    async def advice_stream(self):
+        started = time.monotonic()
+        try:
+            async with self.client.stream('GET', '/advice/stream') as response:
+                if response.status_code != 200:
+                    self.stats.record('advice_stream', started, response.status_code)
+                    return
+                async for line in response.aiter_lines():
+                    if line == 'event: failed':
+                        self.stats.record('advice_stream', started, 'failed event')
+                        return
+        except httpx.HTTPError as e:
+            self.stats.record('advice_stream', started, type(e).__name__)
+            return
+        self.stats.record('advice_stream', started)
+
+    async def run(self, username, password, deadline):
+        if not await self.log_in(username, password):
+            return
+        while time.monotonic() < deadline:
+            action = random.choices(self.actions, self.weights)[0]
+            if action in PAGES:
+                await self.request(action, 'GET', PAGES[action])
+            else:
+                await getattr(self, action)()
+            await asyncio.sleep(random.expovariate(1 / self.think) if self.think else 0)
+
+
+async def scrape_sql_errors(base_url, token):
+    """``{kind: count}`` of failed SQL statements from /metrics, or None if it cannot be read."""
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+            response = await client.get('/metrics', headers=headers)
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return None
+    kinds = defaultdict(float)
+    for _, labels, value in METRIC_LINE.findall(response.text):
+        kind = re.search(r'kind="([^"]*)"', labels)
+        kinds[kind.group(1) if kind else 'other'] += float(value)
+    return dict(kinds)
+
+
+async def load(args, base_url, mix):
+    stats = Stats()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    before = await scrape_sql_errors(base_url, args.metrics_token)
+    started = time.monotonic()
+    deadline = started + args.ramp_up + args.duration
+
+    async def one(index):
+        await asyncio.sleep(args.ramp_up * index / max(1, args.users))
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+            user = VirtualUser(index, client, stats, mix, args.think)
+            await user.run(f'{args.user_prefix}{args.first_account + index % args.accounts}', args.password, deadline)
+
+    await asyncio.gather(*(one(index) for index in range(args.users)))
+    elapsed = time.monotonic() - started
+    if before is not None:
+        await asyncio.sleep(args.metrics_wait)  # until every worker has written its snapshot
+    after = await scrape_sql_errors(base_url, args.metrics_token)
+    sql_errors = None
+    if before is not None and after is not None:
+        sql_errors = {kind: int(after.get(kind, 0) - before.get(kind, 0)) for kind in after}
+    return stats.report(elapsed), sql_errors, elapsed
+
+
+def parse_mix(text):
+    mix = dict(ACTIONS)
+    for part in filter(None, (text or '').split(',')):
+        action, _, weight = part.partition('=')
+        if action not in ACTIONS:
+            raise SystemExit(f'unknown action {action!r}; choose from {", ".join(ACTIONS)}')
+        mix[action] = float(weight)
+    return {action: weight for action, weight in mix.items() if weight > 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=50, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds after ramp-up')
+    parser.add_argument('--ramp-up', type=float, default=10, help='seconds over which users log in')
+    parser.add_argument('--think', type=float, default=1.0, help='mean pause between actions, seconds')
+    parser.add_argument('--mix', help='weights to change, e.g. advice=10,report=0')
+    parser.add_argument('--timeout', type=float, default=60, help='client timeout per request')
+    parser.add_argument('--url', help='test a running server instead of starting one')
+    parser.add_argument('--user-prefix', default='gen')
+    parser.add_argument('--first-account', type=int, default=1)
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--metrics-token', help='METRICS_TOKEN of the server under --url')
+    parser.add_argument('--metrics-wait', type=float, default=6,
+                        help="seconds to wait for the workers' METRICS_FLUSH_INTERVAL before the last scrape")
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='gthread threads per gunicorn worker')
+    parser.add_argument('--accounts', type=int, default=None, help='users to generate (default: --users)')
+    parser.add_argument('--years', type=float, default=0.5, help='history of each generated user')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='stub seconds before answering')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='server setting')
+    parser.add_argument('--port', type=int, default=8200, help='first of two ports to use')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    args.accounts = args.accounts or args.users
+    mix = parse_mix(args.mix)
+
+    processes = []
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            base_url = f'http://127.0.0.1:{args.port + 1}'
+            args.metrics_token = secrets.token_hex(8)
+            processes = start_server(args)
+        results, sql_errors, elapsed = asyncio.run(load(args, base_url, mix))
+    finally:
+        for process in reversed(processes):
+            stop(process)
+
+    print(f"{'action':<16}{'requests':>9}{'req/s':>9}{'errors':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for row in results:
+        latencies = ''.join(f"{'-' if row[key] is None else row[key]:>9}" for key in ('p50_s', 'p90_s', 'p99_s', 'max_s'))
+        print(f"{row['action']:<16}{row['requests']:>9}{row['rps']:>9}{row['errors']:>8}{latencies}"
+              + (f"  {row['error_kinds']}" if row['errors'] else ''))
+    if sql_errors is None:
+        print('Server SQL errors: unknown (/metrics not readable)')
+    else:
+        print(f"Server SQL errors: {sum(sql_errors.values())}, database is locked: {sql_errors.get('locked', 0)}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'elapsed_s': round(elapsed, 1), 'results': results,
+                       'sql_errors': sql_errors}, f, indent=2)
+
+
+def start_server(args):
+    """Prepare a scratch database and start the LLM stub and the app; returns the processes."""
+    stub_port, app_port = args.port, args.port + 1
+    scratch = tempfile.mkdtemp(prefix='hms-load-')
+    env = dict(os.environ,
+               APP_CONFIG='production',
+               DATABASE_URL=f"sqlite:///{os.path.join(scratch, 'app.db')}",
+               SESSION_COOKIE_SECURE='false',
+               DEEPSEEK_API_KEY='stub',
+               DEEPSEEK_API_URL=f'http://127.0.0.1:{stub_port}/v1/chat/completions',
+               METRICS_MODE='light',
+               METRICS_TOKEN=args.metrics_token,
+               WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_THREADS=str(args.threads),
+               FLASK_APP='run.py')
+    for setting in args.env:
+        key, _, value = setting.partition('=')
+        env[key] = value
+    print(f'Generating {args.accounts} users with {args.years} years of history in {scratch}...', flush=True)
+    subprocess.run([sys.executable, '-m', 'flask', 'db', 'upgrade'], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    subprocess.run([sys.executable, '-m', 'flask', 'generate-data', '--users', str(args.accounts),
+                    '--years', str(args.years)], cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    commands = {
+        'wsgi': [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{app_port}',
+                 'wsgi:app'],
+        'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(app_port),
+                 '--workers', str(args.workers), '--log-level', 'warning'],
+    }
+    stub = start([sys.executable, 'llm_stub.py', '--port', str(stub_port), '--latency', str(args.llm_latency),
+                  '--quiet'], env)
+    processes = [stub]
+    try:
+        wait_for_port(stub_port)
+        processes.append(start(commands[args.server], env))
+        wait_for_port(app_port)
+    except Exception:
+        for process in reversed(processes):
+            stop(process)
+        raise
+    return processes
+
+
+if __name__ == '__main__':
+    main()
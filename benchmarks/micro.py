@@ -0,0 +1,187 @@
+"""
+Micro-benchmarks: the analysis functions and every page's render, by data size.
+
+    python benchmarks/micro.py --years 0.1 1 3 --json before.json
+    ... change something ...
+    python benchmarks/micro.py --years 0.1 1 3 --json after.json
+    python benchmarks/micro.py --compare before.json after.json
+
+For each ``--years`` value, fills a scratch database with app/datagen.py
+(``--users`` users, each with that many years of history) and times, for
+the first user:
+
+* ``history.load``, which reads the user's sleep and exercise arrays;
+* ``generate_sleep_prediction`` and ``analyze_exercise_sleep_correlation``
+  over those arrays, as the report builds them;
+* ``get_weekly_avg_sleep``;
+* ``timeline.build_year`` for the current year, uncached;
+* a GET of every page in app/querybudget.py's ``ROUTE_BUDGETS``.
+
+Every size runs in a fresh process, since the social graph, food catalog
+and identity cache are per-process.  Each case runs once to warm up and
+then ``--repeat`` times; the minimum, median and mean are printed and, with
+``--json``, written together with the commit they were measured at.  ``--compare`` prints the median change per
+case between two such files and exits with status 1 if any case got slower
+by more than ``--threshold``.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(fn, repeat):
+    fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return {'runs': repeat, 'min_s': round(min(timings), 6), 'median_s': round(statistics.median(timings), 6),
+            'mean_s': round(statistics.mean(timings), 6)}
+
+
+def run_size(years, users, repeat, seed):
+    from config import TestingConfig
+    from app import create_app
+
+    scratch = tempfile.mkdtemp(prefix='hms-micro-')
+
+    class BenchConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(scratch, 'app.db')}"
+
+    app = create_app(BenchConfig)
+    try:
+        return _run_cases(app, years, users, repeat, seed)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _run_cases(app, years, users, repeat, seed):
+    from app import db, history, timeline
+    from app.analysis import generate_sleep_prediction, analyze_exercise_sleep_correlation, get_weekly_avg_sleep
+    from app.datagen import generate
+    from app.models import User
+    from app.querybudget import ROUTE_BUDGETS
+
+    results = []
+    with app.app_context():
+        db.create_all()
+        generate(users=users, years=years, seed=seed)
+        user = db.session.get(User, 1)
+        sleep, exercise = history.load(user.id)
+        size = {'years': years, 'sleep_records': len(sleep), 'exercise_records': len(exercise),
+                'diet_records': user.diet_records.count()}
+        cases = {
+            'history.load': lambda: history.load(user.id),
+            'generate_sleep_prediction': lambda: generate_sleep_prediction(sleep),
+            'analyze_exercise_sleep_correlation': lambda: analyze_exercise_sleep_correlation(exercise, sleep),
+            'get_weekly_avg_sleep': lambda: get_weekly_avg_sleep(user),
+            'timeline.build_year': lambda: timeline.build_year(user.id, datetime.utcnow().year),
+        }
+        for name, fn in cases.items():
+            results.append({'name': name, **size, **measure(fn, repeat)})
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+    with app.test_request_context():
+        from flask import url_for
+        urls = {endpoint: url_for(endpoint, **({'friend_id': 1} if endpoint == 'main.friend_profile' else {}))
+                for endpoint in ROUTE_BUDGETS}
+    for endpoint, url in urls.items():
+        def get(url=url):
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f'{url} answered {response.status_code}')
+        results.append({'name': f'route:{endpoint}', **size, **measure(get, repeat)})
+
+    return results
+
+
+def compare(before_path, after_path, threshold):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    baseline = {(row['name'], row['years']): row for row in before['results']}
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    regressions = 0
+    for row in after['results']:
+        old = baseline.get((row['name'], row['years']))
+        if old is None or not old['median_s']:
+            continue
+        change = row['median_s'] / old['median_s'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  SLOWER'
+            regressions += 1
+        elif change < -threshold:
+            flag = '  faster'
+        print(f"{row['name']:<42} {row['years']:>5}y  {old['median_s'] * 1000:9.2f}ms -> "
+              f"{row['median_s'] * 1000:9.2f}ms  {change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--years', type=float, nargs='+', default=[0.1, 1, 3], help='history per user')
+    parser.add_argument('--users', type=int, default=20, help='users generated per size')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change reported by --compare')
+    parser.add_argument('--one-size', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    if args.one_size is not None:
+        # The report chart's CJK labels warn on hosts without the font
+        warnings.simplefilter('ignore')
+        logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
+        json.dump(run_size(args.one_size, args.users, args.repeat, args.seed), sys.stdout)
+        return
+
+    report = {'commit': commit(), 'python': platform.python_version(), 'created': datetime.utcnow().isoformat(),
+              'settings': vars(args), 'results': []}
+    for years in args.years:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--one-size', str(years),
+                                '--users', str(args.users), '--repeat', str(args.repeat), '--seed', str(args.seed)],
+                               cwd=ROOT, stdout=subprocess.PIPE, check=True)
+        rows = json.loads(child.stdout)
+        report['results'].extend(rows)
+        for row in rows:
+            print(f"{row['name']:<42} {years:>5}y  {row['sleep_records']:>5} sleep records  "
+                  f"min {row['min_s'] * 1000:9.2f}ms  median {row['median_s'] * 1000:9.2f}ms", flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY') or 'a-secret-key-that-you-should-change'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///app.db'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    REPORT_CACHE_TTL = 3600 # seconds
+    IDENTITY_CACHE_TTL = 300 # seconds
+    FEED_FANOUT_LIMIT = 500 # friends; above this, friends read the user's outbox instead
+    FEED_MAX_ENTRIES = 500 # per timeline, enforced by 'flask feed trim'
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite')
+    CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+    SESSION_REDIS_URL = os.environ.get('REDIS_URL')
+    METRICS_MODE = os.environ.get('METRICS_MODE', 'light') # 'full', 'light' or 'off', see app/metrics.py
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Users who may see /admin pages and profile their own requests, comma-separated
+    ADMIN_USERNAMES = [name.strip() for name in os.environ.get('ADMIN_USERNAMES', '').split(',') if name.strip()]
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0)) # fraction of requests, see app/profiler.py
+    # Seconds; slower SQL statements are logged with their query plan, see app/slowlog.py. 'off' disables
+    SLOW_QUERY_THRESHOLD = (None if os.environ.get('SLOW_QUERY_THRESHOLD') == 'off'
+                            else float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.1)))
+    SCHEDULER_IN_WORKER = os.environ.get('SCHEDULER_IN_WORKER', 'false').lower() == 'true'
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 16)) # per worker, runs the Flask views under asgi.py
+    CHART_WORKERS = int(os.environ.get('CHART_WORKERS', 2)) # renderer processes per worker, 0 draws in-process
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    METRICS_MODE = os.environ.get('METRICS_MODE', 'full')
+
+
+class ProductionConfig(Config):
+    # Set SESSION_COOKIE_SECURE=false only when the site is not served over HTTPS
+    SESSION_COOKIE_SECURE = os.environ.get('SESSION_COOKIE_SECURE', 'true').lower() == 'true'
+    REMEMBER_COOKIE_SECURE = SESSION_COOKIE_SECURE
+    PREFERRED_URL_SCHEME = 'https' if SESSION_COOKIE_SECURE else 'http'
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    # Stores nothing, so tests never read another app's entries; its generations still count
+    # in-process, and {% cache %} blocks render uncached (see NullBackend in app/cache.py)
+    CACHE_BACKEND = 'null'
+    SESSION_BACKEND = 'cookie'
+    METRICS_MODE = 'off'
+    SLOW_QUERY_THRESHOLD = None
+    CHART_WORKERS = 0
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'testing': TestingConfig,
+}
+
+
+def get_config(name=None):
+    """Config class by name, defaulting to the APP_CONFIG environment variable."""
+    return CONFIGS[name or os.environ.get('APP_CONFIG', 'development')]
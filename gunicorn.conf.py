@@ -0,0 +1,31 @@
+# Gunicorn settings for wsgi:app. Every value can be overridden from the
+# environment, e.g. WEB_CONCURRENCY=8 gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+
+# Load the app (and warm its caches, see app/prefork.py) once in the master,
+# then fork workers that share it copy-on-write. With preloading, SIGHUP
+# restarts the workers but does not pick up new code; to deploy, send USR2
+# (starts a new master with the new code) and then QUIT to the old master.
+preload_app = True
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Threads let a worker keep serving pages while some requests wait on
+# DeepSeek or stream advice
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# On SIGHUP/SIGTERM, workers get this long to finish in-flight requests
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Recycle workers now and then so slow leaks cannot build up; the jitter
+# keeps them from all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+accesslog = '-'
+errorlog = '-'
@@ -1,9 +1,11 @@
-from app import app, db
+from app import create_app, db
 from flask_migrate import upgrade
 
+app = create_app()
+
 # Create the application context
 with app.app_context():
     # Apply all migrations
     upgrade()
     
-    print("Database initialized successfully!")
\ No newline at end of file
+    print("Database initialized successfully!")
@@ -0,0 +1,117 @@
+"""
+Local stand-in for the DeepSeek chat completions API, for offline
+development and load tests.
+
+    python llm_stub.py --port 8001 --latency 1.5 --error-rate 0.05
+    DEEPSEEK_API_KEY=stub DEEPSEEK_API_URL=http://127.0.0.1:8001/v1/chat/completions flask run
+
+Answers every POST with a canned OpenAI-style completion after the given
+latency (plus jitter).  Requests with ``"stream": true`` get the answer as
+server-sent events, one chunk every ``--chunk-delay`` seconds.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ADVICE = '''### 健康评估
+
+- **睡眠**：平均睡眠时长基本达标，建议固定作息时间，睡前一小时避免使用电子设备。
+- **体重**：BMI 处于正常范围，继续保持。
+- **饮食与运动**：热量摄入与消耗大致平衡，可以适当增加蛋白质和蔬菜的比例。
+
+### 食谱建议
+
+1. 早餐：燕麦粥、鸡蛋、一份水果
+2. 午餐：糙米饭、清蒸鱼、炒时蔬
+3. 晚餐：杂粮馒头、豆腐汤、凉拌黄瓜
+'''
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None  # set by main()
+    served = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            payload = {}
+        with self.lock:
+            StubHandler.served += 1
+
+        options = self.options
+        time.sleep(max(0.0, random.gauss(options.latency, options.jitter)))
+        if random.random() < options.error_rate:
+            self._send_json(503, {'error': {'message': 'stub: simulated overload'}})
+            return
+        if payload.get('stream'):
+            self._stream()
+        else:
+            self._send_json(200, {
+                'id': f'stub-{self.served}',
+                'object': 'chat.completion',
+                'model': payload.get('model', 'stub'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': ADVICE}}],
+            })
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        size = self.options.chunk_size
+        for i in range(0, len(ADVICE), size):
+            chunk = {'choices': [{'index': 0, 'delta': {'content': ADVICE[i:i + size]}}]}
+            self.wfile.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode())
+            self.wfile.flush()
+            time.sleep(self.options.chunk_delay)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        if not self.options.quiet:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds before the response starts')
+    parser.add_argument('--jitter', type=float, default=0.2, help='standard deviation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--chunk-size', type=int, default=8, help='characters per streamed chunk')
+    parser.add_argument('--chunk-delay', type=float, default=0.05, help='seconds between streamed chunks')
+    parser.add_argument('--quiet', action='store_true')
+    StubHandler.options = parser.parse_args()
+
+    # The default listen backlog of 5 refuses connections under load tests
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((StubHandler.options.host, StubHandler.options.port), StubHandler)
+    server.daemon_threads = True
+    print(f'LLM stub listening on http://{StubHandler.options.host}:{StubHandler.options.port}/v1/chat/completions')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
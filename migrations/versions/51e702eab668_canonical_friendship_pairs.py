@@ -0,0 +1,67 @@
+"""Canonical friendship pairs
+
+Revision ID: 51e702eab668
+Revises: 0e7f0bd43b2d
+Create Date: 2026-10-19 15:11:34.839696
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '51e702eab668'
+down_revision = '0e7f0bd43b2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Friendships: one row per pair with user_id < friend_id. Mirror rows
+    # become duplicates once flipped, so flip first, then keep the oldest row.
+    op.execute('UPDATE friendship SET user_id = friend_id, friend_id = user_id WHERE user_id > friend_id')
+    op.execute('''
+        DELETE FROM friendship
+        WHERE user_id = friend_id
+           OR id NOT IN (SELECT MIN(id) FROM friendship GROUP BY user_id, friend_id)''')
+
+    with op.batch_alter_table('friendship', schema=None) as batch_op:
+        batch_op.create_index('ix_friendship_friend_id', ['friend_id'], unique=False)
+        batch_op.create_unique_constraint('uq_friendship_pair', ['user_id', 'friend_id'])
+        batch_op.create_check_constraint('ck_friendship_canonical', 'user_id < friend_id')
+
+    # Friend requests: record the canonical pair, then settle duplicates so the
+    # partial unique index can be built
+    with op.batch_alter_table('friend_request', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('user_low', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('user_high', sa.Integer(), nullable=True))
+    op.execute('UPDATE friend_request SET user_low = min(sender_id, receiver_id), user_high = max(sender_id, receiver_id)')
+    op.execute('''
+        UPDATE friend_request SET status = 'accepted'
+        WHERE status = 'pending' AND EXISTS (
+            SELECT 1 FROM friendship
+            WHERE friendship.user_id = friend_request.user_low AND friendship.friend_id = friend_request.user_high)''')
+    op.execute('''
+        DELETE FROM friend_request
+        WHERE status = 'pending' AND id NOT IN (
+            SELECT MIN(id) FROM friend_request WHERE status = 'pending' GROUP BY user_low, user_high)''')
+
+    with op.batch_alter_table('friend_request', schema=None) as batch_op:
+        batch_op.alter_column('user_low', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('user_high', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_index('uq_friend_request_pending_pair', ['user_low', 'user_high'], unique=True, sqlite_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    with op.batch_alter_table('friend_request', schema=None) as batch_op:
+        batch_op.drop_index('uq_friend_request_pending_pair', sqlite_where=sa.text("status = 'pending'"))
+        batch_op.drop_column('user_high')
+        batch_op.drop_column('user_low')
+
+    with op.batch_alter_table('friendship', schema=None) as batch_op:
+        batch_op.drop_constraint('ck_friendship_canonical', type_='check')
+        batch_op.drop_constraint('uq_friendship_pair', type_='unique')
+        batch_op.drop_index('ix_friendship_friend_id')
+
+    # Restore the mirror rows the old code expected
+    op.execute('INSERT INTO friendship (user_id, friend_id) SELECT friend_id, user_id FROM friendship')
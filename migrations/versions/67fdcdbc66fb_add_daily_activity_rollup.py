@@ -0,0 +1,49 @@
+"""Add daily activity rollup
+
+Revision ID: 67fdcdbc66fb
+Revises: 5b699437ec34
+Create Date: 2026-10-19 15:12:40.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '67fdcdbc66fb'
+down_revision = '5b699437ec34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_activity',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('exercise_minutes', sa.Float(), nullable=False),
+    sa.Column('calories_burned', sa.Float(), nullable=False),
+    sa.Column('sleep_hours', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'day', name='uq_daily_activity_user_day')
+    )
+
+    # Backfill from existing records; sleep is attributed to the wake-up day
+    op.execute('''
+        INSERT INTO daily_activity (user_id, day, exercise_minutes, calories_burned, sleep_hours)
+        SELECT user_id, day, SUM(exercise_minutes), SUM(calories_burned), SUM(sleep_hours) FROM (
+            SELECT user_id, date(timestamp) AS day, COALESCE(duration, 0) AS exercise_minutes,
+                   COALESCE(calories_burned, 0) AS calories_burned, 0 AS sleep_hours
+            FROM exercise_record
+            UNION ALL
+            SELECT user_id, date(wakeup_time), 0, 0, COALESCE(duration, 0)
+            FROM sleep_record
+        ) AS activity
+        WHERE user_id IS NOT NULL AND day IS NOT NULL
+        GROUP BY user_id, day
+    ''')
+
+
+def downgrade():
+    op.drop_table('daily_activity')
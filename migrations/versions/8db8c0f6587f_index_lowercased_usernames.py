@@ -0,0 +1,25 @@
+"""Index lowercased usernames
+
+Revision ID: 8db8c0f6587f
+Revises: 97f6ea8481fa
+Create Date: 2026-10-19 16:37:04.398325
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8db8c0f6587f'
+down_revision = '97f6ea8481fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Expression index, written by hand: autogenerate cannot reflect these on SQLite
+    op.create_index('ix_user_username_lower', 'user', [sa.text('lower(username)')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_user_username_lower', table_name='user')
@@ -0,0 +1,38 @@
+"""Record the feed path on each entry
+
+Revision ID: 97f6ea8481fa
+Revises: 0c9ea1e20403
+Create Date: 2026-10-19 16:33:07.562979
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '97f6ea8481fa'
+down_revision = '0c9ea1e20403'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('feed_entry', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('pulled', sa.Boolean(), server_default=sa.text('0'), nullable=False))
+
+    # Outbox entries that were never copied to a friend's timeline are read from the outbox
+    op.execute('''
+        UPDATE feed_entry SET pulled = 1
+        WHERE owner_id = actor_id AND NOT EXISTS (
+            SELECT 1 FROM feed_entry AS copy
+            WHERE copy.kind = feed_entry.kind AND copy.record_id = feed_entry.record_id
+              AND copy.owner_id != copy.actor_id)''')
+
+    with op.batch_alter_table('feed_entry', schema=None) as batch_op:
+        batch_op.create_index('ix_feed_entry_pulled_owner_id_id', ['owner_id', 'id'], unique=False, sqlite_where=sa.text('pulled = 1'))
+
+
+def downgrade():
+    with op.batch_alter_table('feed_entry', schema=None) as batch_op:
+        batch_op.drop_index('ix_feed_entry_pulled_owner_id_id', sqlite_where=sa.text('pulled = 1'))
+        batch_op.drop_column('pulled')
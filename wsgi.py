@@ -0,0 +1,14 @@
+"""
+Production entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Uses the ``production`` config unless ``APP_CONFIG`` says otherwise.
+"""
+import os
+
+from app import create_app
+from app.prefork import warm_up
+
+app = create_app(os.environ.get('APP_CONFIG', 'production'))
+warm_up(app)